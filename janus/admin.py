@@ -1,4 +1,4 @@
-from django.contrib import admin
+from django.contrib import admin, messages
 from django.contrib.auth import get_user_model
 from django.template import Template
 from django.utils.module_loading import import_string
@@ -10,7 +10,36 @@ from janus.models import Profile, ApplicationGroup, ProfilePermission, GroupPerm
     ApplicationExtension
 from django.contrib.auth.admin import UserAdmin
 
-from janus.oauth2.util import get_group_list
+from janus.oauth2.util import resolve_permissions_bulk
+from janus.revocation import revoke_tokens, revoke_group_tokens
+
+
+###################################################
+# bulk revocation, large revocations are better run with `./manage.py revoke_tokens`
+
+def revocation_message(modeladmin, request, deleted):
+    modeladmin.message_user(request, "revoked: " + ", ".join("%d %s" % (count, name)
+                                                             for name, count in deleted.items()))
+
+
+@admin.action(description="Revoke tokens and sessions", permissions=['change'])
+def revoke_user_tokens(modeladmin, request, queryset):
+    revocation_message(modeladmin, request, revoke_tokens(queryset.values_list('pk', flat=True)))
+
+
+@admin.action(description="Revoke tokens and sessions of the members", permissions=['change'])
+def revoke_member_tokens(modeladmin, request, queryset):
+    if queryset.filter(default=True).exists():
+        # a default group has all users as members
+        modeladmin.message_user(request, "default groups cannot be revoked, use `./manage.py revoke_tokens` to "
+                                         "revoke the tokens of all users of an application", level=messages.ERROR)
+        return
+    revocation_message(modeladmin, request, revoke_group_tokens(list(queryset.values_list('pk', flat=True))))
+
+
+@admin.action(description="Revoke all tokens of the application", permissions=['change'])
+def revoke_application_tokens(modeladmin, request, queryset):
+    revocation_message(modeladmin, request, revoke_tokens(None, queryset.values_list('pk', flat=True)))
 
 
 ###################################################
@@ -37,10 +66,13 @@ class FakeFormSetNew(FakeFormSet):
 class ApplicationGroupFormSet(FakeFormSetNew):
     # this probably works, but usually you'd point it at a template file.
     template = Template('''
-    <p>Debug applied application groups (save to see the update!):
-    {% for key, value in inline_admin_formset.formset.get_applications.items %}
-    <p>application "{{ key }}":<br/>
-    {{ value }}
+    <p>Debug applied application permissions and groups (save to see the update!):
+    {% for application in inline_admin_formset.formset.get_applications %}
+    <p>application "{{ application.name }}":<br/>
+    can authenticate: {{ application.can_authenticate }},
+    staff: {{ application.is_staff }},
+    superuser: {{ application.is_superuser }}<br/>
+    {{ application.groups }}
     </p>
     {% endfor %}
     
@@ -54,13 +86,23 @@ class ApplicationGroupFormSet(FakeFormSetNew):
 
     def get_applications(self):
         user = self.instance
-
-        ret = {}
-
-        applications = get_application_model().objects.all()
-
-        for application in applications:
-            ret[application.name] = get_group_list(user, application)
+        if user.pk is None:
+            return []
+
+        # resolve all applications at once instead of one query cascade per application
+        resolved = resolve_permissions_bulk([user.pk])
+        ret = []
+
+        for application_id, name in get_application_model().objects.order_by('name', 'pk').values_list('pk', 'name'):
+            (can_authenticate, is_staff, is_superuser), groups = resolved.get(
+                (user.pk, application_id), ((False, False, False), []))
+            ret.append({
+                'name': name,
+                'can_authenticate': can_authenticate,
+                'is_staff': is_staff,
+                'is_superuser': is_superuser,
+                'groups': groups,
+            })
 
         return ret
 
@@ -73,9 +115,14 @@ class ApplicationGroups(FakeInline):
 # noinspection PyRedeclaration
 class JanusUserAdmin(UserAdmin):
     inlines = (ProfileInline, ApplicationGroups)
+    actions = (revoke_user_tokens,)
 
     list_display = UserAdmin.list_display + ('profile_groups',)
 
+    def get_queryset(self, request):
+        # load the profile groups of all users on the page with one query
+        return super().get_queryset(request).select_related('profile').prefetch_related('profile__group')
+
     def profile_groups(self, obj):
         return obj.profile.get_groups()
 
@@ -101,6 +148,7 @@ class ProfileGroupAdmin(admin.ModelAdmin):
     list_display = ('id', 'name', 'description', 'default')
     list_display_links = ('id', 'name')
     search_fields = ('id', 'name')
+    actions = (revoke_member_tokens,)
 
 admin.site.register(ProfileGroup, ProfileGroupAdmin)
 
@@ -108,6 +156,7 @@ admin.site.register(ProfileGroup, ProfileGroupAdmin)
 class ApplicationGroupAdmin(admin.ModelAdmin):
     list_display = ('id', 'application', 'name')
     list_display_links = ('id', 'name')
+    list_select_related = ('application',)
     search_fields = ('id', 'application', 'name')
 
 admin.site.register(ApplicationGroup, ApplicationGroupAdmin)
@@ -116,6 +165,7 @@ admin.site.register(ApplicationGroup, ApplicationGroupAdmin)
 class ProfilePermissionAdmin(admin.ModelAdmin):
     list_display = ('id', 'profile', 'application', 'can_authenticate', 'is_staff', 'is_superuser',)
     list_display_links = ('id',)
+    list_select_related = ('profile__user', 'application',)
     search_fields = ('id', 'profile', 'application',)
 
 admin.site.register(ProfilePermission, ProfilePermissionAdmin)
@@ -124,6 +174,7 @@ admin.site.register(ProfilePermission, ProfilePermissionAdmin)
 class GroupPermissionAdmin(admin.ModelAdmin):
     list_display = ('id', 'profile_group', 'application', 'can_authenticate', 'is_staff', 'is_superuser',)
     list_display_links = ('id',)
+    list_select_related = ('profile_group', 'application',)
     search_fields = ('id', 'profile_group', 'application',)
 
 admin.site.register(GroupPermission, GroupPermissionAdmin)
@@ -136,7 +187,9 @@ class ApplicationExtensionInline(admin.StackedInline):
 
 class ApplicationAdminJanus(ApplicationAdmin):
     list_display = ApplicationAdmin.list_display + ('email_required',)
+    list_select_related = ('user', 'extension',)
     inlines = (ApplicationExtensionInline,)
+    actions = (revoke_application_tokens,)
 
     def email_required(self, object):
         if object.extension:
@@ -10,3 +10,82 @@ JANUS_OIDC_ENABLED = OAUTH_SETTINGS.get('OIDC_ENABLED', False)
 
 # janus supports some non-standard claims. Set which scope is required to return the claims.
 JANUS_OIDC_SCOPE_EXTRA = getattr(settings, 'JANUS_OIDC_SCOPE_EXTRA', 'janus')
+
+# read permissions from the materialized EffectivePermission table instead of resolving them on every request.
+# run `./manage.py rebuild_effective_permissions` after enabling it.
+JANUS_EFFECTIVE_PERMISSIONS = getattr(settings, 'JANUS_EFFECTIVE_PERMISSIONS', False)
+
+# cache the resolved permissions and groups for this many seconds, 0 disables the cache.
+# the entries are invalidated when profiles, groups or permissions change.
+JANUS_PERMISSION_CACHE_TTL = getattr(settings, 'JANUS_PERMISSION_CACHE_TTL', 0)
+# name of the django cache used for the permission cache
+JANUS_PERMISSION_CACHE = getattr(settings, 'JANUS_PERMISSION_CACHE', 'default')
+
+# remember denied authorize requests of a user for an application and unknown client ids for this many seconds,
+# 0 disables it. stops clients stuck in a redirect loop from hitting the database, permission changes and a new
+# application with the client id end it immediately.
+JANUS_AUTHORIZE_DENY_CACHE_TTL = getattr(settings, 'JANUS_AUTHORIZE_DENY_CACHE_TTL', 0)
+
+# keep applications, their extensions and the app launcher entries in memory for this many seconds,
+# 0 disables it. changes are distributed to the other processes through the JANUS_PERMISSION_CACHE cache.
+JANUS_APPLICATION_REGISTRY_TTL = getattr(settings, 'JANUS_APPLICATION_REGISTRY_TTL', 0)
+
+# purge of expired tokens, grants and sessions (janus.tasks.cleanup_token, ./manage.py cleanup_expired)
+JANUS_CLEANUP_BATCH_SIZE = getattr(settings, 'JANUS_CLEANUP_BATCH_SIZE', 1000)
+# seconds to sleep between two batches
+JANUS_CLEANUP_BATCH_INTERVAL = getattr(settings, 'JANUS_CLEANUP_BATCH_INTERVAL', 0.1)
+# stop after this many seconds, 0 for no limit. the next run continues where the last one stopped.
+JANUS_CLEANUP_TIME_BUDGET = getattr(settings, 'JANUS_CLEANUP_TIME_BUDGET', 0)
+
+# time the stages of the profile, authorize and logout views and count their queries.
+# the results are sent as Server-Timing header and logged to the `janus.instrumentation` logger.
+JANUS_INSTRUMENTATION = getattr(settings, 'JANUS_INSTRUMENTATION', False)
+# log a warning if a view needs more queries, eg. {'profile': 6, 'authorize': 10, 'logout': 8}
+JANUS_QUERY_BUDGETS = getattr(settings, 'JANUS_QUERY_BUDGETS', {})
+
+# answer `o/profile/` with an ETag and `304 Not Modified` if the profile did not change since the client's last request.
+# the permission versions are kept in the JANUS_PERMISSION_CACHE cache, use a cache shared by the workers.
+JANUS_PROFILE_ETAG = getattr(settings, 'JANUS_PROFILE_ETAG', False)
+
+# compute the profile of the user once when an access token is issued or refreshed and store it with the token,
+# `o/profile/` and the userinfo claims read it instead of resolving the permissions on every request.
+# permission and user changes delete the snapshots of the affected tokens, they fall back to the live profile.
+JANUS_PROFILE_SNAPSHOT = getattr(settings, 'JANUS_PROFILE_SNAPSHOT', False)
+
+# maximum number of users per request to the batch profile endpoint `o/profiles/`
+JANUS_PROFILE_BATCH_LIMIT = getattr(settings, 'JANUS_PROFILE_BATCH_LIMIT', 1000)
+
+# cache validated bearer tokens in the JANUS_PERMISSION_CACHE cache for this many seconds, 0 disables it.
+# requires janus.oauth2.validator.JanusOAuth2Validator and JANUS_APPLICATION_REGISTRY_TTL, the cache is not used without
+# the registry. an entry never outlives the token's expiry and is deleted
+# with the token (logout, revoke_token, refresh, bulk revocation), use a cache shared by the workers.
+JANUS_TOKEN_CACHE_TTL = getattr(settings, 'JANUS_TOKEN_CACHE_TTL', 0)
+
+# verify signed access tokens (janus.oauth2.tokens.signed_token_generator) in JanusOAuth2Validator by their signature,
+# without a database lookup. revoked tokens stay valid until they expire.
+JANUS_JWT_VALIDATE_LOCALLY = getattr(settings, 'JANUS_JWT_VALIDATE_LOCALLY', False)
+
+# collect prometheus metrics, exported at o/metrics. the counts of all workers are aggregated in the
+# JANUS_PERMISSION_CACHE cache, use a cache shared by the workers.
+JANUS_METRICS = getattr(settings, 'JANUS_METRICS', False)
+# bearer token required to scrape the metrics, without it only staff users can read them
+JANUS_METRICS_TOKEN = getattr(settings, 'JANUS_METRICS_TOKEN', None)
+
+# OIDC back-channel logout, sent to the applications with a back-channel logout uri on `o/logout/`
+# size of the thread pool sending the logout tokens
+JANUS_BACKCHANNEL_LOGOUT_WORKERS = getattr(settings, 'JANUS_BACKCHANNEL_LOGOUT_WORKERS', 4)
+# seconds to wait for a relying party
+JANUS_BACKCHANNEL_LOGOUT_TIMEOUT = getattr(settings, 'JANUS_BACKCHANNEL_LOGOUT_TIMEOUT', 5)
+# retries after connection errors and 5xx responses, waiting JANUS_BACKCHANNEL_LOGOUT_BACKOFF seconds, doubled each time
+JANUS_BACKCHANNEL_LOGOUT_RETRIES = getattr(settings, 'JANUS_BACKCHANNEL_LOGOUT_RETRIES', 3)
+JANUS_BACKCHANNEL_LOGOUT_BACKOFF = getattr(settings, 'JANUS_BACKCHANNEL_LOGOUT_BACKOFF', 1)
+# send the logout tokens with the celery task janus.tasks.backchannel_logout instead of the thread pool
+JANUS_BACKCHANNEL_LOGOUT_CELERY = getattr(settings, 'JANUS_BACKCHANNEL_LOGOUT_CELERY', False)
+
+# confirmation mails requested by the authorize view are sent in the background, at most one per user
+# within this many seconds, 0 disables the deduplication. the window is kept in the JANUS_PERMISSION_CACHE cache.
+JANUS_EMAIL_CONFIRMATION_WINDOW = getattr(settings, 'JANUS_EMAIL_CONFIRMATION_WINDOW', 180)
+# size of the thread pool sending the mails
+JANUS_EMAIL_CONFIRMATION_WORKERS = getattr(settings, 'JANUS_EMAIL_CONFIRMATION_WORKERS', 2)
+# send the mails with the celery task janus.tasks.email_confirmation instead of the thread pool
+JANUS_EMAIL_CONFIRMATION_CELERY = getattr(settings, 'JANUS_EMAIL_CONFIRMATION_CELERY', False)
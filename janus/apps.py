@@ -0,0 +1,12 @@
+from django.apps import AppConfig
+
+
+class JanusConfig(AppConfig):
+    name = 'janus'
+    default_auto_field = 'django.db.models.AutoField'
+
+    def ready(self):
+        # connect the signal handlers
+        from janus import signals  # noqa: F401
+        from janus.oauth2.tokens import check_token_generators
+        check_token_generators()
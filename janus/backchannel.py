@@ -0,0 +1,136 @@
+"""
+OIDC back-channel logout, https://openid.net/specs/openid-connect-backchannel-1_0.html
+
+on a remote logout every application with a back-channel logout uri, in which the user has tokens,
+receives a signed logout token. the tokens are sent in the background after the logout is committed,
+by a bounded thread pool or, with JANUS_BACKCHANNEL_LOGOUT_CELERY, by celery workers.
+"""
+import logging
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+
+from django.db import transaction
+from django.db.models import Q
+from django.urls import NoReverseMatch
+from jwcrypto import jwt
+from oauth2_provider.models import get_application_model, get_access_token_model, get_refresh_token_model
+from oauth2_provider.settings import oauth2_settings
+
+from janus import app_settings
+from janus.background import submit
+from janus.metrics import metrics
+from janus.oauth2.tokens import signing_key
+
+logger = logging.getLogger(__name__)
+
+LOGOUT_EVENT = 'http://schemas.openid.net/event/backchannel-logout'
+# seconds a logout token is valid, covers the retries of a delivery
+LOGOUT_TOKEN_LIFETIME = 120
+
+
+def logout_applications(user):
+    """
+    :return: the applications with a back-channel logout uri in which the user has tokens
+    """
+    token_applications = Q(pk__in=get_access_token_model().objects.filter(user=user).values('application_id')) | \
+        Q(pk__in=get_refresh_token_model().objects.filter(user=user).values('application_id'))
+    return list(get_application_model().objects.filter(token_applications)
+                .exclude(extension__backchannel_logout_uri__isnull=True)
+                .exclude(extension__backchannel_logout_uri='')
+                .select_related('extension'))
+
+
+def logout_token(application, user, issuer):
+    """
+    :return: the signed logout token of the user for the application
+    """
+    now = int(time.time())
+    claims = {
+        'iss': issuer,
+        'aud': application.client_id,
+        'iat': now,
+        'exp': now + LOGOUT_TOKEN_LIFETIME,
+        'jti': uuid.uuid4().hex,
+        'sub': str(user.pk),
+        'events': {LOGOUT_EVENT: {}},
+    }
+    key = signing_key()
+    token = jwt.JWT(header={'alg': 'RS256', 'typ': 'logout+jwt', 'kid': key.thumbprint()}, claims=claims)
+    token.make_signed_token(key)
+    return token.serialize()
+
+
+def send_logout_token(uri, token, timeout=None, retries=None, backoff=None):
+    """
+    post the logout token to the back-channel logout uri, retried with exponential backoff
+    on connection errors and 5xx responses
+    :return: True if the relying party accepted the token
+    """
+    timeout = app_settings.JANUS_BACKCHANNEL_LOGOUT_TIMEOUT if timeout is None else timeout
+    retries = app_settings.JANUS_BACKCHANNEL_LOGOUT_RETRIES if retries is None else retries
+    backoff = app_settings.JANUS_BACKCHANNEL_LOGOUT_BACKOFF if backoff is None else backoff
+    body = urllib.parse.urlencode({'logout_token': token}).encode('ascii')
+
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(backoff * 2 ** (attempt - 1))
+        request = urllib.request.Request(uri, data=body, method='POST',
+                                         headers={'Content-Type': 'application/x-www-form-urlencoded'})
+        try:
+            with urllib.request.urlopen(request, timeout=timeout):
+                metrics.inc('janus_backchannel_logout_total', {'result': 'success'})
+                return True
+        except urllib.error.HTTPError as e:
+            if e.code < 500:
+                # the relying party rejected the token, a retry will not change that
+                logger.warning("back-channel logout to %s rejected with %d", uri, e.code)
+                break
+            logger.info("back-channel logout to %s failed with %d (attempt %d)", uri, e.code, attempt + 1)
+        except (urllib.error.URLError, OSError) as e:
+            logger.info("back-channel logout to %s failed: %s (attempt %d)", uri, e, attempt + 1)
+
+    logger.warning("back-channel logout to %s failed", uri)
+    metrics.inc('janus_backchannel_logout_total', {'result': 'failure'})
+    return False
+
+
+def dispatch(uri, token):
+    """
+    send the logout token in the background
+    """
+    if app_settings.JANUS_BACKCHANNEL_LOGOUT_CELERY:
+        from janus.tasks import backchannel_logout
+        backchannel_logout.delay(uri, token)
+        return None
+    return submit('backchannel-logout', app_settings.JANUS_BACKCHANNEL_LOGOUT_WORKERS, send_logout_token, uri, token)
+
+
+def notify_logout(request, user):
+    """
+    send logout tokens to the applications of the user once the current transaction is committed.
+    call it before the tokens of the user are deleted.
+    :return: list of the notified applications
+    """
+    if not oauth2_settings.OIDC_RSA_PRIVATE_KEY:
+        return []
+    applications = logout_applications(user)
+    if not applications:
+        return []
+
+    try:
+        issuer = oauth2_settings.oidc_issuer(request)
+    except NoReverseMatch:
+        # OIDC is disabled and OIDC_ISS_ENDPOINT not set
+        return []
+    tokens = [(application.extension.backchannel_logout_uri, logout_token(application, user, issuer))
+              for application in applications]
+
+    def send():
+        for uri, token in tokens:
+            dispatch(uri, token)
+
+    transaction.on_commit(send)
+    return applications
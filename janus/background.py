@@ -0,0 +1,33 @@
+"""
+bounded thread pools for work that must not delay the response, used when celery is not enabled
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import connection
+
+_executors = {}
+_lock = threading.Lock()
+
+
+def get_executor(name, max_workers):
+    with _lock:
+        if name not in _executors:
+            _executors[name] = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='janus-' + name)
+        return _executors[name]
+
+
+def _run(func, *args):
+    try:
+        return func(*args)
+    finally:
+        # the pool threads are not request threads, nobody else closes their database connection
+        connection.close()
+
+
+def submit(name, max_workers, func, *args):
+    """
+    run func(*args) in the thread pool of the given name
+    :return: future
+    """
+    return get_executor(name, max_workers).submit(_run, func, *args)
@@ -0,0 +1,263 @@
+"""
+synthetic organization benchmark for the profile, userinfo, authorize and logout endpoints.
+used by `./manage.py janus_benchmark` and the BenchmarkTests in janus.tests.test_basics
+"""
+import base64
+import hashlib
+import math
+import platform
+import random
+import secrets
+import time
+from collections import Counter
+from datetime import timedelta
+
+import django
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.db import connection
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse, NoReverseMatch
+from django.utils import timezone
+from oauth2_provider.models import get_application_model, get_access_token_model
+
+from janus import __version__, app_settings, cache
+from janus.models import Profile, ProfileGroup, ApplicationGroup, GroupPermission, ProfilePermission
+from janus.oauth2.util import refresh_effective_permissions
+
+PREFIX = 'janus-bench'
+REDIRECT_URI = 'https://localhost/janus-bench/callback'
+ENDPOINTS = ('profile', 'userinfo', 'authorize', 'logout')
+BATCH_SIZE = 1000
+
+
+class Organization(object):
+    """
+    ids of the generated objects
+    """
+
+    def __init__(self, config, user_ids, application_ids):
+        self.config = config
+        self.user_ids = user_ids
+        self.application_ids = application_ids
+
+
+def generate_organization(users=1000, groups=100, applications=50, groups_per_user=5,
+                          applications_per_group=5, application_groups=5, personal_permission_ratio=0.05,
+                          seed=0):
+    """
+    create a synthetic organization: users with profiles, profile groups with group permissions
+    and application groups, and personal permissions for a part of the users.
+    the rows are bulk inserted, so no signal handler runs. the effective permission table and the cache
+    are refreshed afterwards if they are enabled.
+    :return: Organization
+    """
+    config = dict(users=users, groups=groups, applications=applications, groups_per_user=groups_per_user,
+                  applications_per_group=applications_per_group, application_groups=application_groups,
+                  personal_permission_ratio=personal_permission_ratio, seed=seed)
+    rng = random.Random(seed)
+    run = secrets.token_hex(4)
+    user_model = get_user_model()
+    application_model = get_application_model()
+
+    # no default groups, they would grant their permissions to the real users as well
+    ProfileGroup.objects.bulk_create(
+        [ProfileGroup(name='%s-%s-group-%d' % (PREFIX, run, i)) for i in range(groups)], batch_size=BATCH_SIZE)
+    group_ids = list(ProfileGroup.objects.filter(name__startswith='%s-%s-' % (PREFIX, run))
+                     .values_list('pk', flat=True))
+
+    # hash once, the secret field does not hash again if the value is already hashed
+    client_secret = make_password(secrets.token_hex(16))
+    application_model.objects.bulk_create([application_model(
+        name='%s-%s-app-%d' % (PREFIX, run, i), client_id='%s-%s-%d' % (PREFIX, run, i),
+        client_secret=client_secret, client_type=application_model.CLIENT_CONFIDENTIAL,
+        authorization_grant_type=application_model.GRANT_AUTHORIZATION_CODE, redirect_uris=REDIRECT_URI,
+        skip_authorization=True) for i in range(applications)], batch_size=BATCH_SIZE)
+    application_ids = list(application_model.objects.filter(name__startswith='%s-%s-' % (PREFIX, run))
+                           .values_list('pk', flat=True))
+
+    ApplicationGroup.objects.bulk_create(
+        [ApplicationGroup(application_id=application_id, name='app-group-%d' % i)
+         for application_id in application_ids for i in range(application_groups)], batch_size=BATCH_SIZE)
+    app_groups = {}
+    for pk, application_id in ApplicationGroup.objects.filter(application_id__in=application_ids) \
+            .values_list('pk', 'application_id'):
+        app_groups.setdefault(application_id, []).append(pk)
+
+    GroupPermission.objects.bulk_create([
+        GroupPermission(profile_group_id=group_id, application_id=application_id,
+                        can_authenticate=rng.random() < 0.7, is_staff=rng.random() < 0.1,
+                        is_superuser=rng.random() < 0.02)
+        for group_id in group_ids
+        for application_id in rng.sample(application_ids, min(applications_per_group, len(application_ids)))
+    ], batch_size=BATCH_SIZE)
+    group_permissions = GroupPermission.objects.filter(profile_group_id__in=group_ids) \
+        .values_list('pk', 'application_id')
+    GroupPermission.groups.through.objects.bulk_create([
+        GroupPermission.groups.through(grouppermission_id=pk, applicationgroup_id=app_group_id)
+        for pk, application_id in group_permissions
+        for app_group_id in rng.sample(app_groups.get(application_id, []),
+                                       min(2, len(app_groups.get(application_id, []))))
+    ], batch_size=BATCH_SIZE)
+
+    username_field = user_model.USERNAME_FIELD
+    user_model.objects.bulk_create(
+        [user_model(**{username_field: '%s-%s-user-%d' % (PREFIX, run, i), 'password': '!'})
+         for i in range(users)], batch_size=BATCH_SIZE)
+    user_ids = list(user_model.objects.filter(**{username_field + '__startswith': '%s-%s-' % (PREFIX, run)})
+                    .values_list('pk', flat=True))
+
+    Profile.objects.bulk_create([Profile(user_id=user_id) for user_id in user_ids], batch_size=BATCH_SIZE)
+    profile_ids = dict(Profile.objects.filter(user_id__in=user_ids).values_list('user_id', 'pk'))
+    Profile.group.through.objects.bulk_create([
+        Profile.group.through(profile_id=profile_ids[user_id], profilegroup_id=group_id)
+        for user_id in user_ids
+        for group_id in rng.sample(group_ids, min(groups_per_user, len(group_ids)))
+    ], batch_size=BATCH_SIZE)
+
+    ProfilePermission.objects.bulk_create([
+        ProfilePermission(profile_id=profile_ids[user_id], application_id=rng.choice(application_ids),
+                          can_authenticate=True, is_staff=rng.random() < 0.5)
+        for user_id in rng.sample(user_ids, int(len(user_ids) * personal_permission_ratio))
+    ], batch_size=BATCH_SIZE, ignore_conflicts=True)
+
+    if app_settings.JANUS_EFFECTIVE_PERMISSIONS:
+        refresh_effective_permissions(user_ids)
+    if cache.uses_versions():
+        cache.invalidate()
+
+    return Organization(config, user_ids, application_ids)
+
+
+def _reverse(*names):
+    for name in names:
+        try:
+            return reverse(name)
+        except NoReverseMatch:
+            pass
+    return None
+
+
+def _percentile(values, percentile):
+    values = sorted(values)
+    index = max(0, int(math.ceil(percentile / 100.0 * len(values))) - 1)
+    return values[index]
+
+
+def _summary(durations, queries, statuses, total):
+    durations_ms = [d * 1000 for d in durations]
+    return {
+        'requests': len(durations),
+        'mean_ms': sum(durations_ms) / len(durations_ms),
+        'p50_ms': _percentile(durations_ms, 50),
+        'p90_ms': _percentile(durations_ms, 90),
+        'p95_ms': _percentile(durations_ms, 95),
+        'p99_ms': _percentile(durations_ms, 99),
+        'max_ms': max(durations_ms),
+        'throughput_rps': len(durations) / total if total else None,
+        'queries_mean': sum(queries) / len(queries),
+        'queries_max': max(queries),
+        'status_codes': {str(k): v for k, v in sorted(statuses.items())},
+    }
+
+
+def _create_token(user_id, application_id, scope='read write openid profile email'):
+    return get_access_token_model().objects.create(
+        user_id=user_id, application_id=application_id, token=secrets.token_urlsafe(24), scope=scope,
+        expires=timezone.now() + timedelta(hours=1)).token
+
+
+def _pkce_challenge():
+    verifier = secrets.token_urlsafe(48)
+    digest = hashlib.sha256(verifier.encode('ascii')).digest()
+    return base64.urlsafe_b64encode(digest).decode('ascii').rstrip('=')
+
+
+def run_benchmark(organization, iterations=200, endpoints=ENDPOINTS, seed=0):
+    """
+    request every endpoint `iterations` times with random users and applications of the organization
+    and measure the latency, the throughput and the number of queries per request
+    :return: dict with the results, ready to be dumped as json
+    """
+    rng = random.Random(seed)
+    application_model = get_application_model()
+    client_ids = dict(application_model.objects.filter(pk__in=organization.application_ids)
+                      .values_list('pk', 'client_id'))
+    user_model = get_user_model()
+
+    def pairs():
+        for _ in range(iterations):
+            yield rng.choice(organization.user_ids), rng.choice(organization.application_ids)
+
+    def profile():
+        url = _reverse('profile')
+        for user_id, application_id in pairs():
+            token = _create_token(user_id, application_id)
+            yield Client(), url, {}, {'HTTP_AUTHORIZATION': 'Bearer ' + token}
+
+    def userinfo():
+        url = _reverse('oauth2_provider:user-info', 'user-info')
+        if url is None:
+            return
+        for user_id, application_id in pairs():
+            token = _create_token(user_id, application_id)
+            yield Client(), url, {}, {'HTTP_AUTHORIZATION': 'Bearer ' + token}
+
+    def authorize():
+        url = _reverse('oauth2_provider:authorize', 'authorize')
+        for user_id, application_id in pairs():
+            client = Client()
+            client.force_login(user_model.objects.get(pk=user_id))
+            params = {'client_id': client_ids[application_id], 'response_type': 'code',
+                      'redirect_uri': REDIRECT_URI, 'code_challenge': _pkce_challenge(),
+                      'code_challenge_method': 'S256'}
+            yield client, url, params, {}
+
+    def logout():
+        url = _reverse('remote_logout')
+        for user_id, application_id in pairs():
+            token = _create_token(user_id, application_id)
+            yield Client(), url, {'access_token': token}, {}
+
+    requests = {'profile': profile, 'userinfo': userinfo, 'authorize': authorize, 'logout': logout}
+
+    results = {}
+    # the test client sends the requests to `testserver`, which must pass the host validation outside of the tests
+    with override_settings(ALLOWED_HOSTS=list(settings.ALLOWED_HOSTS) + ['testserver']):
+        for name in endpoints:
+            durations, queries, statuses = [], [], Counter()
+            for client, url, params, headers in requests[name]():
+                with CaptureQueriesContext(connection) as captured:
+                    start = time.perf_counter()
+                    response = client.get(url, params, **headers)
+                    duration = time.perf_counter() - start
+                statuses[response.status_code] += 1
+                # error responses are no latency measurements of the endpoint
+                if response.status_code < 400:
+                    durations.append(duration)
+                    queries.append(len(captured))
+            if durations:
+                results[name] = _summary(durations, queries, statuses, sum(durations))
+                results[name]['errors'] = sum(count for status, count in statuses.items() if status >= 400)
+            elif statuses:
+                results[name] = {'failed': 'all requests failed',
+                                 'status_codes': {str(k): v for k, v in sorted(statuses.items())}}
+            else:
+                results[name] = {'skipped': 'endpoint not available'}
+
+    return {
+        'janus_version': '.'.join(str(x) for x in __version__),
+        'django_version': django.get_version(),
+        'python_version': platform.python_version(),
+        'database': connection.vendor,
+        'settings': {
+            'JANUS_EFFECTIVE_PERMISSIONS': app_settings.JANUS_EFFECTIVE_PERMISSIONS,
+            'JANUS_PERMISSION_CACHE_TTL': app_settings.JANUS_PERMISSION_CACHE_TTL,
+            'JANUS_APPLICATION_REGISTRY_TTL': app_settings.JANUS_APPLICATION_REGISTRY_TTL,
+        },
+        'organization': organization.config,
+        'iterations': iterations,
+        'endpoints': results,
+    }
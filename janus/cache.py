@@ -0,0 +1,255 @@
+import hashlib
+import threading
+import time
+
+from django.core.cache import caches
+
+from janus import app_settings
+
+KEY_PREFIX = 'janus:permissions'
+TOKEN_KEY_PREFIX = 'janus:token'
+
+# how long a worker waits for another worker computing the same entry before computing it itself
+LOCK_TIMEOUT = 10
+LOCK_WAIT = 1.0
+LOCK_POLL_INTERVAL = 0.05
+
+# the local hit/miss counts are pushed to the shared cache after this many events or seconds
+STATS_FLUSH_EVENTS = 100
+STATS_FLUSH_SECONDS = 10
+STATS_KEYS = ('hits', 'misses', 'lock_waits')
+
+
+def get_cache():
+    return caches[app_settings.JANUS_PERMISSION_CACHE]
+
+
+def is_enabled():
+    return bool(app_settings.JANUS_PERMISSION_CACHE_TTL)
+
+
+def uses_versions():
+    # the version counters must be maintained if any cached value depends on them
+    return is_enabled() or bool(app_settings.JANUS_AUTHORIZE_DENY_CACHE_TTL) or app_settings.JANUS_PROFILE_ETAG
+
+
+def _version_key(scope, pk=None):
+    if pk is None:
+        return '%s:version:%s' % (KEY_PREFIX, scope)
+    return '%s:version:%s:%s' % (KEY_PREFIX, scope, pk)
+
+
+def _new_version():
+    # a version key evicted from the cache must never fall back to a version that was used before
+    return int(time.time() * 1000)
+
+
+def _get_versions(cache, keys):
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            cache.add(key, _new_version(), timeout=None)
+            versions[key] = cache.get(key)
+    return [versions[key] for key in keys]
+
+
+def _bump(cache, keys):
+    for key in keys:
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, _new_version(), timeout=None)
+
+
+def invalidate(user_ids=None, application_ids=None):
+    """
+    invalidate the cached permissions of the given users and applications
+    :param user_ids: affected user ids, None for all users
+    :param application_ids: affected application ids, None for all applications
+    """
+    cache = get_cache()
+    if user_ids is None and application_ids is None:
+        _bump(cache, [_version_key('global')])
+    elif user_ids is None:
+        _bump(cache, [_version_key('application', pk) for pk in application_ids])
+    elif application_ids is None:
+        _bump(cache, [_version_key('user', pk) for pk in user_ids])
+    else:
+        # both scopes are correct, the smaller one is cheaper
+        if len(user_ids) <= len(application_ids):
+            _bump(cache, [_version_key('user', pk) for pk in user_ids])
+        else:
+            _bump(cache, [_version_key('application', pk) for pk in application_ids])
+
+
+def _permission_version(cache, user, application):
+    versions = _get_versions(cache, [_version_key('global'), _version_key('user', user.pk),
+                                     _version_key('application', application.pk)])
+    return ':'.join(str(v) for v in versions)
+
+
+def get_permission_version(user, application):
+    """
+    :return: string which changes whenever the permissions or groups of the user for the application change
+    """
+    return _permission_version(get_cache(), user, application)
+
+
+def _versioned_key(cache, kind, user, application):
+    return '%s:%s:%s:%s:%s' % (KEY_PREFIX, kind, user.pk, application.pk,
+                               _permission_version(cache, user, application))
+
+
+def is_denied(user, application):
+    """
+    check if an authorize request of the user for the application was denied recently
+    """
+    cache = get_cache()
+    return cache.get(_versioned_key(cache, 'denied', user, application)) is not None
+
+
+def remember_denial(user, application):
+    cache = get_cache()
+    cache.set(_versioned_key(cache, 'denied', user, application), 1,
+              timeout=app_settings.JANUS_AUTHORIZE_DENY_CACHE_TTL)
+
+
+def _unknown_client_key(client_id):
+    # the client id comes from the request, hash it to get a valid key of any length
+    return '%s:unknown_client:%s' % (KEY_PREFIX, hashlib.sha256(str(client_id).encode('utf-8')).hexdigest())
+
+
+def is_unknown_client(client_id):
+    """
+    check if an authorize request with the client id was refused recently because there is no such application
+    """
+    return get_cache().get(_unknown_client_key(client_id)) is not None
+
+
+def remember_unknown_client(client_id):
+    get_cache().set(_unknown_client_key(client_id), 1, timeout=app_settings.JANUS_AUTHORIZE_DENY_CACHE_TTL)
+
+
+def forget_unknown_client(client_id):
+    get_cache().delete(_unknown_client_key(client_id))
+
+
+def get_or_compute(user, application, compute):
+    """
+    return the cached value for the user and application, compute it with `compute(user, application)` on a miss.
+    only one worker computes a missing entry, the others wait up to LOCK_WAIT seconds for its result.
+    """
+    cache = get_cache()
+    key = _versioned_key(cache, 'resolved', user, application)
+
+    value = cache.get(key)
+    if value is not None:
+        stats.count('hits')
+        return value
+
+    lock_key = key + ':lock'
+    if not cache.add(lock_key, 1, timeout=LOCK_TIMEOUT):
+        stats.count('lock_waits')
+        deadline = time.monotonic() + LOCK_WAIT
+        while time.monotonic() < deadline:
+            time.sleep(LOCK_POLL_INTERVAL)
+            value = cache.get(key)
+            if value is not None:
+                stats.count('hits')
+                return value
+        lock_key = None
+
+    stats.count('misses')
+    try:
+        value = compute(user, application)
+        cache.set(key, value, timeout=app_settings.JANUS_PERMISSION_CACHE_TTL)
+    finally:
+        if lock_key:
+            cache.delete(lock_key)
+    return value
+
+
+###################################################
+# validated access tokens, the cache keys are derived from the value stored in AccessToken.token,
+# so deleted tokens can be dropped without knowing the token sent by the client
+
+def token_cache_enabled():
+    return bool(app_settings.JANUS_TOKEN_CACHE_TTL)
+
+
+def _token_key(stored):
+    return '%s:%s' % (TOKEN_KEY_PREFIX, hashlib.sha256(stored.encode('utf-8')).hexdigest())
+
+
+def get_token(stored):
+    """
+    :param stored: the AccessToken.token value
+    :return: (pk, user_id, client_id, scope, expires timestamp) of a cached valid token, None if not cached
+    """
+    entry = get_cache().get(_token_key(stored))
+    if entry is None or entry[4] <= time.time():
+        return None
+    return entry
+
+
+def remember_token(access_token):
+    """
+    cache a validated access token for JANUS_TOKEN_CACHE_TTL seconds, never beyond its expiry
+    """
+    expires = access_token.expires.timestamp()
+    timeout = min(app_settings.JANUS_TOKEN_CACHE_TTL, int(expires - time.time()))
+    if timeout <= 0:
+        return
+    entry = (access_token.pk, access_token.user_id, access_token.application.client_id, access_token.scope, expires)
+    get_cache().set(_token_key(access_token.token), entry, timeout=timeout)
+
+
+def forget_token(stored):
+    get_cache().delete(_token_key(stored))
+
+
+class CacheStats(object):
+    """
+    hit/miss counters of the permission cache, aggregated over all workers sharing the cache backend.
+    the counts are collected in process and pushed to the cache in batches.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = dict.fromkeys(STATS_KEYS, 0)
+        self._last_flush = time.monotonic()
+
+    def count(self, name):
+        with self._lock:
+            self._local[name] += 1
+            pending = sum(self._local.values())
+        if pending >= STATS_FLUSH_EVENTS or time.monotonic() - self._last_flush >= STATS_FLUSH_SECONDS:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            local, self._local = self._local, dict.fromkeys(STATS_KEYS, 0)
+            self._last_flush = time.monotonic()
+        cache = get_cache()
+        for name, value in local.items():
+            if not value:
+                continue
+            key = '%s:stats:%s' % (KEY_PREFIX, name)
+            if not cache.add(key, value, timeout=None):
+                try:
+                    cache.incr(key, value)
+                except ValueError:
+                    cache.set(key, value, timeout=None)
+
+    def get(self):
+        """
+        :return: dict with the shared hits, misses and lock_waits counters
+        """
+        self.flush()
+        cache = get_cache()
+        keys = {name: '%s:stats:%s' % (KEY_PREFIX, name) for name in STATS_KEYS}
+        values = cache.get_many(keys.values())
+        return {name: values.get(key, 0) for name, key in keys.items()}
+
+
+stats = CacheStats()
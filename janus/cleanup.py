@@ -0,0 +1,123 @@
+import time
+from datetime import timedelta
+
+from django.apps import apps
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models import Q, Exists, OuterRef
+from django.utils import timezone
+from oauth2_provider.models import get_access_token_model, get_refresh_token_model, get_grant_model, \
+    get_id_token_model
+from oauth2_provider.settings import oauth2_settings
+
+from janus import app_settings
+from janus.metrics import metrics, is_enabled as metrics_enabled
+from janus.models import UserSession
+
+
+def _refresh_expire_at(now):
+    expire_seconds = oauth2_settings.REFRESH_TOKEN_EXPIRE_SECONDS
+    if not expire_seconds:
+        return None
+    if not isinstance(expire_seconds, timedelta):
+        try:
+            expire_seconds = timedelta(seconds=expire_seconds)
+        except TypeError:
+            raise ImproperlyConfigured("REFRESH_TOKEN_EXPIRE_SECONDS must be either a timedelta or seconds")
+    return now - expire_seconds
+
+
+def expired_querysets(now=None):
+    """
+    the rows to purge in the order they are deleted, same rules as oauth2_provider.models.clear_expired
+    plus expired id tokens, sessions and stale entries of the user session index
+    :return: list of (name, queryset)
+    """
+    now = now or timezone.now()
+    refresh_token_model = get_refresh_token_model()
+    querysets = []
+
+    refresh_expire_at = _refresh_expire_at(now)
+    if refresh_expire_at:
+        querysets.append(('refresh tokens', refresh_token_model.objects.filter(
+            Q(revoked__lt=refresh_expire_at) | Q(access_token__expires__lt=refresh_expire_at))))
+
+    querysets += [
+        ('access tokens', get_access_token_model().objects.filter(refresh_token__isnull=True, expires__lt=now)),
+        ('grants', get_grant_model().objects.filter(expires__lt=now)),
+        # deleting an id token deletes its access token, only touch the orphaned ones
+        ('id tokens', get_id_token_model().objects.filter(expires__lt=now, access_token__isnull=True)),
+    ]
+
+    if apps.is_installed('django.contrib.sessions'):
+        from django.contrib.sessions.models import Session
+        querysets += [
+            ('sessions', Session.objects.filter(expire_date__lt=now)),
+            ('user sessions', UserSession.objects.filter(
+                ~Exists(Session.objects.filter(session_key=OuterRef('session_key'))))),
+        ]
+    return querysets
+
+
+def delete_in_batches(queryset, batch_size, batch_interval=0, deadline=None, name=None, log=None):
+    """
+    delete the rows of a queryset in primary key ordered batches
+    :param queryset: rows to delete
+    :param batch_size: rows per DELETE
+    :param batch_interval: seconds to sleep between two batches
+    :param deadline: time.monotonic() value to stop at, None for no limit
+    :param name: name of the rows in the progress messages
+    :param log: optional callable receiving progress messages
+    :return: number of deleted rows of the queryset's table, cascaded rows are not counted
+    """
+    name = name or queryset.model._meta.verbose_name_plural
+    deleted = 0
+    last_pk = None
+    while deadline is None or time.monotonic() < deadline:
+        batch = queryset.order_by('pk')
+        if last_pk is not None:
+            batch = batch.filter(pk__gt=last_pk)
+        pks = list(batch.values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            break
+        last_pk = pks[-1]
+
+        deleted += queryset.model.objects.filter(pk__in=pks).delete()[1].get(queryset.model._meta.label, 0)
+        if log:
+            log("%s: %d deleted" % (name, deleted))
+
+        if len(pks) < batch_size:
+            break
+        if batch_interval:
+            time.sleep(batch_interval)
+    return deleted
+
+
+def purge_expired(batch_size=None, batch_interval=None, time_budget=None, log=None):
+    """
+    delete expired tokens, grants and sessions in small primary key ordered batches,
+    so no single statement holds locks on large parts of the tables.
+    :param batch_size: rows per DELETE, default JANUS_CLEANUP_BATCH_SIZE
+    :param batch_interval: seconds to sleep between two batches, default JANUS_CLEANUP_BATCH_INTERVAL
+    :param time_budget: stop after this many seconds, 0 for no limit, default JANUS_CLEANUP_TIME_BUDGET.
+                        the next run continues where this one stopped.
+    :param log: optional callable receiving progress messages
+    :return: dict name -> number of deleted rows
+    """
+    batch_size = batch_size or app_settings.JANUS_CLEANUP_BATCH_SIZE
+    batch_interval = app_settings.JANUS_CLEANUP_BATCH_INTERVAL if batch_interval is None else batch_interval
+    time_budget = app_settings.JANUS_CLEANUP_TIME_BUDGET if time_budget is None else time_budget
+    start = time.monotonic()
+    deadline = start + time_budget if time_budget else None
+
+    deleted = {}
+    for name, queryset in expired_querysets():
+        deleted[name] = delete_in_batches(queryset, batch_size, batch_interval, deadline, name=name, log=log)
+
+    metrics.inc('janus_cleanup_runs_total')
+    for name, count in deleted.items():
+        metrics.inc('janus_cleanup_deleted_total', {'table': name}, count)
+    metrics.observe('janus_cleanup_duration_seconds', time.monotonic() - start)
+    if metrics_enabled():
+        # the worker running the cleanup may not count anything else for a long time
+        metrics.flush()
+    return deleted
@@ -0,0 +1,60 @@
+"""
+email confirmations requested by the authorize view for applications requiring a verified email address.
+the mails are sent in the background, at most one per user within JANUS_EMAIL_CONFIRMATION_WINDOW seconds,
+so clients retrying the authorize request do not send a mail each time.
+"""
+from allauth.account.adapter import get_adapter
+from allauth.account.models import EmailAddress
+from django.contrib import messages
+from django.contrib.auth import get_user_model
+from django.db import transaction
+
+from janus import app_settings, cache
+from janus.background import submit
+
+
+def _window_key(user):
+    return 'janus:email_confirmation:%s' % user.pk
+
+
+def send_email_confirmation(user_id):
+    """
+    send the confirmation mail for the email address of the user, without a request.
+    the confirmation link is built from the current site and ACCOUNT_DEFAULT_HTTP_PROTOCOL.
+    :return: True if a mail was sent
+    """
+    user = get_user_model().objects.filter(pk=user_id).first()
+    if user is None or not user.email:
+        return False
+    email_address = EmailAddress.objects.filter(user=user, email__iexact=user.email).first()
+    if email_address is None:
+        EmailAddress.objects.add_email(None, user, user.email, confirm=True)
+        return True
+    if email_address.verified:
+        return False
+    email_address.send_confirmation(None)
+    return True
+
+
+def queue_email_confirmation(request, user):
+    """
+    send the confirmation mail in the background once the current transaction is committed,
+    unless one was queued for the user within the window
+    :return: True if a mail was queued
+    """
+    window = app_settings.JANUS_EMAIL_CONFIRMATION_WINDOW
+    if window and not cache.get_cache().add(_window_key(user), 1, timeout=window):
+        return False
+
+    def dispatch():
+        if app_settings.JANUS_EMAIL_CONFIRMATION_CELERY:
+            from janus.tasks import email_confirmation
+            email_confirmation.delay(user.pk)
+        else:
+            submit('email-confirmation', app_settings.JANUS_EMAIL_CONFIRMATION_WORKERS, send_email_confirmation,
+                   user.pk)
+
+    transaction.on_commit(dispatch)
+    get_adapter(request).add_message(request, messages.INFO, "account/messages/email_confirmation_sent.txt",
+                                     {"email": user.email})
+    return True
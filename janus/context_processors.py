@@ -2,13 +2,8 @@
 
 def applications(request):
 
-    from janus.models import ApplicationExtension
-    objects = ApplicationExtension.objects.filter(display_name__isnull=False)
+    from janus.registry import registry
 
-    ret = []
-
-    for o in objects:
-        ret.append({'name': o.display_name, 'url': o.link})
     return {
-        'APPLICATIONS': ret,
+        'APPLICATIONS': registry.get_launcher_applications(),
     }
\ No newline at end of file
@@ -0,0 +1,141 @@
+import functools
+import logging
+import threading
+import time
+from contextlib import contextmanager, ExitStack
+
+from django.db import connections
+
+from janus import app_settings
+
+logger = logging.getLogger('janus.instrumentation')
+
+_local = threading.local()
+
+
+def is_enabled():
+    return bool(app_settings.JANUS_INSTRUMENTATION)
+
+
+def current():
+    return getattr(_local, 'recording', None)
+
+
+class Recording(object):
+    """
+    timings and query counts of the stages of one request.
+    the queries are counted with a database execute wrapper, so DEBUG is not required.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.queries = 0
+        self.duration = 0
+        self.stages = []
+        self._start = None
+        self._wrappers = None
+
+    def __call__(self, execute, sql, params, many, context):
+        self.queries += 1
+        return execute(sql, params, many, context)
+
+    def __enter__(self):
+        self._wrappers = ExitStack()
+        for connection in connections.all():
+            self._wrappers.enter_context(connection.execute_wrapper(self))
+        _local.recording = self
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.duration = time.perf_counter() - self._start
+        _local.recording = None
+        self._wrappers.close()
+
+    def add_stage(self, name, duration, queries):
+        self.stages.append((name, duration, queries))
+
+    def server_timing(self):
+        """
+        :return: value of the Server-Timing header
+        """
+        entries = [(self.name, self.duration, self.queries)] + self.stages
+        return ', '.join('%s;dur=%.2f;desc="%d queries"' % (name, duration * 1000, queries)
+                         for name, duration, queries in entries)
+
+    def as_dict(self):
+        return {
+            'view': self.name,
+            'duration_ms': round(self.duration * 1000, 2),
+            'queries': self.queries,
+            'stages': [{'name': name, 'duration_ms': round(duration * 1000, 2), 'queries': queries}
+                       for name, duration, queries in self.stages],
+        }
+
+    def report(self, response=None):
+        """
+        log the recording, warn if the query budget of the view is exceeded and add the Server-Timing header
+        """
+        record = self.as_dict()
+        logger.info("%s took %.2fms with %d queries", self.name, record['duration_ms'], self.queries,
+                    extra={'janus_timing': record})
+
+        budget = app_settings.JANUS_QUERY_BUDGETS.get(self.name)
+        if budget is not None and self.queries > budget:
+            logger.warning("%s exceeded its query budget: %d queries, budget %d", self.name, self.queries, budget,
+                           extra={'janus_timing': record})
+
+        if response is not None:
+            existing = response.get('Server-Timing')
+            response['Server-Timing'] = existing + ', ' + self.server_timing() if existing else self.server_timing()
+
+
+@contextmanager
+def stage(name):
+    """
+    time a stage of the current request. outside of an instrumented view, e.g. the claims of the token and
+    userinfo endpoints of oauth2_provider, the stage is logged on its own.
+    """
+    recording = current()
+    if recording is None:
+        if not is_enabled():
+            yield
+            return
+        recording = Recording(name)
+        with recording:
+            yield
+        recording.report()
+        return
+
+    start = time.perf_counter()
+    queries = recording.queries
+    try:
+        yield
+    finally:
+        recording.add_stage(name, time.perf_counter() - start, recording.queries - queries)
+
+
+def instrument(name):
+    """
+    decorator for view methods taking the request: record the stages of the request, log them and
+    add them to the response as Server-Timing header
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, request, *args, **kwargs):
+            if not is_enabled():
+                return func(self, request, *args, **kwargs)
+            if current() is not None:
+                with stage(name):
+                    return func(self, request, *args, **kwargs)
+
+            recording = Recording(name)
+            with recording:
+                response = func(self, request, *args, **kwargs)
+            recording.report(response)
+            return response
+
+        return wrapper
+
+    return decorator
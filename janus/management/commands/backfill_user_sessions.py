@@ -0,0 +1,44 @@
+from django.contrib.auth import SESSION_KEY, get_user_model
+from django.contrib.sessions.models import Session
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from janus.models import UserSession
+
+
+class Command(BaseCommand):
+    help = "Add the sessions that are not indexed yet to the user session index used by the remote logout."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help="number of sessions decoded per batch")
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        sessions = Session.objects.filter(expire_date__gt=timezone.now()).order_by('pk')
+
+        indexed = 0
+        batch = []
+        for session in sessions.iterator(chunk_size=batch_size):
+            user_id = session.get_decoded().get(SESSION_KEY)
+            if user_id is not None:
+                batch.append((session.session_key, user_id))
+            if len(batch) >= batch_size:
+                indexed += self.index(batch)
+                batch = []
+        indexed += self.index(batch)
+
+        self.stdout.write("indexed %d sessions" % indexed)
+
+    @staticmethod
+    def index(batch):
+        if not batch:
+            return 0
+        user_model = get_user_model()
+        user_ids = {user_model._meta.pk.to_python(user_id) for _, user_id in batch}
+        existing = set(user_model.objects.filter(pk__in=user_ids).values_list('pk', flat=True))
+
+        rows = [UserSession(session_key=session_key, user_id=user_model._meta.pk.to_python(user_id))
+                for session_key, user_id in batch
+                if user_model._meta.pk.to_python(user_id) in existing]
+        UserSession.objects.bulk_create(rows, ignore_conflicts=True)
+        return len(rows)
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from janus.cleanup import purge_expired
+
+
+class Command(BaseCommand):
+    help = "Delete expired tokens, grants and sessions in small batches."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=None, help="rows per DELETE statement")
+        parser.add_argument('--batch-interval', type=float, default=None, help="seconds to sleep between batches")
+        parser.add_argument('--time-budget', type=float, default=None, help="stop after this many seconds")
+
+    def handle(self, *args, **options):
+        log = self.stdout.write if options['verbosity'] > 1 else None
+        deleted = purge_expired(batch_size=options['batch_size'], batch_interval=options['batch_interval'],
+                                time_budget=options['time_budget'], log=log)
+        for name, count in deleted.items():
+            self.stdout.write("%s: %d deleted" % (name, count))
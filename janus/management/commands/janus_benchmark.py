@@ -0,0 +1,66 @@
+import json
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from janus.benchmark import ENDPOINTS, generate_organization, run_benchmark
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = "Generate a synthetic organization and benchmark the profile, userinfo, authorize and logout endpoints. " \
+           "The generated data is rolled back afterwards unless --keep is given."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--groups', type=int, default=100, help="number of profile groups")
+        parser.add_argument('--applications', type=int, default=50)
+        parser.add_argument('--groups-per-user', type=int, default=5)
+        parser.add_argument('--applications-per-group', type=int, default=5,
+                            help="group permissions per profile group")
+        parser.add_argument('--application-groups', type=int, default=5, help="application groups per application")
+        parser.add_argument('--personal-permission-ratio', type=float, default=0.05,
+                            help="share of the users with a personal permission")
+        parser.add_argument('--iterations', type=int, default=200, help="requests per endpoint")
+        parser.add_argument('--endpoint', action='append', choices=ENDPOINTS, dest='endpoints',
+                            help="benchmark only this endpoint, can be repeated")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help="write the results as json to this file")
+        parser.add_argument('--keep', action='store_true', help="keep the generated organization")
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                organization = generate_organization(
+                    users=options['users'], groups=options['groups'], applications=options['applications'],
+                    groups_per_user=options['groups_per_user'],
+                    applications_per_group=options['applications_per_group'],
+                    application_groups=options['application_groups'],
+                    personal_permission_ratio=options['personal_permission_ratio'], seed=options['seed'])
+                results = run_benchmark(organization, iterations=options['iterations'],
+                                        endpoints=options['endpoints'] or ENDPOINTS, seed=options['seed'])
+                if not options['keep']:
+                    raise Rollback()
+        except Rollback:
+            pass
+
+        for name, result in results['endpoints'].items():
+            if 'skipped' in result:
+                self.stdout.write("%-10s skipped: %s" % (name, result['skipped']))
+                continue
+            if 'failed' in result:
+                self.stderr.write("%-10s failed, status codes: %s" % (name, result['status_codes']))
+                continue
+            self.stdout.write("%-10s p50 %7.2fms  p90 %7.2fms  p99 %7.2fms  %7.1f req/s  %5.1f queries (max %d)" % (
+                name, result['p50_ms'], result['p90_ms'], result['p99_ms'], result['throughput_rps'],
+                result['queries_mean'], result['queries_max']))
+            if result['errors']:
+                self.stderr.write("%-10s %d failed requests are not included, status codes: %s" % (
+                    name, result['errors'], result['status_codes']))
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
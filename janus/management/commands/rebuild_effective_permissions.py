@@ -0,0 +1,50 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from oauth2_provider.models import get_application_model
+
+from janus.oauth2.util import refresh_effective_permissions, compute_permissions, compute_group_list, \
+    get_effective_permissions
+
+
+class Command(BaseCommand):
+    help = "Rebuild the materialized EffectivePermission table and compare it against the live resolver."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500, help="number of users resolved per batch")
+        parser.add_argument('--check', action='store_true',
+                            help="compare the stored rows with the live resolver after the rebuild")
+        parser.add_argument('--check-only', action='store_true', help="only compare, do not rebuild")
+        parser.add_argument('--sample', type=int, default=0,
+                            help="number of random users to compare, 0 compares all users")
+
+    def handle(self, *args, **options):
+        if not options['check_only']:
+            stored = refresh_effective_permissions(chunk_size=options['chunk_size'])
+            self.stdout.write("stored %d effective permission rows" % stored)
+
+        if options['check'] or options['check_only']:
+            self.check_table(options['sample'])
+
+    def check_table(self, sample):
+        users = get_user_model().objects.order_by('pk')
+        if sample:
+            users = users.order_by('?')[:sample]
+        applications = list(get_application_model().objects.all())
+
+        mismatches = 0
+        checked = 0
+        for user in users.iterator():
+            for application in applications:
+                checked += 1
+                permissions, groups = get_effective_permissions(user, application)
+                live_permissions = compute_permissions(user, application)
+                live_groups = compute_group_list(user, application)
+                if permissions != live_permissions or sorted(groups) != sorted(live_groups):
+                    mismatches += 1
+                    self.stderr.write("mismatch for user %s and application %s: stored %s %s, live %s %s" % (
+                        user.pk, application.pk, permissions, sorted(groups), live_permissions,
+                        sorted(live_groups)))
+
+        if mismatches:
+            raise CommandError("%d of %d checked pairs differ from the live resolver" % (mismatches, checked))
+        self.stdout.write("checked %d pairs, no differences" % checked)
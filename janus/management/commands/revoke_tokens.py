@@ -0,0 +1,68 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+from oauth2_provider.models import get_application_model
+
+from janus.models import ProfileGroup
+from janus.revocation import revoke_tokens
+from janus.signals import group_member_ids
+
+
+def _lookup(queryset, values, *fields):
+    """
+    :return: primary keys of the rows matching one of the values in one of the fields or the primary key
+    """
+    pks = set()
+    for value in values:
+        query = Q()
+        for field in fields:
+            query |= Q(**{field: value})
+        if value.isdigit():
+            query |= Q(pk=int(value))
+        found = list(queryset.filter(query).values_list('pk', flat=True))
+        if not found:
+            raise CommandError("%s not found: %s" % (queryset.model._meta.verbose_name, value))
+        pks.update(found)
+    return pks
+
+
+class Command(BaseCommand):
+    help = "Revoke the tokens of users, profile group members or applications in small batches " \
+           "and delete the sessions of the users."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', action='append', default=[], help="username or id, repeatable")
+        parser.add_argument('--group', action='append', default=[], help="profile group name or id, repeatable")
+        parser.add_argument('--application', action='append', default=[],
+                            help="client id, name or id, repeatable. limits the revocation to these applications")
+        parser.add_argument('--keep-sessions', action='store_true', help="do not delete the sessions of the users")
+        parser.add_argument('--batch-size', type=int, default=None, help="rows per DELETE statement")
+        parser.add_argument('--batch-interval', type=float, default=None, help="seconds to sleep between batches")
+
+    def handle(self, *args, **options):
+        if not options['user'] and not options['group'] and not options['application']:
+            raise CommandError("select users, groups or applications")
+
+        user_ids = None
+        if options['user'] or options['group']:
+            user_ids = _lookup(get_user_model().objects.all(), options['user'], 'username')
+            group_ids = _lookup(ProfileGroup.objects.all(), options['group'], 'name')
+            if group_ids:
+                members = group_member_ids(group_ids)
+                # a default group has all users as members
+                user_ids = None if members is None else user_ids | set(members)
+
+        application_ids = None
+        if options['application']:
+            application_ids = _lookup(get_application_model().objects.all(), options['application'],
+                                      'client_id', 'name')
+
+        log = self.stdout.write if options['verbosity'] > 1 else None
+        try:
+            deleted = revoke_tokens(user_ids, application_ids, sessions=not options['keep_sessions'],
+                                    batch_size=options['batch_size'], batch_interval=options['batch_interval'],
+                                    log=log)
+        except ValueError as e:
+            raise CommandError(str(e))
+        for name, count in deleted.items():
+            self.stdout.write("%s: %d deleted" % (name, count))
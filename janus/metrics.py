@@ -0,0 +1,172 @@
+import hashlib
+import threading
+import time
+from collections import defaultdict
+
+from janus import app_settings, cache
+
+KEY_PREFIX = 'janus:metrics'
+INDEX_KEY = KEY_PREFIX + ':index'
+
+# the local counts are pushed to the shared cache after this many events or seconds
+FLUSH_EVENTS = 100
+FLUSH_SECONDS = 10
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# name -> (type, help)
+METRICS = {
+    'janus_token_validations_total': ('counter', "Bearer token validations by result."),
+    'janus_token_validation_seconds': ('histogram', "Duration of the bearer token validation."),
+    'janus_profile_requests_total': ('counter', "Profile requests by application."),
+    'janus_profile_request_seconds': ('histogram', "Duration of the profile requests."),
+    'janus_authorize_decisions_total': ('counter', "Authorize permission decisions by decision."),
+    'janus_logout_sessions_deleted_total': ('counter', "Sessions deleted by the remote logout."),
+    'janus_logout_tokens_deleted_total': ('counter', "Tokens deleted by the remote logout by type."),
+    'janus_cleanup_runs_total': ('counter', "Runs of the expired token cleanup."),
+    'janus_cleanup_deleted_total': ('counter', "Rows deleted by the expired token cleanup by table."),
+    'janus_cleanup_duration_seconds': ('histogram', "Duration of the expired token cleanup."),
+    'janus_backchannel_logout_total': ('counter', "Back-channel logout tokens sent by result."),
+    'janus_revoked_total': ('counter', "Rows deleted by the bulk token revocation by table."),
+}
+
+
+def is_enabled():
+    return bool(app_settings.JANUS_METRICS)
+
+
+def _series(name, labels):
+    return name, tuple(sorted((labels or {}).items()))
+
+
+def _cache_key(series):
+    return '%s:%s' % (KEY_PREFIX, hashlib.md5(repr(series).encode('utf-8')).hexdigest())
+
+
+class Metrics(object):
+    """
+    counters and histograms aggregated over all workers sharing the cache backend.
+    the values are collected in process and pushed to the cache in batches, the database is never written.
+    histogram sums are stored in microseconds, as the cache can only increment integers.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = defaultdict(int)
+        self._events = 0
+        self._known = set()
+        self._last_flush = time.monotonic()
+
+    def inc(self, name, labels=None, value=1):
+        if not is_enabled() or not value:
+            return
+        with self._lock:
+            self._pending[_series(name, labels)] += value
+            self._events += 1
+        self._maybe_flush()
+
+    def observe(self, name, seconds, labels=None):
+        if not is_enabled():
+            return
+        labels = labels or {}
+        with self._lock:
+            # empty buckets are exported as well, the bucket set of a histogram must not change
+            for bucket in BUCKETS:
+                self._pending[_series(name + '_bucket', dict(labels, le=str(bucket)))] += int(seconds <= bucket)
+            self._pending[_series(name + '_bucket', dict(labels, le='+Inf'))] += 1
+            self._pending[_series(name + '_count', labels)] += 1
+            self._pending[_series(name + '_sum', labels)] += int(seconds * 1000000)
+            self._events += 1
+        self._maybe_flush()
+
+    def _maybe_flush(self):
+        if self._events >= FLUSH_EVENTS or time.monotonic() - self._last_flush >= FLUSH_SECONDS:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, defaultdict(int)
+            self._events = 0
+            self._last_flush = time.monotonic()
+            new = set(pending) - self._known
+            self._known.update(new)
+        shared = cache.get_cache()
+
+        for series, value in pending.items():
+            key = _cache_key(series)
+            if not shared.add(key, value, timeout=None):
+                try:
+                    shared.incr(key, value)
+                except ValueError:
+                    shared.set(key, value, timeout=None)
+
+        # concurrent updates of the index can get lost, every process adds its series again on the next flush
+        index = shared.get(INDEX_KEY) or set()
+        if new or not self._known <= index:
+            shared.set(INDEX_KEY, index | self._known, timeout=None)
+
+    def collect(self):
+        """
+        :return: dict series -> value of all workers
+        """
+        self.flush()
+        shared = cache.get_cache()
+        index = sorted(shared.get(INDEX_KEY) or set())
+        values = shared.get_many([_cache_key(series) for series in index])
+        return {series: values.get(_cache_key(series), 0) for series in index}
+
+
+metrics = Metrics()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format(name, labels, value):
+    if labels:
+        name += '{%s}' % ','.join('%s="%s"' % (key, _escape(val)) for key, val in labels)
+    return '%s %s' % (name, value)
+
+
+def _bucket_order(series):
+    labels = dict(series[1])
+    le = labels.pop('le', None)
+    return tuple(sorted(labels.items())), float(le) if le is not None else 0
+
+
+def render():
+    """
+    :return: all metrics in the prometheus text format
+    """
+    families = defaultdict(list)
+    for (name, labels), value in metrics.collect().items():
+        family = name
+        for suffix in ('_bucket', '_count', '_sum'):
+            if name.endswith(suffix) and name[:-len(suffix)] in METRICS:
+                family = name[:-len(suffix)]
+                if suffix == '_sum':
+                    value = value / 1000000.0
+        families[family].append(((name, labels), value))
+
+    lines = []
+    for family in sorted(families):
+        kind, description = METRICS.get(family, ('untyped', ''))
+        lines.append('# HELP %s %s' % (family, description))
+        lines.append('# TYPE %s %s' % (family, kind))
+        for (name, labels), value in sorted(families[family], key=lambda entry: (entry[0][0],
+                                                                                 _bucket_order(entry[0]))):
+            lines.append(_format(name, labels, value))
+
+    if cache.is_enabled():
+        stats = cache.stats.get()
+        lines.append('# HELP janus_permission_cache_requests_total Permission cache lookups by result.')
+        lines.append('# TYPE janus_permission_cache_requests_total counter')
+        for result in ('hits', 'misses', 'lock_waits'):
+            lines.append(_format('janus_permission_cache_requests_total', [('result', result)], stats[result]))
+        lookups = stats['hits'] + stats['misses']
+        lines.append('# HELP janus_permission_cache_hit_ratio Share of the permission cache lookups that were hits.')
+        lines.append('# TYPE janus_permission_cache_hit_ratio gauge')
+        lines.append(_format('janus_permission_cache_hit_ratio', None, stats['hits'] / lookups if lookups else 0))
+
+    return '\n'.join(lines) + '\n'
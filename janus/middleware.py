@@ -1,5 +1,7 @@
 from janus.models import Profile
 
+PROFILE_SESSION_KEY = '_janus_profile'
+
 
 class ProfileMiddleware(object):
     def __init__(self, get_response):
@@ -15,8 +17,12 @@ class ProfileMiddleware(object):
         # Code to be executed for each request/response after
         # the view is called.
 
+        # the profile is created on login, the session remembers the check for users logged in before
         if request.user.is_authenticated:
-            if not hasattr(request.user, 'profile'):
+            session = getattr(request, 'session', None)
+            if session is None or session.get(PROFILE_SESSION_KEY) != str(request.user.pk):
                 Profile.create_default_profile(request.user)
+                if session is not None:
+                    session[PROFILE_SESSION_KEY] = str(request.user.pk)
 
         return response
\ No newline at end of file
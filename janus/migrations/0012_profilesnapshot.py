@@ -0,0 +1,24 @@
+# Generated by Django 4.0.10 on 2026-10-18 09:01
+
+from django.db import migrations, models
+import django.db.models.deletion
+from oauth2_provider.settings import oauth2_settings
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(oauth2_settings.ACCESS_TOKEN_MODEL),
+        ('janus', '0011_usersession'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProfileSnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('data', models.JSONField()),
+                ('access_token', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='janus_snapshot', to=oauth2_settings.ACCESS_TOKEN_MODEL)),
+            ],
+        ),
+    ]
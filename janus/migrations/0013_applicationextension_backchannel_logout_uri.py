@@ -0,0 +1,18 @@
+# Generated by Django 4.0.10 on 2026-10-18 09:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('janus', '0012_profilesnapshot'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='applicationextension',
+            name='backchannel_logout_uri',
+            field=models.URLField(blank=True, default=None, null=True),
+        ),
+    ]
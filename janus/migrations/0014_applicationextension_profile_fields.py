@@ -0,0 +1,18 @@
+# Generated by Django 4.0.10 on 2026-10-18 09:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('janus', '0013_applicationextension_backchannel_logout_uri'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='applicationextension',
+            name='profile_fields',
+            field=models.CharField(blank=True, default=None, max_length=255, null=True),
+        ),
+    ]
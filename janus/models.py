@@ -1,8 +1,8 @@
 from django.conf import settings
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
-from oauth2_provider.models import Application
+from oauth2_provider.models import Application, AccessToken
 
 import json
 
@@ -24,14 +24,16 @@ class Profile(models.Model):
 
     @staticmethod
     def create_default_profile(user):
-        p = Profile()
-        p.user = user
-        p.save()
-
-        default_groups = ProfileGroup.objects.filter(default=True)
-        if default_groups.exists():
-            p.group.add(default_groups.latest('id'))
-        p.save()
+        """
+        get or create the profile of a user, a new profile is added to the latest default group.
+        safe if parallel requests of a new user race.
+        """
+        with transaction.atomic():
+            p, created = Profile.objects.get_or_create(user=user)
+            if created:
+                default_group = ProfileGroup.objects.filter(default=True).order_by('-id').first()
+                if default_group:
+                    p.group.add(default_group)
         return p
 
 
@@ -83,12 +85,80 @@ class GroupPermission(models.Model):
     groups = models.ManyToManyField(ApplicationGroup, blank=True,)
 
 
+class EffectivePermission(models.Model):
+    """
+        materialized result of the permission resolution for a user and an application,
+        kept up to date by janus.signals if JANUS_EFFECTIVE_PERMISSIONS is enabled
+        a missing row means the user has no permissions and no groups for the application
+    """
+    class Meta:
+        unique_together = (('user', 'application', ), )
+
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    application = models.ForeignKey(Application, on_delete=models.CASCADE)
+    can_authenticate = models.BooleanField(default=False)
+    is_staff = models.BooleanField(default=False)
+    is_superuser = models.BooleanField(default=False)
+    # sorted list of the application group names
+    groups = models.JSONField(default=list, blank=True)
+
+
+class UserSession(models.Model):
+    """
+        index of the sessions of a user, used to end all sessions of a user on a remote logout
+        without decoding every session
+    """
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    session_key = models.CharField(max_length=40, unique=True)
+
+    def __str__(self):
+        return self.session_key
+
+
+class ProfileSnapshot(models.Model):
+    """
+        profile payload of the token's user for the token's application, computed when the token is issued
+        if JANUS_PROFILE_SNAPSHOT is enabled. permission changes delete the snapshots of the affected tokens.
+    """
+    access_token = models.OneToOneField(AccessToken, on_delete=models.CASCADE, related_name="janus_snapshot")
+    # result of ProfileView.generate_json_data
+    data = models.JSONField()
+
+    @staticmethod
+    def for_token(token):
+        """
+        :return: the snapshot data of the access token, None if it has none
+        """
+        if token is None or token.pk is None:
+            return None
+        try:
+            return token.janus_snapshot.data
+        except ProfileSnapshot.DoesNotExist:
+            return None
+
+    @staticmethod
+    def invalidate(user_ids=None, application_ids=None):
+        """
+        delete the snapshots of the tokens of the given users and applications, None for all
+        """
+        snapshots = ProfileSnapshot.objects.all()
+        if user_ids is not None:
+            snapshots = snapshots.filter(access_token__user_id__in=user_ids)
+        if application_ids is not None:
+            snapshots = snapshots.filter(access_token__application_id__in=application_ids)
+        snapshots.delete()
+
+
 class ApplicationExtension(models.Model):
     application = models.OneToOneField(Application, on_delete=models.CASCADE, related_name="extension")
     email_required = models.BooleanField(default=False)
     display_name = models.CharField(max_length=255, null=True, blank=True, default=None)
     link = models.URLField(default=None, blank=True, null=True)
     profile_replace_json = models.TextField(null=True, blank=True, default=None)
+    # comma separated keys of the profile response the application gets (before the replacement), empty for all
+    profile_fields = models.CharField(max_length=255, null=True, blank=True, default=None)
+    # OIDC back-channel logout, receives a logout token when the user is logged out remotely
+    backchannel_logout_uri = models.URLField(null=True, blank=True, default=None)
 
     def clean(self):
         if self.profile_replace_json is not None:
@@ -0,0 +1,162 @@
+"""
+signed (JWT) access tokens carrying the janus claims, resource servers verify them against the JWKS endpoint.
+
+enable with OAUTH2_PROVIDER['ACCESS_TOKEN_GENERATOR'] = 'janus.oauth2.tokens.signed_token_generator'.
+the tokens are too long for the token column of oauth2_provider, only their digest is stored.
+REFRESH_TOKEN_GENERATOR must be set to a random generator, e.g.
+'oauthlib.oauth2.rfc6749.tokens.random_token_generator', oauthlib would sign the refresh tokens as well otherwise
+and they do not fit into the refresh token column.
+"""
+import base64
+import functools
+import hashlib
+import json
+import time
+import uuid
+
+from django.core.exceptions import ImproperlyConfigured
+from django.urls import NoReverseMatch
+from django.utils import timezone
+from jwcrypto import jwk, jwt
+from jwcrypto.common import JWException
+from oauthlib.common import Request
+from oauth2_provider.settings import oauth2_settings
+
+DIGEST_PREFIX = 'sha256:'
+ACCESS_TOKEN_TYPE = 'at+jwt'
+
+# claims of JanusOAuth2Validator.get_additional_claims embedded in the access token
+JANUS_CLAIMS = ('is_staff', 'is_superuser', 'can_authenticate', 'groups', 'email_verified')
+
+
+def is_signed_token(token):
+    return bool(token) and token.count('.') == 2
+
+
+def signed_tokens_enabled():
+    return oauth2_settings.ACCESS_TOKEN_GENERATOR is signed_token_generator
+
+
+def check_token_generators():
+    """
+    :raises: ImproperlyConfigured if the refresh tokens would be signed as well
+    """
+    if signed_tokens_enabled() and oauth2_settings.REFRESH_TOKEN_GENERATOR in (None, signed_token_generator):
+        raise ImproperlyConfigured("REFRESH_TOKEN_GENERATOR must be a random token generator if the access tokens "
+                                   "are signed, oauthlib signs the refresh tokens as well otherwise")
+
+
+def stored_token(token):
+    """
+    :return: the value stored in AccessToken.token for the token presented by a client
+    """
+    # tokens of other generators are stored as they are, even if they look like a signed token
+    if signed_tokens_enabled() and is_signed_token(token):
+        return DIGEST_PREFIX + hashlib.sha256(token.encode('utf-8')).hexdigest()
+    return token
+
+
+@functools.lru_cache(maxsize=8)
+def _load_key(pem):
+    return jwk.JWK.from_pem(pem.encode('utf8'))
+
+
+def signing_key():
+    """
+    :return: the JWK of OIDC_RSA_PRIVATE_KEY, signs the access tokens and the back-channel logout tokens
+    """
+    if not oauth2_settings.OIDC_RSA_PRIVATE_KEY:
+        raise ValueError("OIDC_RSA_PRIVATE_KEY is required for signed access tokens")
+    return _load_key(oauth2_settings.OIDC_RSA_PRIVATE_KEY)
+
+
+def _verification_keys():
+    keys = jwk.JWKSet()
+    for pem in [oauth2_settings.OIDC_RSA_PRIVATE_KEY, *oauth2_settings.OIDC_RSA_PRIVATE_KEYS_INACTIVE]:
+        if pem:
+            key = _load_key(pem)
+            public = json.loads(key.export_public())
+            # the key id is the thumbprint, same as the JWKS endpoint
+            public['kid'] = key.thumbprint()
+            keys.add(jwk.JWK(**public))
+    return keys
+
+
+def signed_token_generator(request, refresh_token=False):
+    """
+    oauthlib token generator, creates a signed access token for the user and client of the request
+    """
+    now = int(time.time())
+    claims = {
+        'aud': request.client.client_id,
+        'client_id': request.client.client_id,
+        'iat': now,
+        'exp': now + int(request.expires_in or oauth2_settings.ACCESS_TOKEN_EXPIRE_SECONDS),
+        'jti': uuid.uuid4().hex,
+        'scope': ' '.join(request.scopes or []),
+    }
+    try:
+        claims['iss'] = oauth2_settings.oidc_issuer(request)
+    except NoReverseMatch:
+        # OIDC is disabled and OIDC_ISS_ENDPOINT not set
+        pass
+
+    # client credentials tokens have no user
+    if request.grant_type != 'client_credentials' and request.user is not None and request.user.is_authenticated:
+        claims['sub'] = str(request.user.pk)
+        additional = oauth2_settings.OAUTH2_VALIDATOR_CLASS().get_additional_claims(request)
+        for key in JANUS_CLAIMS:
+            if key in additional:
+                claims[key] = additional[key](request) if callable(additional[key]) else additional[key]
+
+    key = signing_key()
+    token = jwt.JWT(header={'alg': 'RS256', 'typ': ACCESS_TOKEN_TYPE, 'kid': key.thumbprint()}, claims=claims)
+    token.make_signed_token(key)
+    return token.serialize()
+
+
+def resign_token(access_token, uri, headers=None):
+    """
+    replace the access token by a new signed token with the same user, application, scope and expiry.
+    a signed token cannot be restored from its stored digest.
+    :param uri: uri of the token request
+    :param headers: headers of the token request, used for the issuer
+    :return: the new signed token
+    """
+    request = Request(uri, headers=headers)
+    request.user = access_token.user
+    request.client = access_token.application
+    request.scopes = access_token.scope.split()
+    request.expires_in = max(int((access_token.expires - timezone.now()).total_seconds()), 1)
+    request.grant_type = 'refresh_token'
+    token = signed_token_generator(request)
+    access_token.token = token
+    access_token.save(update_fields=['token'])
+    return token
+
+
+def _token_type(token):
+    try:
+        header = token.split('.', 1)[0]
+        return json.loads(base64.urlsafe_b64decode(header + '=' * (-len(header) % 4))).get('typ')
+    except (ValueError, TypeError, AttributeError):
+        return None
+
+
+def verify_signed_token(token):
+    """
+    verify the signature and the expiry of a signed access token without touching the database.
+    revoked tokens stay valid until they expire.
+    :return: dict of claims, None if the token is invalid or expired
+    """
+    # id tokens and logout tokens are signed with the same key, only access tokens are accepted (RFC 9068)
+    if _token_type(token) != ACCESS_TOKEN_TYPE:
+        return None
+    try:
+        verified = jwt.JWT(jwt=token, key=_verification_keys(), expected_type='JWS')
+        claims = json.loads(verified.claims)
+    except (JWException, ValueError, TypeError):
+        return None
+    if claims.get('exp', 0) <= time.time():
+        return None
+    return claims
@@ -1,4 +1,16 @@
-from janus.models import ProfileGroup, Profile, GroupPermission, ProfilePermission
+import logging
+from collections import defaultdict
+
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import Q, F, Count, Exists
+from oauth2_provider.models import get_application_model
+
+from janus import app_settings, cache
+from janus.models import ProfileGroup, Profile, GroupPermission, ProfilePermission, ApplicationGroup, \
+    EffectivePermission
+
+logger = logging.getLogger(__name__)
 
 
 def get_profile_memberships(user):
@@ -11,6 +23,17 @@ def get_profile_memberships(user):
     return list(all_profiles)
 
 
+def profile_group_membership_q(user, prefix='profile_group'):
+    """
+    build a filter matching all profile groups of a user, including the default groups, without loading them
+    :param user:
+    :param prefix: lookup path from the filtered model to the ProfileGroup
+    :return: Q object
+    """
+    explicit_groups = Profile.group.through.objects.filter(profile__user=user).values('profilegroup_id')
+    return Q(**{prefix + '__default': True}) | Q(**{prefix + '__in': explicit_groups})
+
+
 def get_group_permissions(user, application):
     """
     Validates the group permissions for a user given a token
@@ -25,22 +48,25 @@ def get_group_permissions(user, application):
     if not user.is_authenticated:
         return can_authenticate, is_staff, is_superuser
 
-    all_groups = get_profile_memberships(user)
-
-    for g in all_groups:
-        gp = GroupPermission.objects.filter(profile_group=g, application=application)
-        if gp.count() == 0:
+    # fetch the permissions of all groups in one query and OR them together in python
+    permissions = GroupPermission.objects.filter(profile_group_membership_q(user), application=application)
+    permissions_by_group = {}
+    for group_id, *flags in permissions.values_list('profile_group_id', 'can_authenticate', 'is_staff',
+                                                    'is_superuser'):
+        permissions_by_group.setdefault(group_id, []).append(flags)
+
+    for group_id, flags in permissions_by_group.items():
+        if len(flags) > 1:
+            logger.warning("profile group %s has %d permissions for application %s, they are ignored",
+                           group_id, len(flags), application.pk)
             continue
-        elif gp.count() == 1:
-            gp = gp.first()
-            if gp.can_authenticate:
-                can_authenticate = True
-            if gp.is_staff:
-                is_staff = True
-            if gp.is_superuser:
-                is_superuser = True
-        else:
-            print('We have a problem')
+        gp_authenticate, gp_staff, gp_superuser = flags[0]
+        if gp_authenticate:
+            can_authenticate = True
+        if gp_staff:
+            is_staff = True
+        if gp_superuser:
+            is_superuser = True
     return can_authenticate, is_staff, is_superuser
 
 
@@ -57,14 +83,34 @@ def get_personal_permissions(user, application):
     if not user.is_authenticated:
         return can_authenticate, is_staff, is_superuser
 
-    pp = ProfilePermission.objects.filter(profile__user=user, application=application).first()
+    pp = ProfilePermission.objects.filter(profile__user=user, application=application) \
+        .values_list('can_authenticate', 'is_staff', 'is_superuser').first()
     if pp:
-        is_staff = True if pp.is_staff else None
-        is_superuser = True if pp.is_superuser else None
-        can_authenticate = True if pp.can_authenticate else None
+        pp_authenticate, pp_staff, pp_superuser = pp
+        is_staff = True if pp_staff else None
+        is_superuser = True if pp_superuser else None
+        can_authenticate = True if pp_authenticate else None
     return can_authenticate, is_staff, is_superuser
 
 
+def _profile_group_names(user, application):
+    # ensure only groups for this application can be returned
+    return ApplicationGroup.objects.filter(
+        profile_group_membership_q(user, prefix='grouppermission__profile_group'),
+        application=application,
+        grouppermission__application=application,
+    ).values_list('name', flat=True)
+
+
+def _profile_personal_names(user, application):
+    # ensure only groups for this application can be returned
+    return ApplicationGroup.objects.filter(
+        application=application,
+        profilepermission__profile__user=user,
+        profilepermission__application=application,
+    ).values_list('name', flat=True)
+
+
 def get_profile_group_memberships(user, application):
     """
     collect group names form user profile group memberships
@@ -72,74 +118,268 @@ def get_profile_group_memberships(user, application):
     :param token:
     :return:
     """
+    return set(_profile_group_names(user, application))
 
-    all_profiles = get_profile_memberships(user)
 
-    group_list = set()
+def get_profile_personal_memberships(user, application):
+    """
+    collect group names form user profile permission
+    :param user:
+    :param token:
+    :return:
+    """
+    return set(_profile_personal_names(user, application))
+
 
-    for g in all_profiles:
-        # get profile-group-permission object
-        gp = GroupPermission.objects.filter(profile_group=g, application=application)
-        for elem in gp:
-            groups = elem.groups.all()
+def compute_authentication_permitted(user, application):
+    """
+    decide if the user may authenticate for the application with a single query,
+    same result as the can_authenticate value of get_permissions
+    :param user:
+    :param application:
+    :return: bool
+    """
+    if not user.is_authenticated:
+        return False
 
-            for g in groups:
-                # ensure only groups for this application can be returned
-                if g.application == application:
-                    group_list.add(g.name)
+    # a group with multiple permissions for the same application is ambiguous and ignored
+    ambiguous_groups = GroupPermission.objects.filter(application=application).values('profile_group') \
+        .annotate(count=Count('pk')).filter(count__gt=1).values('profile_group')
+    granted_by_group = GroupPermission.objects.filter(profile_group_membership_q(user), application=application,
+                                                      can_authenticate=True) \
+        .exclude(profile_group__in=ambiguous_groups)
+    granted_personally = ProfilePermission.objects.filter(profile__user=user, application=application,
+                                                          can_authenticate=True)
 
-    return group_list
+    return get_application_model().objects.filter(pk=application.pk) \
+        .filter(Exists(granted_by_group) | Exists(granted_personally)).exists()
 
 
-def get_profile_personal_memberships(user, application):
+def merge_permissions(group_permissions, personal_permissions):
     """
-    collect group names form user profile permission
+    apply the personal override on top of the OR-ed group permissions
+    :param group_permissions: (can_authenticate, is_staff, is_superuser)
+    :param personal_permissions: (can_authenticate, is_staff, is_superuser), None means not set
+    :return: (can_authenticate, is_staff, is_superuser)
+    """
+    return tuple(group if personal is None else personal
+                 for group, personal in zip(group_permissions, personal_permissions))
+
+
+def compute_permissions(user, application):
+    """
+    return permissions according to application settings, personal overwrite and default values
     :param user:
-    :param token:
+    :param application:
     :return:
     """
+    return merge_permissions(get_group_permissions(user, application),
+                             get_personal_permissions(user, application))
 
-    profile_permissions = ProfilePermission.objects.filter(profile__user=user, application=application).first()
 
-    group_list = set()
+def compute_group_list(user, application):
+    # a single UNION query, the database removes the duplicates
+    return list(_profile_group_names(user, application).union(_profile_personal_names(user, application)))
 
-    if profile_permissions:
-        groups = profile_permissions.groups.all()
 
-        for g in groups:
-            # ensure only groups for this application can be returned
-            if g.application == application:
-                group_list.add(g.name)
+def get_effective_permissions(user, application):
+    """
+    read the materialized permissions of a user for an application, a missing row means no permissions at all
+    :param user:
+    :param application:
+    :return: (can_authenticate, is_staff, is_superuser), list of group names
+    """
+    row = EffectivePermission.objects.filter(user_id=user.pk, application=application) \
+        .values_list('can_authenticate', 'is_staff', 'is_superuser', 'groups').first()
+    if row is None:
+        return (False, False, False), []
+    return tuple(row[:3]), list(row[3])
+
 
-    return group_list
+def _resolve_uncached(user, application):
+    if app_settings.JANUS_EFFECTIVE_PERMISSIONS:
+        return get_effective_permissions(user, application)
+    return compute_permissions(user, application), compute_group_list(user, application)
 
 
 def get_permissions(user, application):
     """
-    return permissions according to application settings, personal overwrite and default values
+    return permissions according to application settings, personal overwrite and default values,
+    read from the cache or the materialized table if enabled
     :param user:
     :param application:
     :return:
     """
-    can_authenticate, is_staff, is_superuser = get_group_permissions(user, application)
+    if uses_permission_store():
+        return resolve_permissions(user, application)[0]
+    return compute_permissions(user, application)
 
-    # if set the personal settings overwrite the user settings
-    pp_authenticate, pp_staff, pp_superuser = get_personal_permissions(user, application)
-    if pp_staff is not None:
-        is_staff = pp_staff
 
-    if pp_superuser is not None:
-        is_superuser = pp_superuser
+def get_group_list(user, application):
+    if uses_permission_store():
+        return resolve_permissions(user, application)[1]
+    return compute_group_list(user, application)
 
-    if pp_authenticate is not None:
-        can_authenticate = pp_authenticate
 
-    return can_authenticate, is_staff, is_superuser
+def uses_permission_store():
+    # the cache and the materialized table answer the flags and the groups at once
+    return cache.is_enabled() or app_settings.JANUS_EFFECTIVE_PERMISSIONS
 
 
-def get_group_list(user, application):
-    groups = set()
-    groups = groups.union(get_profile_group_memberships(user, application))
-    groups = groups.union(get_profile_personal_memberships(user, application))
+def resolve_permissions(user, application):
+    """
+    resolve the permission flags and the group names of a user for a single application.
+    the number of queries does not depend on the number of groups the user is member of.
+    :param user:
+    :param application:
+    :return: (can_authenticate, is_staff, is_superuser), list of group names
+    """
+    if cache.is_enabled() and user.is_authenticated:
+        permissions, groups = cache.get_or_compute(user, application, _resolve_uncached)
+        return permissions, list(groups)
+    return _resolve_uncached(user, application)
+
+
+def resolve_permissions_bulk(user_ids, application_ids=None):
+    """
+    resolve the permission flags and the group names for many users and applications at once.
+    the number of queries is constant, pass the user ids in chunks to keep the IN clauses small.
+    :param user_ids: ids of the users to resolve
+    :param application_ids: ids of the applications to resolve, None for all applications
+    :return: dict (user_id, application_id) -> ((can_authenticate, is_staff, is_superuser), sorted group names),
+             pairs without any GroupPermission or ProfilePermission are missing
+    """
+    user_ids = list(user_ids)
+    application_filter = {} if application_ids is None else {'application_id__in': list(application_ids)}
+
+    memberships = defaultdict(set)
+    for user_id, group_id in Profile.group.through.objects.filter(profile__user_id__in=user_ids) \
+            .values_list('profile__user_id', 'profilegroup_id'):
+        memberships[user_id].add(group_id)
+    default_groups = set(ProfileGroup.objects.filter(default=True).values_list('pk', flat=True))
+    all_groups = default_groups.union(*memberships.values())
+
+    group_permissions = GroupPermission.objects.filter(profile_group_id__in=all_groups, **application_filter)
+    # profile_group_id -> application_id -> [(grouppermission_id, flags), ...]
+    permissions_by_group = defaultdict(lambda: defaultdict(list))
+    for gp_id, group_id, application_id, *flags in group_permissions.values_list(
+            'id', 'profile_group_id', 'application_id', 'can_authenticate', 'is_staff', 'is_superuser'):
+        permissions_by_group[group_id][application_id].append((gp_id, tuple(flags)))
+
+    # ensure only groups for the same application can be returned
+    group_names = defaultdict(set)
+    for gp_id, name in GroupPermission.groups.through.objects.filter(
+            grouppermission__in=group_permissions.values('pk'),
+            applicationgroup__application_id=F('grouppermission__application_id'),
+    ).values_list('grouppermission_id', 'applicationgroup__name'):
+        group_names[gp_id].add(name)
+
+    profile_permissions = ProfilePermission.objects.filter(profile__user_id__in=user_ids, **application_filter)
+    # user_id -> application_id -> (profilepermission_id, flags)
+    personal = defaultdict(dict)
+    for pp_id, user_id, application_id, *flags in profile_permissions.values_list(
+            'id', 'profile__user_id', 'application_id', 'can_authenticate', 'is_staff', 'is_superuser'):
+        personal[user_id][application_id] = (pp_id, tuple(True if flag else None for flag in flags))
+
+    personal_names = defaultdict(set)
+    for pp_id, name in ProfilePermission.groups.through.objects.filter(
+            profilepermission__in=profile_permissions.values('pk'),
+            applicationgroup__application_id=F('profilepermission__application_id'),
+    ).values_list('profilepermission_id', 'applicationgroup__name'):
+        personal_names[pp_id].add(name)
+
+    result = {}
+    for user_id in user_ids:
+        flags = {}
+        names = defaultdict(set)
+        for group_id in memberships[user_id] | default_groups:
+            for application_id, entries in permissions_by_group[group_id].items():
+                application_flags = flags.setdefault(application_id, (False, False, False))
+                # a group with multiple permissions for the same application is ambiguous, only its groups count
+                if len(entries) == 1:
+                    flags[application_id] = tuple(a or b for a, b in zip(application_flags, entries[0][1]))
+                for gp_id, _ in entries:
+                    names[application_id] |= group_names[gp_id]
+
+        for application_id, (pp_id, pp_flags) in personal[user_id].items():
+            flags[application_id] = merge_permissions(flags.get(application_id, (False, False, False)), pp_flags)
+            names[application_id] |= personal_names[pp_id]
+
+        for application_id, application_flags in flags.items():
+            result[user_id, application_id] = (application_flags, sorted(names[application_id]))
+    return result
+
+
+def _chunks(items, size):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def resolve_application_permissions(user_ids, application, chunk_size=500):
+    """
+    resolve the permissions of many users for one application, the number of queries only depends on the
+    number of chunks. reads the EffectivePermission table if it is enabled.
+    :param user_ids: ids of the users to resolve
+    :param application:
+    :param chunk_size: number of users resolved per batch
+    :return: dict user_id -> ((can_authenticate, is_staff, is_superuser), sorted group names)
+    """
+    result = {user_id: ((False, False, False), []) for user_id in user_ids}
+    for chunk in _chunks(result, chunk_size):
+        if app_settings.JANUS_EFFECTIVE_PERMISSIONS:
+            for user_id, *flags, groups in EffectivePermission.objects.filter(
+                    user_id__in=chunk, application=application).values_list(
+                    'user_id', 'can_authenticate', 'is_staff', 'is_superuser', 'groups'):
+                result[user_id] = (tuple(flags), list(groups))
+        else:
+            for (user_id, _), resolved in resolve_permissions_bulk(chunk, [application.pk]).items():
+                result[user_id] = resolved
+    return result
+
 
-    return list(groups)
+def refresh_effective_permissions(user_ids=None, application_ids=None, chunk_size=500):
+    """
+    recompute the materialized EffectivePermission rows for the given users and applications
+    :param user_ids: ids of the users to refresh, None for all users
+    :param application_ids: ids of the applications to refresh, None for all applications
+    :param chunk_size: number of users resolved per batch
+    :return: number of stored rows
+    """
+    users = get_user_model().objects.order_by('pk').values_list('pk', flat=True)
+    if user_ids is None:
+        user_ids = users
+    stored = 0
+
+    with transaction.atomic():
+        for chunk in _chunks(user_ids, chunk_size):
+            # users deleted in the meantime are skipped, their rows are removed by the cascade
+            existing = list(users.filter(pk__in=chunk))
+            resolved = resolve_permissions_bulk(existing, application_ids)
+
+            stale = EffectivePermission.objects.filter(user_id__in=chunk)
+            if application_ids is not None:
+                stale = stale.filter(application_id__in=application_ids)
+            stale.delete()
+
+            rows = [
+                EffectivePermission(user_id=user_id, application_id=application_id, can_authenticate=flags[0],
+                                    is_staff=flags[1], is_superuser=flags[2], groups=groups)
+                for (user_id, application_id), (flags, groups) in resolved.items()
+                if any(flags) or groups
+            ]
+            EffectivePermission.objects.bulk_create(rows)
+            stored += len(rows)
+    return stored
+
+
+def get_authentication_permitted(user, application):
+    """
+    decide if the user may authenticate for the application, use the cheapest source available
+    :param user:
+    :param application:
+    :return: bool
+    """
+    if uses_permission_store():
+        return bool(resolve_permissions(user, application)[0][0])
+    return compute_authentication_permitted(user, application)
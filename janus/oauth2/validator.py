@@ -1,8 +1,20 @@
+import time
+from datetime import datetime, timezone
+
 from allauth.account.models import EmailAddress
+from django.contrib.auth import get_user_model
+from django.core.exceptions import ObjectDoesNotExist
+from django.utils.functional import SimpleLazyObject
+from oauth2_provider.models import get_access_token_model
 from oauth2_provider.oauth2_validators import OAuth2Validator
 
-from janus import app_settings
-from janus.oauth2.util import get_permissions, get_group_list
+from janus import app_settings, cache
+from janus.instrumentation import stage
+from janus.metrics import metrics
+from janus.models import ProfileSnapshot
+from janus.oauth2.tokens import is_signed_token, stored_token, verify_signed_token
+from janus.oauth2.util import resolve_permissions
+from janus.registry import registry
 
 
 class JanusOAuth2Validator(OAuth2Validator):
@@ -16,29 +28,121 @@ class JanusOAuth2Validator(OAuth2Validator):
                              "groups": app_settings.JANUS_OIDC_SCOPE_EXTRA
                              })
 
+    @staticmethod
+    def _resolve_permissions(request):
+        # one resolution feeds all permission and group claims of the request
+        permissions = getattr(request, '_janus_permissions', None)
+        if permissions is None and app_settings.JANUS_PROFILE_SNAPSHOT:
+            snapshot = ProfileSnapshot.for_token(getattr(request, 'access_token', None))
+            if snapshot is not None:
+                permissions = ((snapshot['can_authenticate'], snapshot['is_staff'], snapshot['is_superuser']),
+                               snapshot['groups'])
+        if permissions is None:
+            with stage('permissions'):
+                permissions = resolve_permissions(request.user, request.client)
+            request._janus_permissions = permissions
+        return permissions
+
+    @staticmethod
+    def _email_verified(request):
+        with stage('email_verified'):
+            return EmailAddress.objects.filter(user=request.user, verified=True).exists()
+
     def get_additional_claims(self, request):
         # The default implementation only returns very little data.
         # Return the data for the additional claims that we want support.
-
-        user = request.user
-
-        can_authenticate, is_staff, is_superuser = get_permissions(user, request.client)
+        # The values are callables, oauth2_provider only evaluates the claims allowed by the granted scopes.
 
         # The `sub` claim is a unique id for a user. The `sub` claim is always returned.
         return {
-            "name": ' '.join([user.first_name, user.last_name]),
-            "given_name": user.first_name,
-            "family_name": user.last_name,
-            "preferred_username": user.username,
-            "email": user.email,
-            "email_verified": EmailAddress.objects.filter(user=user, verified=True).exists(),
-            "is_staff": is_staff,
-            "is_superuser": is_superuser,
+            "name": lambda r: ' '.join([r.user.first_name, r.user.last_name]),
+            "given_name": lambda r: r.user.first_name,
+            "family_name": lambda r: r.user.last_name,
+            "preferred_username": lambda r: r.user.username,
+            "email": lambda r: r.user.email,
+            "email_verified": self._email_verified,
+            "is_staff": lambda r: self._resolve_permissions(r)[0][1],
+            "is_superuser": lambda r: self._resolve_permissions(r)[0][2],
             # TODO: Is `can_authenticate` required?
-            "can_authenticate": can_authenticate,
-            "groups": get_group_list(user, request.client),
+            "can_authenticate": lambda r: self._resolve_permissions(r)[0][0],
+            "groups": lambda r: self._resolve_permissions(r)[1],
         }
 
+    def _load_access_token(self, token):
+        if app_settings.JANUS_PROFILE_SNAPSHOT:
+            return get_access_token_model().objects.select_related("application", "user", "janus_snapshot") \
+                .filter(token=stored_token(token)).first()
+        return super(JanusOAuth2Validator, self)._load_access_token(stored_token(token))
+
+    def revoke_token(self, token, token_type_hint, request, *args, **kwargs):
+        return super(JanusOAuth2Validator, self).revoke_token(stored_token(token), token_type_hint, request,
+                                                              *args, **kwargs)
+
+    def validate_bearer_token(self, token, scopes, request):
+        # counted here, every protected endpoint (profile, userinfo, introspect) validates through the validator
+        start = time.perf_counter()
+        valid = self._validate_bearer_token(token, scopes, request)
+        metrics.observe('janus_token_validation_seconds', time.perf_counter() - start)
+        metrics.inc('janus_token_validations_total', {'result': 'valid' if valid else 'invalid'})
+        return valid
+
+    def _validate_bearer_token(self, token, scopes, request):
+        if app_settings.JANUS_JWT_VALIDATE_LOCALLY and is_signed_token(token):
+            return self._validate_signed_token(token, scopes, request)
+        # without the registry a cached token would need more queries than loading it with its application
+        if cache.token_cache_enabled() and registry.is_enabled() and token:
+            return self._validate_cached_token(token, scopes, request)
+        return super(JanusOAuth2Validator, self).validate_bearer_token(token, scopes, request)
+
+    def _validate_cached_token(self, token, scopes, request):
+        entry = cache.get_token(stored_token(token))
+        if entry is None:
+            valid = super(JanusOAuth2Validator, self).validate_bearer_token(token, scopes, request)
+            if valid:
+                cache.remember_token(request.access_token)
+            return valid
+
+        pk, user_id, client_id, scope, expires = entry
+        if not set(scopes or []).issubset(scope.split()):
+            return False
+        try:
+            application = registry.get_application(client_id)
+        except ObjectDoesNotExist:
+            return False
+        access_token = get_access_token_model()(
+            pk=pk, token=stored_token(token), user_id=user_id, application=application, scope=scope,
+            expires=datetime.fromtimestamp(expires, tz=timezone.utc))
+        self._set_validated_token(request, access_token, user_id)
+        return True
+
+    def _validate_signed_token(self, token, scopes, request):
+        # no database access, the user is loaded on first use and the application comes from the registry
+        claims = verify_signed_token(token)
+        if claims is None or not set(scopes or []).issubset(claims.get('scope', '').split()):
+            return False
+        try:
+            application = registry.get_application(claims['client_id'])
+        except (KeyError, ObjectDoesNotExist):
+            return False
+
+        user_id = claims.get('sub')
+        access_token = get_access_token_model()(
+            token=stored_token(token), user_id=user_id, application=application, scope=claims['scope'],
+            expires=datetime.fromtimestamp(claims['exp'], tz=timezone.utc))
+        self._set_validated_token(request, access_token, user_id)
+        return True
+
+    @staticmethod
+    def _set_validated_token(request, access_token, user_id):
+        # the user is loaded on first use, once for the request and the token
+        user = SimpleLazyObject(lambda: get_user_model().objects.get(pk=user_id)) if user_id else None
+        if user is not None:
+            access_token._state.fields_cache['user'] = user
+        request.client = access_token.application
+        request.user = user
+        request.scopes = access_token.scope.split()
+        request.access_token = access_token
+
     def get_discovery_claims(self, request):
         # Used for discovery of the available claims at the Auto Discovery Endpoint.
         return ["name", "given_name", "family_name", "preferred_username", "email", "email_verified", "is_staff",
@@ -1,48 +1,77 @@
+import json
 import urllib
 from allauth.account.models import EmailAddress
-from allauth.account.utils import send_email_confirmation
+from django.core.exceptions import ObjectDoesNotExist
+from django.http import HttpResponse
 from django.shortcuts import redirect
-from oauth2_provider.models import get_application_model
-from oauth2_provider.views import AuthorizationView as AuthView
-
-from janus.models import ProfilePermission
+from django.utils.decorators import method_decorator
+from django.views.decorators.debug import sensitive_post_parameters
+from oauth2_provider.models import get_access_token_model
+from oauth2_provider.signals import app_authorized
+from oauth2_provider.views import AuthorizationView as AuthView, TokenView as BaseTokenView, \
+    IntrospectTokenView as BaseIntrospectTokenView
+
+from janus import app_settings, cache
+from janus.confirmation import queue_email_confirmation
+from janus.instrumentation import instrument, stage
+from janus.metrics import metrics
+from janus.oauth2.tokens import DIGEST_PREFIX, resign_token, stored_token
+from janus.oauth2.util import get_authentication_permitted
+from janus.registry import registry
+
+
+def authorize_application(client_id):
+    """
+    :return: the application of the client id, None if there is no such application
+    """
+    # a client with an unknown client id stuck in a redirect loop must not query the applications over and over again
+    deny_cache = bool(app_settings.JANUS_AUTHORIZE_DENY_CACHE_TTL)
+    if deny_cache and cache.is_unknown_client(client_id):
+        return None
+    try:
+        return registry.get_application(client_id)
+    except ObjectDoesNotExist:
+        if deny_cache:
+            cache.remember_unknown_client(client_id)
+        return None
 
 
 def authentication_permitted(user, application):
-    permitted = False
-
-    # check if a override entry (ProfilePermission) exists
-    slinge_permit = ProfilePermission.objects.filter(profile=user.profile, application=application)
-    if len(slinge_permit) == 1:
-        return slinge_permit[0].can_authenticate
+    # a client stuck in a redirect loop must not resolve the same denial over and over again
+    deny_cache = bool(app_settings.JANUS_AUTHORIZE_DENY_CACHE_TTL)
+    if deny_cache and cache.is_denied(user, application):
+        metrics.inc('janus_authorize_decisions_total', {'decision': 'deny'})
+        return False
 
-    # check if user can autenticate for this app
-    for group in user.profile.group.all():
-        permits = group.grouppermission_set.filter(application=application).all()
-        for permit in permits:
-            if permit.can_authenticate:
-                permitted = True
+    permitted = get_authentication_permitted(user, application)
 
-    if not permitted:
-        return False
-    return True
+    if not permitted and deny_cache:
+        cache.remember_denial(user, application)
+    metrics.inc('janus_authorize_decisions_total', {'decision': 'allow' if permitted else 'deny'})
+    return permitted
 
 
 class AuthorizationView(AuthView):
 
     # override the get request class, so we can deny the access before the validation starts
+    @instrument('authorize')
     def get(self, request, *args, **kwargs):
         user = request.user
-        application = get_application_model().objects.get(client_id=request.GET.get('client_id'))
+        with stage('application'):
+            application = authorize_application(request.GET.get('client_id'))
 
-        permitted = authentication_permitted(user, application)
+        if application is None:
+            metrics.inc('janus_authorize_decisions_total', {'decision': 'deny'})
+            return redirect('not_authorized')
+
+        with stage('permissions'):
+            permitted = authentication_permitted(user, application)
 
         if permitted:
 
             # check if the application needs a valid email address
-            required = False
-            if hasattr(application, 'extension'):
-                required = application.extension and application.extension.email_required
+            extension = registry.get_extension(application)
+            required = extension is not None and extension.email_required
 
             if required:
 
@@ -50,12 +79,14 @@ class AuthorizationView(AuthView):
                 if user.email:
 
                 # check if the email address is verified (else redirect to verification page)
-                    verified = EmailAddress.objects.filter(user=user, verified=True).exists()
+                    with stage('email'):
+                        verified = EmailAddress.objects.filter(user=user, verified=True).exists()
 
                     if verified:
-                        return super(AuthorizationView, self).get(request, *args, **kwargs)
+                        with stage('oauth2'):
+                            return super(AuthorizationView, self).get(request, *args, **kwargs)
                     else:
-                        send_email_confirmation(request, request.user)
+                        queue_email_confirmation(request, request.user)
                         if request.GET:
                             params = urllib.parse.urlencode(request.GET)
                             request.session['requested_path'] = request.path + '?' + params
@@ -68,6 +99,44 @@ class AuthorizationView(AuthView):
                     return redirect('account_email')
 
 
-            return super(AuthorizationView, self).get(request, *args, **kwargs)
+            with stage('oauth2'):
+                return super(AuthorizationView, self).get(request, *args, **kwargs)
         else:
             return redirect('not_authorized')
+
+
+# signed access tokens are stored as digest, the lookups by token value must use it
+
+class TokenView(BaseTokenView):
+
+    @method_decorator(sensitive_post_parameters("password"))
+    def post(self, request, *args, **kwargs):
+        url, headers, body, status = self.create_token_response(request)
+        if status == 200:
+            data = json.loads(body)
+            access_token = data.get("access_token")
+            if access_token is not None and access_token.startswith(DIGEST_PREFIX):
+                # within the refresh token grace period oauth2_provider returns the stored value of the previous
+                # access token, which is the digest of a signed token. the client gets a new signed token instead.
+                token = get_access_token_model().objects.select_related('user', 'application').get(token=access_token)
+                request_headers = {key: value for key, value in request.META.items() if isinstance(value, str)}
+                if request.is_secure():
+                    request_headers["X_DJANGO_OAUTH_TOOLKIT_SECURE"] = "1"
+                data["access_token"] = resign_token(token, request.build_absolute_uri(), request_headers)
+                body = json.dumps(data)
+                app_authorized.send(sender=self, request=request, token=token)
+            elif access_token is not None:
+                token = get_access_token_model().objects.get(token=stored_token(access_token))
+                app_authorized.send(sender=self, request=request, token=token)
+        response = HttpResponse(content=body, status=status)
+
+        for k, v in headers.items():
+            response[k] = v
+        return response
+
+
+class IntrospectTokenView(BaseIntrospectTokenView):
+
+    @staticmethod
+    def get_token_response(token_value=None):
+        return BaseIntrospectTokenView.get_token_response(stored_token(token_value))
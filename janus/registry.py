@@ -0,0 +1,117 @@
+import threading
+import time
+
+from django.core.exceptions import ObjectDoesNotExist
+from oauth2_provider.models import get_application_model
+
+from janus import app_settings
+from janus.cache import get_cache
+from janus.models import ApplicationExtension
+
+VERSION_KEY = 'janus:registry:version'
+
+
+class ApplicationRegistry(object):
+    """
+    read-through, per process cache of the applications, their extensions and the app launcher entries.
+    model changes bump a version in the shared cache, every process drops its entries once it sees the new version.
+    entries are also dropped after JANUS_APPLICATION_REGISTRY_TTL seconds, which bounds the staleness if the
+    cache backend is not shared between the workers.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clear(None)
+
+    def _clear(self, version):
+        self._version = version
+        self._loaded_at = time.monotonic()
+        self._by_client_id = {}
+        self._extensions = {}
+        self._launcher = None
+
+    @staticmethod
+    def is_enabled():
+        return bool(app_settings.JANUS_APPLICATION_REGISTRY_TTL)
+
+    def _sync(self):
+        version = get_cache().get(VERSION_KEY)
+        expired = time.monotonic() - self._loaded_at > app_settings.JANUS_APPLICATION_REGISTRY_TTL
+        if version != self._version or expired:
+            with self._lock:
+                self._clear(version)
+
+    def invalidate(self):
+        """
+        drop the entries of all processes
+        """
+        cache = get_cache()
+        if not cache.add(VERSION_KEY, 1, timeout=None):
+            try:
+                cache.incr(VERSION_KEY)
+            except ValueError:
+                cache.set(VERSION_KEY, 1, timeout=None)
+        with self._lock:
+            self._clear(None)
+
+    def get_application(self, client_id):
+        """
+        :return: the application with the given client id, the extension is loaded in the same query
+        :raises: DoesNotExist if there is no such application
+        """
+        queryset = get_application_model().objects.select_related('extension')
+        if not self.is_enabled():
+            return queryset.get(client_id=client_id)
+
+        self._sync()
+        application = self._by_client_id.get(client_id)
+        if application is None:
+            application = queryset.get(client_id=client_id)
+            with self._lock:
+                self._by_client_id[client_id] = application
+                self._extensions[application.pk] = self._extension_of(application)
+        return application
+
+    @staticmethod
+    def _extension_of(application):
+        try:
+            return application.extension
+        except ObjectDoesNotExist:
+            return None
+
+    def get_extension(self, application):
+        """
+        :return: the ApplicationExtension of the application or None
+        """
+        if not self.is_enabled():
+            return self._extension_of(application)
+
+        self._sync()
+        try:
+            return self._extensions[application.pk]
+        except KeyError:
+            pass
+        extension = ApplicationExtension.objects.filter(application_id=application.pk).first()
+        with self._lock:
+            self._extensions[application.pk] = extension
+        return extension
+
+    def get_launcher_applications(self):
+        """
+        :return: list of dicts with name and url of all applications with a display name
+        """
+        if self.is_enabled():
+            self._sync()
+            if self._launcher is not None:
+                return self._launcher
+
+        launcher = [{'name': name, 'url': link} for name, link in ApplicationExtension.objects.filter(
+            display_name__isnull=False).values_list('display_name', 'link')]
+
+        if self.is_enabled():
+            with self._lock:
+                self._launcher = launcher
+        return launcher
+
+
+registry = ApplicationRegistry()
@@ -0,0 +1,89 @@
+"""
+bulk revocation of the tokens and sessions of users, profile groups and applications, e.g. during an incident.
+used by the admin actions and `./manage.py revoke_tokens`.
+"""
+from django.apps import apps
+from oauth2_provider.models import get_access_token_model, get_refresh_token_model, get_grant_model, \
+    get_id_token_model
+
+from janus import app_settings, cache
+from janus.cleanup import delete_in_batches
+from janus.metrics import metrics
+from janus.models import UserSession
+from janus.signals import group_member_ids
+
+
+def revocation_querysets(user_ids=None, application_ids=None):
+    """
+    the tokens and grants to revoke in the order they are deleted, refresh tokens first so no new access token
+    can be issued while the access tokens are deleted
+    :param user_ids: user ids or a values_list queryset of them, None for all users
+    :param application_ids: application ids, None for all applications
+    :return: list of (name, queryset)
+    """
+    def scoped(model):
+        queryset = model.objects.all()
+        if user_ids is not None:
+            queryset = queryset.filter(user_id__in=user_ids)
+        if application_ids is not None:
+            queryset = queryset.filter(application_id__in=application_ids)
+        return queryset
+
+    return [
+        ('refresh tokens', scoped(get_refresh_token_model())),
+        ('access tokens', scoped(get_access_token_model())),
+        ('id tokens', scoped(get_id_token_model())),
+        ('grants', scoped(get_grant_model())),
+    ]
+
+
+def revoke_tokens(user_ids=None, application_ids=None, sessions=True, batch_size=None, batch_interval=None,
+                  log=None):
+    """
+    delete the tokens and grants of the given users for the given applications in small batches.
+    the sessions of the users are deleted as well, they are not bound to an application.
+    :param user_ids: user ids or a values_list queryset of them, None for all users
+    :param application_ids: application ids, None for all applications
+    :param sessions: delete the sessions of the users, requires user_ids
+    :param batch_size: rows per DELETE, default JANUS_CLEANUP_BATCH_SIZE
+    :param batch_interval: seconds to sleep between two batches, default JANUS_CLEANUP_BATCH_INTERVAL
+    :param log: optional callable receiving progress messages
+    :return: dict name -> number of deleted rows
+    """
+    if user_ids is None and application_ids is None:
+        raise ValueError("select users or applications, revoking all tokens is not supported")
+    if application_ids is not None:
+        application_ids = list(application_ids)
+    batch_size = batch_size or app_settings.JANUS_CLEANUP_BATCH_SIZE
+    batch_interval = app_settings.JANUS_CLEANUP_BATCH_INTERVAL if batch_interval is None else batch_interval
+
+    deleted = {}
+    for name, queryset in revocation_querysets(user_ids, application_ids):
+        deleted[name] = delete_in_batches(queryset, batch_size, batch_interval, name=name, log=log)
+
+    if sessions and user_ids is not None and apps.is_installed('django.contrib.sessions'):
+        from django.contrib.sessions.models import Session
+        # the index is filled on login, sessions from before run `./manage.py backfill_user_sessions`
+        user_sessions = UserSession.objects.filter(user_id__in=user_ids)
+        deleted['sessions'] = delete_in_batches(
+            Session.objects.filter(session_key__in=user_sessions.values('session_key')), batch_size,
+            batch_interval, name='sessions', log=log)
+        deleted['user sessions'] = delete_in_batches(user_sessions, batch_size, batch_interval,
+                                                     name='user sessions', log=log)
+
+    if cache.uses_versions():
+        cache.invalidate(list(user_ids) if user_ids is not None else None, application_ids)
+
+    for name, count in deleted.items():
+        metrics.inc('janus_revoked_total', {'table': name}, count)
+    return deleted
+
+
+def revoke_group_tokens(group_ids, application_ids=None, **kwargs):
+    """
+    revoke the tokens of all members of the given profile groups, a default group has all users as members
+    :param group_ids: profile group ids
+    :param application_ids: application ids, None for all applications
+    :return: dict name -> number of deleted rows
+    """
+    return revoke_tokens(group_member_ids(group_ids), application_ids, **kwargs)
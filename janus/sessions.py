@@ -0,0 +1,31 @@
+from django.contrib.auth import SESSION_KEY
+from django.contrib.sessions.backends.db import SessionStore as DBSessionStore
+
+from janus.models import UserSession
+
+
+def index_session(user_id, session_key):
+    if user_id is None or not session_key:
+        return
+    UserSession.objects.update_or_create(session_key=session_key, defaults={'user_id': user_id})
+
+
+def unindex_session(session_key):
+    if session_key:
+        UserSession.objects.filter(session_key=session_key).delete()
+
+
+class SessionStore(DBSessionStore):
+    """
+    database session store which keeps the UserSession index in sync when the session key is rotated,
+    e.g. by `update_session_auth_hash` after a password change.
+    enable with SESSION_ENGINE = 'janus.sessions'
+    """
+
+    def cycle_key(self):
+        old_key = self.session_key
+        super().cycle_key()
+        user_id = self.get(SESSION_KEY)
+        if user_id is not None:
+            unindex_session(old_key)
+            index_session(user_id, self.session_key)
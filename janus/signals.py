@@ -0,0 +1,309 @@
+from django.conf import settings
+from django.contrib.auth.signals import user_logged_in, user_logged_out
+from django.db import transaction
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete, m2m_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+from oauth2_provider.models import get_application_model, get_access_token_model
+
+from janus import app_settings, cache
+from janus.models import Profile, ProfileGroup, GroupPermission, ProfilePermission, ApplicationGroup, \
+    ApplicationExtension, ProfileSnapshot
+from janus.oauth2.tokens import stored_token
+from janus.oauth2.util import refresh_effective_permissions
+from janus.registry import registry
+from janus.middleware import PROFILE_SESSION_KEY
+from janus.sessions import index_session, unindex_session
+
+
+###################################################
+# keep the materialized EffectivePermission table and the cached permissions up to date
+#
+# the affected users and applications are collected while the data is still intact (pre_* signals),
+# the updates run after the transaction is committed, so cascading deletes are already done and
+# no concurrent request can cache the old state under the new version.
+
+
+def permissions_changed(user_ids=None, application_ids=None):
+    """
+    refresh the effective permissions and invalidate the cache once the current transaction is committed
+    :param user_ids: affected user ids, None for all users
+    :param application_ids: affected application ids, None for all applications
+    """
+    if user_ids is not None:
+        user_ids = set(user_ids)
+        if not user_ids:
+            return
+    if application_ids is not None:
+        application_ids = set(application_ids)
+        if not application_ids:
+            return
+
+    def update():
+        if app_settings.JANUS_EFFECTIVE_PERMISSIONS:
+            refresh_effective_permissions(user_ids, application_ids)
+        if cache.uses_versions():
+            cache.invalidate(user_ids, application_ids)
+        if app_settings.JANUS_PROFILE_SNAPSHOT:
+            ProfileSnapshot.invalidate(user_ids, application_ids)
+
+    transaction.on_commit(update)
+
+
+def group_member_ids(group_ids):
+    """
+    user ids of all members of the given profile groups, None if one of them is a default group
+    """
+    if ProfileGroup.objects.filter(pk__in=group_ids, default=True).exists():
+        return None
+    return Profile.objects.filter(group__in=group_ids).values_list('user_id', flat=True).distinct()
+
+
+def group_permissions_changed(group_permissions):
+    group_ids = {gp.profile_group_id for gp in group_permissions}
+    application_ids = {gp.application_id for gp in group_permissions}
+    if group_ids:
+        permissions_changed(group_member_ids(group_ids), application_ids)
+
+
+def profile_permissions_changed(profile_permissions):
+    user_ids = {pp.profile.user_id for pp in profile_permissions}
+    application_ids = {pp.application_id for pp in profile_permissions}
+    permissions_changed(user_ids, application_ids)
+
+
+def enabled(raw=False):
+    # fixtures are loaded raw, rebuild the table afterwards
+    return (app_settings.JANUS_EFFECTIVE_PERMISSIONS or cache.uses_versions() or app_settings.JANUS_PROFILE_SNAPSHOT) \
+        and not raw
+
+
+@receiver(pre_save, sender=ProfileGroup)
+@receiver(pre_save, sender=GroupPermission)
+@receiver(pre_save, sender=ProfilePermission)
+@receiver(pre_save, sender=ApplicationGroup)
+def remember_previous_state(sender, instance, raw=False, **kwargs):
+    if not enabled(raw):
+        return
+    instance._janus_previous = sender.objects.filter(pk=instance.pk).first() if instance.pk else None
+
+
+########## Profile
+
+@receiver(post_save, sender=Profile)
+def profile_saved(sender, instance, raw=False, **kwargs):
+    if enabled(raw):
+        permissions_changed([instance.user_id])
+
+
+@receiver(pre_delete, sender=Profile)
+def profile_deleted(sender, instance, **kwargs):
+    if enabled():
+        permissions_changed([instance.user_id])
+
+
+@receiver(m2m_changed, sender=Profile.group.through)
+def profile_groups_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if not enabled():
+        return
+    if not reverse:
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            permissions_changed([instance.user_id])
+    elif action in ('post_add', 'post_remove'):
+        permissions_changed(Profile.objects.filter(pk__in=pk_set).values_list('user_id', flat=True))
+    elif action == 'pre_clear':
+        permissions_changed(instance.profile_set.values_list('user_id', flat=True))
+
+
+########## ProfileGroup
+
+@receiver(post_save, sender=ProfileGroup)
+def profile_group_saved(sender, instance, raw=False, **kwargs):
+    if not enabled(raw):
+        return
+    previous = getattr(instance, '_janus_previous', None)
+    was_default = previous.default if previous else False
+    if instance.default != was_default:
+        # all users gain or lose the group
+        permissions_changed(None, instance.grouppermission_set.values_list('application_id', flat=True))
+
+
+@receiver(pre_delete, sender=ProfileGroup)
+def profile_group_deleted(sender, instance, **kwargs):
+    if enabled():
+        group_permissions_changed(list(instance.grouppermission_set.all()))
+
+
+########## GroupPermission
+
+@receiver(post_save, sender=GroupPermission)
+def group_permission_saved(sender, instance, raw=False, **kwargs):
+    if not enabled(raw):
+        return
+    previous = getattr(instance, '_janus_previous', None)
+    group_permissions_changed([instance] + ([previous] if previous else []))
+
+
+@receiver(pre_delete, sender=GroupPermission)
+def group_permission_deleted(sender, instance, **kwargs):
+    if enabled():
+        group_permissions_changed([instance])
+
+
+@receiver(m2m_changed, sender=GroupPermission.groups.through)
+def group_permission_groups_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if not enabled():
+        return
+    if not reverse:
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            group_permissions_changed([instance])
+    elif action in ('post_add', 'post_remove'):
+        group_permissions_changed(list(GroupPermission.objects.filter(pk__in=pk_set)))
+    elif action == 'pre_clear':
+        group_permissions_changed(list(instance.grouppermission_set.all()))
+
+
+########## ProfilePermission
+
+@receiver(post_save, sender=ProfilePermission)
+def profile_permission_saved(sender, instance, raw=False, **kwargs):
+    if not enabled(raw):
+        return
+    previous = getattr(instance, '_janus_previous', None)
+    profile_permissions_changed([instance] + ([previous] if previous else []))
+
+
+@receiver(pre_delete, sender=ProfilePermission)
+def profile_permission_deleted(sender, instance, **kwargs):
+    if enabled():
+        profile_permissions_changed([instance])
+
+
+@receiver(m2m_changed, sender=ProfilePermission.groups.through)
+def profile_permission_groups_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if not enabled():
+        return
+    if not reverse:
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            profile_permissions_changed([instance])
+    elif action in ('post_add', 'post_remove'):
+        profile_permissions_changed(list(ProfilePermission.objects.filter(pk__in=pk_set)))
+    elif action == 'pre_clear':
+        profile_permissions_changed(list(instance.profilepermission_set.all()))
+
+
+########## ApplicationGroup
+
+def application_group_changed(application_group):
+    group_permissions_changed(list(application_group.grouppermission_set.all()))
+    profile_permissions_changed(list(application_group.profilepermission_set.select_related('profile')))
+
+
+@receiver(post_save, sender=ApplicationGroup)
+def application_group_saved(sender, instance, raw=False, **kwargs):
+    if not enabled(raw):
+        return
+    previous = getattr(instance, '_janus_previous', None)
+    if previous and (previous.name, previous.application_id) != (instance.name, instance.application_id):
+        application_group_changed(instance)
+
+
+@receiver(pre_delete, sender=ApplicationGroup)
+def application_group_deleted(sender, instance, **kwargs):
+    if enabled():
+        application_group_changed(instance)
+
+
+###################################################
+# application registry
+
+@receiver(post_save, sender=get_application_model())
+@receiver(post_delete, sender=get_application_model())
+@receiver(post_save, sender=ApplicationExtension)
+@receiver(post_delete, sender=ApplicationExtension)
+def application_changed(sender, **kwargs):
+    if registry.is_enabled():
+        transaction.on_commit(registry.invalidate)
+
+
+@receiver(post_save, sender=get_application_model())
+def application_saved(sender, instance, raw=False, **kwargs):
+    # a remembered unknown client id may belong to the new or changed application
+    if app_settings.JANUS_AUTHORIZE_DENY_CACHE_TTL and not raw:
+        transaction.on_commit(lambda: cache.forget_unknown_client(instance.client_id))
+
+
+###################################################
+# signed access tokens do not fit into the token column, only their digest is stored
+
+@receiver(pre_save, sender=get_access_token_model())
+def store_token_digest(sender, instance, **kwargs):
+    instance.token = stored_token(instance.token)
+
+
+###################################################
+# cached bearer token validation, a deleted or refreshed token must not validate from the cache
+
+@receiver(pre_save, sender=get_access_token_model())
+def forget_replaced_token(sender, instance, raw=False, **kwargs):
+    if not cache.token_cache_enabled() or raw or instance.pk is None:
+        return
+    # a refresh replaces the token value of the existing row
+    previous = sender.objects.filter(pk=instance.pk).values_list('token', flat=True).first()
+    if previous is not None and previous != instance.token:
+        transaction.on_commit(lambda: cache.forget_token(previous))
+
+
+@receiver(post_delete, sender=get_access_token_model())
+def forget_deleted_token(sender, instance, **kwargs):
+    if cache.token_cache_enabled():
+        transaction.on_commit(lambda: cache.forget_token(instance.token))
+
+
+###################################################
+# profile snapshots, computed when a token is issued or refreshed
+
+@receiver(post_save, sender=get_access_token_model())
+def store_profile_snapshot(sender, instance, raw=False, **kwargs):
+    if not app_settings.JANUS_PROFILE_SNAPSHOT or raw or instance.user_id is None:
+        return
+    profile_view = import_string(app_settings.ALLAUTH_JANUS_PROFILE_VIEW)()
+    data = profile_view.generate_json_data(instance.user, instance.application)
+    ProfileSnapshot.objects.update_or_create(access_token=instance, defaults={'data': data})
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def user_saved(sender, instance, raw=False, update_fields=None, **kwargs):
+    # the snapshots contain the name and email, a login only updates last_login
+    if not app_settings.JANUS_PROFILE_SNAPSHOT or raw or update_fields == frozenset(['last_login']):
+        return
+    transaction.on_commit(lambda: ProfileSnapshot.invalidate([instance.pk]))
+
+
+###################################################
+# profile provisioning
+
+@receiver(user_logged_in)
+def provision_profile(sender, request, user, **kwargs):
+    Profile.create_default_profile(user)
+    session = getattr(request, 'session', None)
+    if session is not None:
+        # spares the ProfileMiddleware the check
+        session[PROFILE_SESSION_KEY] = str(user.pk)
+
+
+###################################################
+# user -> session index, used by the remote logout
+
+@receiver(user_logged_in)
+def session_logged_in(sender, request, user, **kwargs):
+    session = getattr(request, 'session', None)
+    if session is not None:
+        index_session(user.pk, session.session_key)
+
+
+@receiver(user_logged_out)
+def session_logged_out(sender, request, user, **kwargs):
+    session = getattr(request, 'session', None)
+    if session is not None:
+        unindex_session(session.session_key)
@@ -1,6 +1,20 @@
 from celery import shared_task
-from oauth2_provider.models import clear_expired
+
+from janus.backchannel import send_logout_token
+from janus.cleanup import purge_expired
+from janus.confirmation import send_email_confirmation
+
 
 @shared_task
 def cleanup_token():
-    clear_expired()
\ No newline at end of file
+    return purge_expired()
+
+
+@shared_task
+def backchannel_logout(uri, token):
+    return send_logout_token(uri, token)
+
+
+@shared_task
+def email_confirmation(user_id):
+    return send_email_confirmation(user_id)
@@ -1,20 +1,53 @@
+import base64
 import json
+import threading
+import time
 from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from io import StringIO
 import urllib.parse as urlparse
 from unittest import mock
 from urllib.parse import parse_qs
 
-from django.contrib.auth import get_user_model
-from django.test import TestCase, Client
+from allauth.account.models import EmailAddress
+from django.contrib.auth import get_user_model, SESSION_KEY
+from django.contrib.sessions.models import Session
+from django.core import mail
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command, CommandError
+from django.db import connection
+from django.http import HttpResponse
+from django.test import TestCase, Client, RequestFactory
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.utils.timezone import now
-from oauth2_provider.models import Application, AccessToken, Grant
-
+from jwcrypto import jwk, jwt
+from oauthlib.common import Request as OAuthRequest
+from oauthlib.oauth2.rfc6749.tokens import random_token_generator
+from oauth2_provider.models import Application, AccessToken, Grant, RefreshToken, IDToken
+from oauth2_provider.settings import oauth2_settings
+
+from janus import app_settings
+from janus import cache as permission_cache
+from janus.backchannel import send_logout_token, LOGOUT_EVENT, LOGOUT_TOKEN_LIFETIME
 from janus.models import ProfileGroup, Profile, GroupPermission, ProfilePermission, ApplicationGroup, \
-    ApplicationExtension
+    ApplicationExtension, EffectivePermission, UserSession, ProfileSnapshot
+from janus.admin import ApplicationGroupFormSet
+from janus.benchmark import generate_organization, run_benchmark
+from janus.cleanup import purge_expired
+from janus.confirmation import send_email_confirmation
+from janus.metrics import Metrics, metrics as janus_metrics
+from janus.middleware import ProfileMiddleware
 from janus.oauth2.util import get_profile_group_memberships, get_personal_permissions, get_group_permissions, \
-    get_profile_memberships, get_permissions
-from janus.views import ProfileView
+    get_profile_memberships, get_permissions, resolve_permissions, get_group_list, compute_permissions, \
+    compute_group_list, get_effective_permissions, refresh_effective_permissions, compute_authentication_permitted
+from janus.oauth2.tokens import signed_token_generator, verify_signed_token, stored_token, check_token_generators
+from janus.oauth2.validator import JanusOAuth2Validator
+from janus.oauth2.views import authentication_permitted, authorize_application, TokenView
+from janus.revocation import revoke_tokens, revoke_group_tokens
+from janus.registry import registry, VERSION_KEY as REGISTRY_VERSION_KEY
+from janus.sessions import SessionStore
+from janus.views import ProfileView, compile_profile_shape, json_response
 
 User = get_user_model()
 
@@ -33,6 +66,39 @@ class ProfileGeneration(TestCase):
         self.assertEqual(bobs_profile.group.first().name, 'default')
 
 
+    def test_create_default_profile_is_idempotent(self):
+        bob = User.objects.get(username='bob')
+        ProfileGroup.objects.create(name='new default', default=True)
+        profile = Profile.create_default_profile(bob)
+        self.assertEqual(Profile.objects.get(user=bob), profile)
+        self.assertEqual(['default'], [g.name for g in profile.group.all()])
+
+    def test_profile_created_on_login(self):
+        User.objects.create_user(username='alice', password='testjanus123')
+        c = Client()
+        c.post(reverse('login'), dict(username='alice', password='testjanus123'))
+        alice_profile = Profile.objects.get(user__username='alice')
+        self.assertEqual(['default'], [g.name for g in alice_profile.group.all()])
+
+    def test_middleware_checks_the_profile_once(self):
+        alice = User.objects.create_user(username='alice', password='testjanus123')
+        c = Client()
+        c.force_login(alice)
+
+        # force_login does not create the profile, the middleware does on the first request
+        c.get(reverse('index'))
+        self.assertTrue(Profile.objects.filter(user=alice).exists())
+
+        request = RequestFactory().get('/')
+        request.user = alice
+        request.session = c.session
+        # the session is loaded by the authentication anyway
+        request.session.items()
+        middleware = ProfileMiddleware(lambda r: HttpResponse())
+        with self.assertNumQueries(0):
+            middleware(request)
+
+
 class UserAuthenticationTest(TestCase):
 
     def setUp(self):
@@ -204,8 +270,8 @@ class UserAuthenticationTest(TestCase):
         response = c.get(authorize_uri, dict(client_id=app.client_id, response_type="code"))
         self.assertEqual(response.status_code, 302)
 
-        # ensure not allowed to login
-        self.assertEqual(response.url, reverse('not_authorized'))
+        # the default group allows the login, a personal permission only adds permissions (same as the profile)
+        self.assertNotEqual(response.url, reverse('not_authorized'))
 
         # set login allowed
         u = User.objects.get(username='eve')
@@ -327,6 +393,38 @@ class ProfileViewTests(TestCase):
         self.assertEqual(res2['ident'], 1)
         self.assertEqual(res2['more'], 'data')
 
+    def test_profile_shape(self):
+        app_new = Application.objects.create(user=self.user_admin,
+                                             redirect_uris='https://localhost:8000/accounts/janus/login/callback/',
+                                             client_type='confidential',
+                                             authorization_grant_type='authorization-code',
+                                             name='test_new', skip_authorization=True)
+        extension = ApplicationExtension.objects.create(application=app_new, profile_fields='id, groups',
+                                                        profile_replace_json=json.dumps({'id': 'username'}))
+        data = {'id': 'user', 'email': 'user@example.com', 'groups': ['staff']}
+
+        with mock.patch('janus.views.json.loads', wraps=json.loads) as loads:
+            for _ in range(3):
+                res = ProfileView().shape_json_data(dict(data), app_new)
+                self.assertEqual({'username': 'user', 'groups': ['staff']}, res)
+        # compiled once for all requests
+        self.assertLessEqual(loads.call_count, 1)
+
+        # a changed extension is compiled again
+        extension.profile_fields = ''
+        extension.profile_replace_json = json.dumps({'groups': 'roles'})
+        self.assertEqual({'id': 'user', 'email': 'user@example.com', 'roles': ['staff']},
+                         ProfileView().shape_json_data(dict(data), app_new))
+        self.assertEqual(((), frozenset(['id'])), compile_profile_shape(None, ' id ,'))
+
+    def test_json_response(self):
+        data = {'id': 'user', 'groups': ['staff'], 'internal_id': 1}
+        self.assertEqual(data, json.loads(json_response(data).content))
+        with mock.patch('janus.views.orjson', None):
+            response = json_response(data, status=201)
+        self.assertEqual((201, 'application/json'), (response.status_code, response['Content-Type']))
+        self.assertEqual(b'{"id":"user","groups":["staff"],"internal_id":1}', response.content)
+
     def test_profile_view_groups(self):
         # check ProfileView
 
@@ -493,3 +591,1661 @@ class PermissionViewTests(TestCase):
     def test_membership(self):
         ret = get_profile_memberships(self.user)
         print(ret)
+
+
+class PermissionResolverTests(TestCase):
+    def setUp(self):
+        self.group_default = ProfileGroup.objects.create(name='default', default=True)
+        self.user = User.objects.create(username='user')
+        self.profile = Profile.create_default_profile(self.user)
+
+        self.application = Application.objects.create(user=None,
+                                                      redirect_uris='https://localhost:8000/accounts/janus/login/callback/',
+                                                      client_type='confidential',
+                                                      authorization_grant_type='authorization-code',
+                                                      name='test', skip_authorization=True)
+        self.other_application = Application.objects.create(user=None,
+                                                            redirect_uris='https://localhost:8000/accounts/janus/login/callback/',
+                                                            client_type='confidential',
+                                                            authorization_grant_type='authorization-code',
+                                                            name='other', skip_authorization=True)
+        self.other_app_group = ApplicationGroup.objects.create(application=self.other_application, name='other')
+
+        default_app_group = ApplicationGroup.objects.create(application=self.application, name='default_app_group')
+        gp = GroupPermission.objects.create(profile_group=self.group_default, application=self.application)
+        gp.groups.add(default_app_group)
+
+    def add_groups(self, count):
+        for i in range(count):
+            group = ProfileGroup.objects.create(name='group %d' % i)
+            self.profile.group.add(group)
+            app_group = ApplicationGroup.objects.create(application=self.application, name='app group %d' % i)
+            gp = GroupPermission.objects.create(profile_group=group, application=self.application,
+                                                is_staff=(i == 3))
+            gp.groups.add(app_group, self.other_app_group)
+
+    def test_query_count_is_constant(self):
+        self.add_groups(2)
+        with self.assertNumQueries(3):
+            resolve_permissions(self.user, self.application)
+
+        self.add_groups(30)
+        with self.assertNumQueries(3):
+            permissions, groups = resolve_permissions(self.user, self.application)
+
+        self.assertEqual((False, True, False), permissions)
+        self.assertEqual(31, len(groups))
+        self.assertNotIn('other', groups)
+
+    def test_flags_and_override(self):
+        self.add_groups(5)
+        self.assertEqual((False, True, False), get_permissions(self.user, self.application))
+
+        pp = ProfilePermission.objects.create(profile=self.profile, application=self.application,
+                                              can_authenticate=True, is_superuser=True)
+        pp.groups.add(ApplicationGroup.objects.create(application=self.application, name='personal'),
+                      self.other_app_group)
+
+        permissions, groups = resolve_permissions(self.user, self.application)
+        self.assertEqual((True, True, True), permissions)
+        self.assertIn('personal', groups)
+        self.assertIn('default_app_group', groups)
+        self.assertNotIn('other', groups)
+        self.assertEqual(sorted(set(groups)), sorted(groups))
+
+    def test_ambiguous_group_permission_is_ignored(self):
+        group = ProfileGroup.objects.create(name='ambiguous')
+        self.profile.group.add(group)
+        GroupPermission.objects.create(profile_group=group, application=self.application, can_authenticate=True)
+        GroupPermission.objects.create(profile_group=group, application=self.application, is_staff=True)
+
+        with self.assertLogs('janus.oauth2.util', 'WARNING') as logs:
+            self.assertEqual((False, False, False), get_group_permissions(self.user, self.application))
+        self.assertIn('has 2 permissions for application', logs.output[0])
+
+
+@mock.patch.object(app_settings, 'JANUS_EFFECTIVE_PERMISSIONS', True)
+class EffectivePermissionTests(TestCase):
+    def setUp(self):
+        self.group_default = ProfileGroup.objects.create(name='default', default=True)
+        self.group_staff = ProfileGroup.objects.create(name='staff')
+        self.user = User.objects.create(username='user')
+        self.other_user = User.objects.create(username='other')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.profile = Profile.create_default_profile(self.user)
+            Profile.create_default_profile(self.other_user)
+
+        self.application = Application.objects.create(user=None,
+                                                      redirect_uris='https://localhost:8000/accounts/janus/login/callback/',
+                                                      client_type='confidential',
+                                                      authorization_grant_type='authorization-code',
+                                                      name='test', skip_authorization=True)
+        self.app_group = ApplicationGroup.objects.create(application=self.application, name='staff_app_group')
+
+    def assertTableMatchesResolver(self):
+        # compute_permissions and compute_group_list always resolve live, they are the reference
+        for user in (self.user, self.other_user):
+            self.assertEqual(compute_permissions(user, self.application), get_permissions(user, self.application))
+            self.assertEqual(sorted(compute_group_list(user, self.application)),
+                             get_group_list(user, self.application))
+
+    def test_incremental_updates(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            gp = GroupPermission.objects.create(profile_group=self.group_staff, application=self.application,
+                                                is_staff=True)
+            gp.groups.add(self.app_group)
+        self.assertEqual(0, EffectivePermission.objects.count())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.profile.group.add(self.group_staff)
+        self.assertEqual(((False, True, False), ['staff_app_group']),
+                         get_effective_permissions(self.user, self.application))
+        self.assertTableMatchesResolver()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            ProfilePermission.objects.create(profile=self.profile, application=self.application,
+                                             can_authenticate=True)
+        self.assertEqual((True, True, False), resolve_permissions(self.user, self.application)[0])
+
+        # a default group applies to every user, even without an explicit membership
+        with self.captureOnCommitCallbacks(execute=True):
+            group_everyone = ProfileGroup.objects.create(name='everyone', default=True)
+            GroupPermission.objects.create(profile_group=group_everyone, application=self.application,
+                                           is_superuser=True)
+        self.assertEqual((False, False, True), resolve_permissions(self.other_user, self.application)[0])
+        self.assertTableMatchesResolver()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            group_everyone.default = False
+            group_everyone.save()
+        self.assertEqual((False, False, False), resolve_permissions(self.other_user, self.application)[0])
+        self.assertTableMatchesResolver()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.app_group.name = 'renamed'
+            self.app_group.save()
+        self.assertEqual(['renamed'], resolve_permissions(self.user, self.application)[1])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.group_staff.delete()
+        self.assertEqual((True, False, False), resolve_permissions(self.user, self.application)[0])
+        self.assertTableMatchesResolver()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.application.delete()
+        self.assertEqual(0, EffectivePermission.objects.count())
+
+    def test_single_query(self):
+        gp = GroupPermission.objects.create(profile_group=self.group_staff, application=self.application,
+                                            can_authenticate=True)
+        gp.groups.add(self.app_group)
+        self.profile.group.add(self.group_staff)
+        refresh_effective_permissions()
+
+        with self.assertNumQueries(1):
+            self.assertEqual(((True, False, False), ['staff_app_group']),
+                             resolve_permissions(self.user, self.application))
+
+    def test_rebuild_command(self):
+        gp = GroupPermission.objects.create(profile_group=self.group_default, application=self.application,
+                                            can_authenticate=True)
+        gp.groups.add(self.app_group)
+        EffectivePermission.objects.all().delete()
+
+        out = StringIO()
+        call_command('rebuild_effective_permissions', '--check', stdout=out)
+        self.assertIn('stored 2 effective permission rows', out.getvalue())
+        self.assertIn('no differences', out.getvalue())
+
+        EffectivePermission.objects.filter(user=self.user).update(is_staff=True)
+        with self.assertRaises(CommandError):
+            call_command('rebuild_effective_permissions', '--check-only', stdout=out, stderr=StringIO())
+
+
+@mock.patch.object(app_settings, 'JANUS_PERMISSION_CACHE_TTL', 60)
+class PermissionCacheTests(TestCase):
+    def setUp(self):
+        permission_cache.get_cache().clear()
+        self.group_staff = ProfileGroup.objects.create(name='staff')
+        self.user = User.objects.create(username='user')
+        self.profile = Profile.create_default_profile(self.user)
+        self.application = Application.objects.create(user=None,
+                                                      redirect_uris='https://localhost:8000/accounts/janus/login/callback/',
+                                                      client_type='confidential',
+                                                      authorization_grant_type='authorization-code',
+                                                      name='test', skip_authorization=True)
+        self.gp = GroupPermission.objects.create(profile_group=self.group_staff, application=self.application,
+                                                 can_authenticate=True)
+        self.gp.groups.add(ApplicationGroup.objects.create(application=self.application, name='staff_app_group'))
+
+    def test_cached_until_invalidated(self):
+        self.assertEqual(((False, False, False), []), resolve_permissions(self.user, self.application))
+        with self.assertNumQueries(0):
+            self.assertEqual((False, False, False), get_permissions(self.user, self.application))
+            self.assertEqual([], get_group_list(self.user, self.application))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.profile.group.add(self.group_staff)
+        self.assertEqual(((True, False, False), ['staff_app_group']),
+                         resolve_permissions(self.user, self.application))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.gp.is_staff = True
+            self.gp.save()
+        self.assertEqual((True, True, False), resolve_permissions(self.user, self.application)[0])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            ProfilePermission.objects.create(profile=self.profile, application=self.application, is_superuser=True)
+        self.assertEqual((True, True, True), resolve_permissions(self.user, self.application)[0])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.group_staff.delete()
+        self.assertEqual(((False, False, True), []), resolve_permissions(self.user, self.application))
+
+    def test_reference_is_not_cached(self):
+        self.assertEqual(((False, False, False), []), resolve_permissions(self.user, self.application))
+        # a change the cache does not know about yet
+        Profile.group.through.objects.create(profile=self.profile, profilegroup=self.group_staff)
+        self.assertEqual((False, False, False), get_permissions(self.user, self.application))
+        self.assertEqual([], get_group_list(self.user, self.application))
+        self.assertEqual((True, False, False), compute_permissions(self.user, self.application))
+        self.assertEqual(['staff_app_group'], compute_group_list(self.user, self.application))
+
+    def test_stats(self):
+        before = permission_cache.stats.get()
+        resolve_permissions(self.user, self.application)
+        resolve_permissions(self.user, self.application)
+        after = permission_cache.stats.get()
+        self.assertEqual(before['misses'] + 1, after['misses'])
+        self.assertEqual(before['hits'] + 1, after['hits'])
+
+    @mock.patch.object(permission_cache, 'LOCK_WAIT', 0.1)
+    def test_locked_entry_is_computed_after_waiting(self):
+        resolve_permissions(self.user, self.application)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.profile.group.add(self.group_staff)
+
+        # another worker is computing the entry but never finishes
+        cache = permission_cache.get_cache()
+        original_add = cache.add
+
+        def add(key, *args, **kwargs):
+            if key.endswith(':lock'):
+                return False
+            return original_add(key, *args, **kwargs)
+
+        with mock.patch.object(cache, 'add', side_effect=add):
+            self.assertEqual((True, False, False), resolve_permissions(self.user, self.application)[0])
+        self.assertGreaterEqual(permission_cache.stats.get()['lock_waits'], 1)
+
+
+class UserSessionIndexTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='bob', password='testjanus123')
+        self.other_user = User.objects.create_user(username='alice', password='testjanus123')
+        Profile.create_default_profile(self.user)
+        Profile.create_default_profile(self.other_user)
+        self.application = Application.objects.create(user=None,
+                                                      redirect_uris='https://localhost:8000/accounts/janus/login/callback/',
+                                                      client_type='confidential',
+                                                      authorization_grant_type='authorization-code',
+                                                      name='test', skip_authorization=True)
+
+    def login(self, username):
+        c = Client()
+        c.post(reverse('login'), dict(username=username, password='testjanus123'))
+        return c
+
+    def test_remote_logout_deletes_indexed_sessions(self):
+        bob_1 = self.login('bob')
+        bob_2 = self.login('bob')
+        alice = self.login('alice')
+        self.assertEqual(2, UserSession.objects.filter(user=self.user).count())
+
+        AccessToken.objects.create(user=self.user, application=self.application, token='logout-token',
+                                   expires=now() + timedelta(hours=1), scope='read')
+        response = Client().get(reverse('remote_logout'), dict(access_token='logout-token'))
+        self.assertEqual(response.status_code, 200)
+
+        self.assertFalse(Session.objects.filter(session_key__in=[bob_1.session.session_key,
+                                                                 bob_2.session.session_key]).exists())
+        self.assertTrue(Session.objects.filter(session_key=alice.session.session_key).exists())
+        self.assertFalse(UserSession.objects.filter(user=self.user).exists())
+        self.assertFalse(AccessToken.objects.filter(user=self.user).exists())
+
+    def test_logout_removes_index(self):
+        c = self.login('bob')
+        c.get(reverse('logout'))
+        self.assertFalse(UserSession.objects.exists())
+
+    def test_session_store_follows_key_rotation(self):
+        store = SessionStore()
+        store[SESSION_KEY] = str(self.user.pk)
+        store.save()
+        UserSession.objects.create(user=self.user, session_key=store.session_key)
+
+        old_key = store.session_key
+        store.cycle_key()
+        self.assertNotEqual(old_key, store.session_key)
+        self.assertEqual([store.session_key],
+                         list(UserSession.objects.filter(user=self.user).values_list('session_key', flat=True)))
+
+    def test_backfill(self):
+        c = self.login('bob')
+        self.login('alice')
+        UserSession.objects.all().delete()
+
+        out = StringIO()
+        call_command('backfill_user_sessions', stdout=out)
+        self.assertIn('indexed 2 sessions', out.getvalue())
+        self.assertEqual([c.session.session_key],
+                         list(UserSession.objects.filter(user=self.user).values_list('session_key', flat=True)))
+
+        # already indexed sessions are skipped
+        call_command('backfill_user_sessions', stdout=out)
+        self.assertEqual(2, UserSession.objects.count())
+
+
+class AuthenticationPermittedTests(TestCase):
+    def setUp(self):
+        permission_cache.get_cache().clear()
+        self.group_default = ProfileGroup.objects.create(name='default', default=True)
+        self.group_1 = ProfileGroup.objects.create(name='group 1')
+        self.user = User.objects.create(username='user')
+        self.profile = Profile.objects.create(user=self.user)
+        self.application = Application.objects.create(user=None,
+                                                      redirect_uris='https://localhost:8000/accounts/janus/login/callback/',
+                                                      client_type='confidential',
+                                                      authorization_grant_type='authorization-code',
+                                                      name='test', skip_authorization=True)
+
+    def assertDecision(self, expected):
+        with self.assertNumQueries(1):
+            self.assertEqual(expected, compute_authentication_permitted(self.user, self.application))
+        self.assertEqual(expected, get_permissions(self.user, self.application)[0])
+
+    def test_same_decision_as_get_permissions(self):
+        self.assertDecision(False)
+
+        # default groups apply without an explicit membership
+        gp_default = GroupPermission.objects.create(profile_group=self.group_default, application=self.application,
+                                                    can_authenticate=True)
+        self.assertDecision(True)
+
+        # an ambiguous group is ignored
+        GroupPermission.objects.create(profile_group=self.group_default, application=self.application)
+        self.assertDecision(False)
+        gp_default.delete()
+
+        self.profile.group.add(self.group_1)
+        GroupPermission.objects.create(profile_group=self.group_1, application=self.application,
+                                       can_authenticate=True)
+        self.assertDecision(True)
+
+        # the personal permission can only grant
+        pp = ProfilePermission.objects.create(profile=self.profile, application=self.application, is_staff=True)
+        self.assertDecision(True)
+        self.profile.group.remove(self.group_1)
+        self.assertDecision(False)
+        pp.can_authenticate = True
+        pp.save()
+        self.assertDecision(True)
+
+    def test_profile_permission_cannot_revoke_a_group_permission(self):
+        GroupPermission.objects.create(profile_group=self.group_default, application=self.application,
+                                       can_authenticate=True)
+        ProfilePermission.objects.create(profile=self.profile, application=self.application, can_authenticate=False)
+        self.assertDecision(True)
+
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('authorize'), {'client_id': self.application.client_id,
+                                                          'response_type': 'code'})
+        self.assertEqual(302, response.status_code)
+        self.assertNotEqual(reverse('not_authorized'), response.url)
+
+    @mock.patch.object(app_settings, 'JANUS_AUTHORIZE_DENY_CACHE_TTL', 30)
+    def test_denial_is_cached_until_permissions_change(self):
+        self.assertFalse(authentication_permitted(self.user, self.application))
+        with self.assertNumQueries(0):
+            self.assertFalse(authentication_permitted(self.user, self.application))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            ProfilePermission.objects.create(profile=self.profile, application=self.application,
+                                             can_authenticate=True)
+        self.assertTrue(authentication_permitted(self.user, self.application))
+
+    @mock.patch.object(app_settings, 'JANUS_AUTHORIZE_DENY_CACHE_TTL', 30)
+    def test_unknown_client_is_cached_until_created(self):
+        self.assertIsNone(authorize_application('unknown'))
+        with self.assertNumQueries(0):
+            self.assertIsNone(authorize_application('unknown'))
+
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('authorize'), {'client_id': 'unknown', 'response_type': 'code'})
+        self.assertRedirects(response, reverse('not_authorized'), fetch_redirect_response=False)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.application.client_id = 'unknown'
+            self.application.save()
+        self.assertEqual(self.application, authorize_application('unknown'))
+
+
+@mock.patch.object(app_settings, 'JANUS_APPLICATION_REGISTRY_TTL', 60)
+class ApplicationRegistryTests(TestCase):
+    def setUp(self):
+        permission_cache.get_cache().clear()
+        registry.invalidate()
+        self.application = Application.objects.create(user=None,
+                                                      redirect_uris='https://localhost:8000/accounts/janus/login/callback/',
+                                                      client_type='confidential',
+                                                      authorization_grant_type='authorization-code',
+                                                      name='test', skip_authorization=True)
+        self.extension = ApplicationExtension.objects.create(application=self.application, display_name='Test',
+                                                             link='https://example.com',
+                                                             profile_replace_json=json.dumps({'id': 'ident'}))
+
+    def test_read_through(self):
+        with self.assertNumQueries(1):
+            application = registry.get_application(self.application.client_id)
+            self.assertEqual(self.extension, registry.get_extension(application))
+        with self.assertNumQueries(0):
+            self.assertEqual(application, registry.get_application(self.application.client_id))
+            self.assertEqual(self.extension, registry.get_extension(application))
+            data = ProfileView._replace_keys_by_application({'id': 1}, application)
+        self.assertEqual({'ident': 1}, data)
+
+        with self.assertNumQueries(1):
+            self.assertEqual([{'name': 'Test', 'url': 'https://example.com'}],
+                             registry.get_launcher_applications())
+            registry.get_launcher_applications()
+
+        with self.assertRaises(Application.DoesNotExist):
+            registry.get_application('unknown')
+
+    def test_invalidated_by_other_process(self):
+        application = registry.get_application(self.application.client_id)
+        registry.get_launcher_applications()
+
+        # another worker changed the extension and bumped the shared version
+        ApplicationExtension.objects.filter(pk=self.extension.pk).update(display_name='Renamed',
+                                                                          email_required=True)
+        self.assertFalse(registry.get_extension(application).email_required)
+        permission_cache.get_cache().incr(REGISTRY_VERSION_KEY)
+
+        self.assertTrue(registry.get_extension(application).email_required)
+        self.assertEqual('Renamed', registry.get_launcher_applications()[0]['name'])
+
+    def test_invalidated_on_save(self):
+        registry.get_launcher_applications()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.extension.display_name = 'Saved'
+            self.extension.save()
+        self.assertEqual('Saved', registry.get_launcher_applications()[0]['name'])
+
+    def test_expires(self):
+        registry.get_launcher_applications()
+        ApplicationExtension.objects.filter(pk=self.extension.pk).update(display_name='Updated')
+        with mock.patch.object(app_settings, 'JANUS_APPLICATION_REGISTRY_TTL', 0.01):
+            time.sleep(0.02)
+            registry._sync()
+        self.assertEqual('Updated', registry.get_launcher_applications()[0]['name'])
+
+
+class EmailConfirmationTests(TestCase):
+    def setUp(self):
+        permission_cache.get_cache().clear()
+        self.user = User.objects.create(username='user', email='user@example.com')
+        Profile.create_default_profile(self.user)
+        self.application = Application.objects.create(user=None,
+                                                      redirect_uris='https://localhost:8000/accounts/janus/login/callback/',
+                                                      client_type='confidential',
+                                                      authorization_grant_type='authorization-code',
+                                                      name='test', skip_authorization=True)
+        ApplicationExtension.objects.create(application=self.application, email_required=True)
+        ProfilePermission.objects.create(profile=self.user.profile, application=self.application,
+                                         can_authenticate=True)
+        self.client.force_login(self.user)
+
+    def authorize(self):
+        return self.client.get(reverse('authorize'), {'client_id': self.application.client_id,
+                                                      'response_type': 'code',
+                                                      'redirect_uri': self.application.redirect_uris})
+
+    def test_sent_in_the_background_once_per_window(self):
+        # run the queued sends inline
+        with mock.patch('janus.confirmation.submit', side_effect=lambda name, workers, func, *args: func(*args)) \
+                as submit:
+            for _ in range(3):
+                with self.captureOnCommitCallbacks(execute=True):
+                    response = self.authorize()
+                self.assertRedirects(response, reverse('account_email_verification_sent'),
+                                     fetch_redirect_response=False)
+        self.assertEqual(1, submit.call_count)
+        self.assertEqual(1, len(mail.outbox))
+        self.assertEqual(['user@example.com'], mail.outbox[0].to)
+
+        with mock.patch.object(app_settings, 'JANUS_EMAIL_CONFIRMATION_WINDOW', 0), \
+                mock.patch('janus.confirmation.submit') as submit, self.captureOnCommitCallbacks(execute=True):
+            self.authorize()
+        submit.assert_called_once()
+
+    def test_celery(self):
+        with mock.patch.object(app_settings, 'JANUS_EMAIL_CONFIRMATION_CELERY', True), \
+                mock.patch('janus.tasks.email_confirmation.delay') as delay, \
+                self.captureOnCommitCallbacks(execute=True):
+            self.authorize()
+        delay.assert_called_once_with(self.user.pk)
+        self.assertEqual(0, len(mail.outbox))
+
+    def test_send_email_confirmation(self):
+        self.assertTrue(send_email_confirmation(self.user.pk))
+        self.assertTrue(send_email_confirmation(self.user.pk))
+        self.assertEqual(2, len(mail.outbox))
+
+        EmailAddress.objects.filter(user=self.user).update(verified=True)
+        self.assertFalse(send_email_confirmation(self.user.pk))
+        self.assertEqual(2, len(mail.outbox))
+
+
+class CleanupTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='user')
+        self.application = Application.objects.create(user=None,
+                                                      redirect_uris='https://localhost:8000/accounts/janus/login/callback/',
+                                                      client_type='confidential',
+                                                      authorization_grant_type='authorization-code',
+                                                      name='test', skip_authorization=True)
+        expired = now() - timedelta(hours=1)
+        valid = now() + timedelta(hours=1)
+
+        for i in range(5):
+            AccessToken.objects.create(user=self.user, application=self.application, token='expired-%d' % i,
+                                       expires=expired, scope='read')
+            Grant.objects.create(user=self.user, application=self.application, code='expired-%d' % i,
+                                 expires=expired, redirect_uri='https://localhost:8000/')
+        AccessToken.objects.create(user=self.user, application=self.application, token='valid', expires=valid,
+                                   scope='read')
+        Grant.objects.create(user=self.user, application=self.application, code='valid', expires=valid,
+                             redirect_uri='https://localhost:8000/')
+
+        # an expired access token with a refresh token is kept, the refresh token can still be used
+        with_refresh = AccessToken.objects.create(user=self.user, application=self.application,
+                                                  token='with-refresh', expires=expired, scope='read')
+        RefreshToken.objects.create(user=self.user, application=self.application, token='refresh',
+                                    access_token=with_refresh)
+
+        IDToken.objects.create(user=self.user, application=self.application, expires=expired)
+        id_token_in_use = IDToken.objects.create(user=self.user, application=self.application, expires=expired)
+        AccessToken.objects.create(user=self.user, application=self.application, token='with-id-token',
+                                   expires=valid, scope='openid', id_token=id_token_in_use)
+
+        Session.objects.create(session_key='expired', session_data='', expire_date=expired)
+        Session.objects.create(session_key='valid', session_data='', expire_date=valid)
+        UserSession.objects.create(user=self.user, session_key='expired')
+        UserSession.objects.create(user=self.user, session_key='valid')
+
+    def test_purge(self):
+        deleted = purge_expired(batch_size=2, batch_interval=0, time_budget=0)
+        self.assertEqual({'access tokens': 5, 'grants': 5, 'id tokens': 1, 'sessions': 1, 'user sessions': 1},
+                         deleted)
+        self.assertEqual({'valid', 'with-refresh', 'with-id-token'},
+                         set(AccessToken.objects.values_list('token', flat=True)))
+        self.assertEqual(['valid'], list(Grant.objects.values_list('code', flat=True)))
+        self.assertEqual([id_token.pk for id_token in IDToken.objects.all()],
+                         [AccessToken.objects.get(token='with-id-token').id_token_id])
+        self.assertEqual(['valid'], list(Session.objects.values_list('session_key', flat=True)))
+        self.assertEqual(['valid'], list(UserSession.objects.values_list('session_key', flat=True)))
+
+    def test_time_budget(self):
+        with mock.patch('janus.cleanup.time.monotonic', side_effect=[0, 0] + [10] * 10):
+            deleted = purge_expired(batch_size=2, batch_interval=0, time_budget=5)
+        self.assertEqual(2, deleted['access tokens'])
+        self.assertEqual(0, deleted['grants'])
+
+    def test_command(self):
+        out = StringIO()
+        call_command('cleanup_expired', '--batch-size', '3', '--batch-interval', '0', stdout=out)
+        self.assertIn('access tokens: 5 deleted', out.getvalue())
+        self.assertIn('sessions: 1 deleted', out.getvalue())
+
+
+class RelyingParty(object):
+    """
+    local stand-in for the back-channel logout endpoint of a relying party
+    """
+
+    def __init__(self, statuses=(200,), delay=0):
+        self.statuses = list(statuses)
+        self.delay = delay
+        self.received = []
+        self.done = threading.Event()
+        relying_party = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length'])).decode()
+                time.sleep(relying_party.delay)
+                status = relying_party.statuses.pop(0) if len(relying_party.statuses) > 1 \
+                    else relying_party.statuses[0]
+                relying_party.received.append((parse_qs(body)['logout_token'][0], status))
+                self.send_response(status)
+                self.end_headers()
+                if status == 200:
+                    relying_party.done.set()
+
+            def log_message(self, *args):
+                pass
+
+        self.server = HTTPServer(('127.0.0.1', 0), Handler)
+        self.uri = 'http://127.0.0.1:%d/logout' % self.server.server_port
+        threading.Thread(target=self.server.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class BackchannelLogoutTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.private_key = jwk.JWK.generate(kty='RSA', size=2048).export_to_pem(private_key=True,
+                                                                                password=None).decode()
+
+    def setUp(self):
+        patcher = mock.patch.object(oauth2_settings, 'OIDC_RSA_PRIVATE_KEY', self.private_key)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(oauth2_settings, 'OIDC_ISS_ENDPOINT', 'https://sso.example.com/o')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.user = User.objects.create(username='user')
+        Profile.create_default_profile(self.user)
+        self.relying_parties = []
+        self.applications = []
+        for name in ('fast', 'slow', 'unused'):
+            relying_party = RelyingParty(delay=1 if name == 'slow' else 0)
+            self.addCleanup(relying_party.stop)
+            application = Application.objects.create(user=None, client_id=name,
+                                                     redirect_uris='https://localhost:8000/accounts/janus/login/callback/',
+                                                     client_type='confidential',
+                                                     authorization_grant_type='authorization-code',
+                                                     name=name, skip_authorization=True)
+            ApplicationExtension.objects.create(application=application, backchannel_logout_uri=relying_party.uri)
+            self.relying_parties.append(relying_party)
+            self.applications.append(application)
+            if name != 'unused':
+                AccessToken.objects.create(user=self.user, application=application, token='token-' + name,
+                                           scope='read', expires=now() + timedelta(hours=1))
+
+    def test_logout_notifies_the_applications_concurrently(self):
+        fast, slow, unused = self.relying_parties
+        start = time.monotonic()
+        with self.captureOnCommitCallbacks(execute=True):
+            response = Client().get(reverse('remote_logout'), dict(access_token='token-fast'))
+        self.assertEqual(200, response.status_code)
+        # the logout does not wait for the slowest relying party
+        self.assertLess(time.monotonic() - start, 1)
+
+        self.assertTrue(fast.done.wait(5))
+        self.assertTrue(slow.done.wait(5))
+        self.assertEqual([], unused.received)
+
+        token, _ = fast.received[0]
+        claims = json.loads(jwt.JWT(jwt=token, key=self.verification_key()).claims)
+        self.assertEqual(('https://sso.example.com/o', 'fast', str(self.user.pk)),
+                         (claims['iss'], claims['aud'], claims['sub']))
+        self.assertIn(LOGOUT_EVENT, claims['events'])
+        self.assertEqual(claims['iat'] + LOGOUT_TOKEN_LIFETIME, claims['exp'])
+        self.assertNotIn('nonce', claims)
+
+    def verification_key(self):
+        return jwk.JWK.from_pem(self.private_key.encode())
+
+    def test_retry(self):
+        relying_party = RelyingParty(statuses=(503, 503, 200))
+        self.addCleanup(relying_party.stop)
+        self.assertTrue(send_logout_token(relying_party.uri, 'token', timeout=1, retries=3, backoff=0))
+        self.assertEqual([503, 503, 200], [status for _, status in relying_party.received])
+
+        # client errors and exhausted retries are not retried forever
+        rejecting = RelyingParty(statuses=(400,))
+        self.addCleanup(rejecting.stop)
+        self.assertFalse(send_logout_token(rejecting.uri, 'token', timeout=1, retries=3, backoff=0))
+        self.assertEqual(1, len(rejecting.received))
+
+    def test_timeout(self):
+        relying_party = RelyingParty(delay=1)
+        self.addCleanup(relying_party.stop)
+        self.assertFalse(send_logout_token(relying_party.uri, 'token', timeout=0.1, retries=1, backoff=0))
+
+    def test_celery(self):
+        with mock.patch.object(app_settings, 'JANUS_BACKCHANNEL_LOGOUT_CELERY', True), \
+                mock.patch('janus.tasks.backchannel_logout.delay') as delay, \
+                self.captureOnCommitCallbacks(execute=True):
+            Client().get(reverse('remote_logout'), dict(access_token='token-fast'))
+        self.assertEqual({self.relying_parties[0].uri, self.relying_parties[1].uri},
+                         {call.args[0] for call in delay.call_args_list})
+
+
+class RevocationTests(TestCase):
+    def setUp(self):
+        self.group = ProfileGroup.objects.create(name='group')
+        self.users = []
+        for name in ('alice', 'bob', 'eve'):
+            user = User.objects.create(username=name)
+            Profile.create_default_profile(user)
+            self.users.append(user)
+        self.users[0].profile.group.add(self.group)
+        self.users[1].profile.group.add(self.group)
+
+        self.applications = [Application.objects.create(user=None,
+                                                        redirect_uris='https://localhost:8000/accounts/janus/login/callback/',
+                                                        client_type='confidential',
+                                                        authorization_grant_type='authorization-code',
+                                                        name=name, skip_authorization=True)
+                             for name in ('one', 'two')]
+
+        valid = now() + timedelta(hours=1)
+        for user in self.users:
+            for application in self.applications:
+                for i in range(3):
+                    token = AccessToken.objects.create(user=user, application=application, expires=valid,
+                                                       token='%s-%s-%d' % (user.username, application.name, i),
+                                                       scope='read')
+                    RefreshToken.objects.create(user=user, application=application, access_token=token,
+                                                token='refresh-' + token.token)
+            Session.objects.create(session_key=user.username, session_data='', expire_date=valid)
+            UserSession.objects.create(user=user, session_key=user.username)
+
+    def remaining(self):
+        return set(AccessToken.objects.values_list('user__username', 'application__name').distinct())
+
+    def test_revoke_users(self):
+        deleted = revoke_tokens([self.users[0].pk], batch_size=2, batch_interval=0)
+        self.assertEqual((6, 6, 1, 1), (deleted['access tokens'], deleted['refresh tokens'], deleted['sessions'],
+                                        deleted['user sessions']))
+        self.assertNotIn('alice', {username for username, _ in self.remaining()})
+        self.assertFalse(RefreshToken.objects.filter(user=self.users[0]).exists())
+        self.assertEqual({'bob', 'eve'}, set(Session.objects.values_list('session_key', flat=True)))
+
+    def test_revoke_group_for_application(self):
+        deleted = revoke_group_tokens([self.group.pk], [self.applications[0].pk], batch_size=2, batch_interval=0)
+        self.assertEqual(6, deleted['access tokens'])
+        self.assertEqual({('alice', 'two'), ('bob', 'two'), ('eve', 'one'), ('eve', 'two')}, self.remaining())
+        self.assertEqual(['eve'], list(Session.objects.values_list('session_key', flat=True)))
+
+        # a default group has all users as members
+        self.group.default = True
+        self.group.save()
+        revoke_group_tokens([self.group.pk], [self.applications[1].pk], batch_interval=0)
+        self.assertEqual({('eve', 'one')}, self.remaining())
+
+    def test_revoke_everything_is_refused(self):
+        with self.assertRaises(ValueError):
+            revoke_tokens()
+
+    def test_command(self):
+        out = StringIO()
+        call_command('revoke_tokens', '--application', self.applications[1].client_id, '--user', 'eve',
+                     '--batch-interval', '0', stdout=out)
+        self.assertIn('access tokens: 3 deleted', out.getvalue())
+        self.assertNotIn(('eve', 'two'), self.remaining())
+        # sessions are not bound to an application, only the selected users lose them
+        self.assertEqual({'alice', 'bob'}, set(Session.objects.values_list('session_key', flat=True)))
+
+        with self.assertRaises(CommandError):
+            call_command('revoke_tokens', '--group', 'missing', stdout=out)
+
+    def test_admin_action(self):
+        admin = User.objects.create_superuser(username='admin', email='admin@example.com', password='admin')
+        Profile.create_default_profile(admin)
+        self.client.force_login(admin)
+        response = self.client.post(reverse('admin:oauth2_provider_application_changelist'),
+                                    {'action': 'revoke_application_tokens',
+                                     '_selected_action': [self.applications[0].pk]})
+        self.assertEqual(302, response.status_code)
+        self.assertEqual({'two'}, {name for _, name in self.remaining()})
+        # the sessions are kept, they are not bound to an application
+        self.assertEqual(3, Session.objects.filter(session_key__in=['alice', 'bob', 'eve']).count())
+
+    def test_admin_action_refuses_default_groups(self):
+        admin = User.objects.create_superuser(username='admin', email='admin@example.com', password='admin')
+        Profile.create_default_profile(admin)
+        self.client.force_login(admin)
+        default_group = ProfileGroup.objects.create(name='everyone', default=True)
+        response = self.client.post(reverse('admin:janus_profilegroup_changelist'),
+                                    {'action': 'revoke_member_tokens',
+                                     '_selected_action': [self.group.pk, default_group.pk]}, follow=True)
+        self.assertEqual(200, response.status_code)
+        self.assertIn('default groups cannot be revoked', [str(m) for m in response.context['messages']][0])
+        self.assertEqual(6, len(self.remaining()))
+
+
+class AdminApplicationGroupsTests(TestCase):
+    def setUp(self):
+        self.group_default = ProfileGroup.objects.create(name='default', default=True)
+        self.group_1 = ProfileGroup.objects.create(name='group 1')
+        self.user = User.objects.create(username='user')
+        self.profile = Profile.create_default_profile(self.user)
+        self.profile.group.add(self.group_1)
+
+    def add_applications(self, count):
+        for i in range(count):
+            application = Application.objects.create(user=None,
+                                                     redirect_uris='https://localhost:8000/accounts/janus/login/callback/',
+                                                     client_type='confidential',
+                                                     authorization_grant_type='authorization-code',
+                                                     name='app %03d' % i, skip_authorization=True)
+            app_group = ApplicationGroup.objects.create(application=application, name='group of %d' % i)
+            gp = GroupPermission.objects.create(profile_group=self.group_1, application=application,
+                                                can_authenticate=i % 2 == 0)
+            gp.groups.add(app_group)
+            GroupPermission.objects.create(profile_group=self.group_default, application=application,
+                                           is_staff=i % 3 == 0)
+            if i % 4 == 0:
+                ProfilePermission.objects.create(profile=self.profile, application=application, is_superuser=True)
+
+    def get_applications(self):
+        formset = ApplicationGroupFormSet(instance=self.user)
+        formset.instance = self.user
+        return formset.get_applications()
+
+    def test_matches_single_resolution(self):
+        self.add_applications(8)
+        applications = self.get_applications()
+        self.assertEqual(8, len(applications))
+        for entry, application in zip(applications, Application.objects.order_by('name')):
+            (can_authenticate, is_staff, is_superuser), groups = resolve_permissions(self.user, application)
+            self.assertEqual(entry['name'], application.name)
+            self.assertEqual((can_authenticate, is_staff, is_superuser),
+                             (entry['can_authenticate'], entry['is_staff'], entry['is_superuser']))
+            self.assertEqual(sorted(groups), entry['groups'])
+
+    def test_query_count_is_constant(self):
+        self.add_applications(2)
+        with self.assertNumQueries(7):
+            self.get_applications()
+        self.add_applications(20)
+        with self.assertNumQueries(7):
+            self.get_applications()
+
+
+class AdminChangelistQueryTests(TestCase):
+    def setUp(self):
+        self.admin = User.objects.create_superuser(username='admin', email='admin@example.com', password='admin')
+        Profile.create_default_profile(self.admin)
+        self.client.force_login(self.admin)
+        self.rows = 0
+
+    def add_rows(self, count):
+        for _ in range(count):
+            i = self.rows
+            self.rows += 1
+            user = User.objects.create(username='user %d' % i)
+            profile = Profile.create_default_profile(user)
+            group = ProfileGroup.objects.create(name='group %d' % i)
+            profile.group.add(group)
+            application = Application.objects.create(user=user,
+                                                     redirect_uris='https://localhost:8000/accounts/janus/login/callback/',
+                                                     client_type='confidential',
+                                                     authorization_grant_type='authorization-code',
+                                                     name='app %d' % i, skip_authorization=True)
+            ApplicationExtension.objects.create(application=application, email_required=True)
+            ApplicationGroup.objects.create(application=application, name='app group %d' % i)
+            ProfilePermission.objects.create(profile=profile, application=application)
+            GroupPermission.objects.create(profile_group=group, application=application)
+
+    def count_queries(self, url):
+        # warm up the caches of the session and the content types
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(200, response.status_code)
+        return len(queries)
+
+    def test_query_count_does_not_depend_on_page_size(self):
+        urls = [reverse('admin:%s_%s_changelist' % (model._meta.app_label, model._meta.model_name))
+                for model in (User, Application, ApplicationGroup, ProfilePermission, GroupPermission)]
+
+        self.add_rows(2)
+        few = [self.count_queries(url) for url in urls]
+        self.add_rows(20)
+        many = [self.count_queries(url) for url in urls]
+        self.assertEqual(dict(zip(urls, few)), dict(zip(urls, many)))
+
+
+@mock.patch.object(app_settings, 'JANUS_PROFILE_ETAG', True)
+class ProfileETagTests(TestCase):
+    def setUp(self):
+        permission_cache.get_cache().clear()
+        self.user = User.objects.create(username='user', first_name='first')
+        Profile.create_default_profile(self.user)
+        self.group = ProfileGroup.objects.create(name='group')
+        self.user.profile.group.add(self.group)
+        self.application = Application.objects.create(user=None,
+                                                      redirect_uris='https://localhost:8000/accounts/janus/login/callback/',
+                                                      client_type='confidential',
+                                                      authorization_grant_type='authorization-code',
+                                                      name='test', skip_authorization=True)
+        self.extension = ApplicationExtension.objects.create(application=self.application)
+        AccessToken.objects.create(user=self.user, application=self.application, token='token', scope='read',
+                                   expires=now() + timedelta(hours=1))
+
+    def get_profile(self, etag=None):
+        headers = {'HTTP_AUTHORIZATION': 'Bearer token'}
+        if etag:
+            headers['HTTP_IF_NONE_MATCH'] = etag
+        return self.client.get(reverse('profile'), **headers)
+
+    def assertChanged(self, etag):
+        response = self.get_profile(etag)
+        self.assertEqual(200, response.status_code)
+        self.assertNotEqual(etag, response['ETag'])
+        return response['ETag']
+
+    def test_not_modified(self):
+        response = self.get_profile()
+        self.assertEqual(200, response.status_code)
+        etag = response['ETag']
+
+        with mock.patch('janus.views.resolve_permissions') as resolve:
+            response = self.get_profile(etag)
+        self.assertEqual(304, response.status_code)
+        self.assertEqual(etag, response['ETag'])
+        resolve.assert_not_called()
+
+        self.assertEqual(200, self.get_profile('"other"').status_code)
+
+    def test_changes_with_every_input(self):
+        etag = self.get_profile()['ETag']
+
+        with self.captureOnCommitCallbacks(execute=True):
+            gp = GroupPermission.objects.create(profile_group=self.group, application=self.application,
+                                                is_staff=True)
+        etag = self.assertChanged(etag)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            gp.groups.add(ApplicationGroup.objects.create(application=self.application, name='app group'))
+        etag = self.assertChanged(etag)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.profile.group.remove(self.group)
+        etag = self.assertChanged(etag)
+
+        self.user.first_name = 'changed'
+        self.user.save()
+        etag = self.assertChanged(etag)
+
+        self.extension.profile_replace_json = '{"id": "username"}'
+        self.extension.save()
+        etag = self.assertChanged(etag)
+        self.assertEqual(304, self.get_profile(etag).status_code)
+
+
+class ProfileFieldsTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='user', first_name='Jon', email='user@example.com')
+        Profile.create_default_profile(self.user)
+        self.application = Application.objects.create(user=None,
+                                                      redirect_uris='https://localhost:8000/accounts/janus/login/callback/',
+                                                      client_type='confidential',
+                                                      authorization_grant_type='authorization-code',
+                                                      name='test', skip_authorization=True)
+        self.extension = ApplicationExtension.objects.create(application=self.application)
+        profile_permission = ProfilePermission.objects.create(profile=self.user.profile,
+                                                              application=self.application, can_authenticate=True)
+        profile_permission.groups.add(ApplicationGroup.objects.create(application=self.application, name='staff'))
+        AccessToken.objects.create(user=self.user, application=self.application, token='token', scope='read',
+                                   expires=now() + timedelta(hours=1))
+
+    def get_profile(self, fields=None):
+        data = {'fields': fields} if fields is not None else {}
+        response = self.client.get(reverse('profile'), data, HTTP_AUTHORIZATION='Bearer token')
+        self.assertEqual(200, response.status_code)
+        return response.json()
+
+    def test_identity_fields_skip_the_resolvers(self):
+        with mock.patch('janus.views.resolve_permissions') as resolve, \
+                mock.patch('janus.views.get_permissions') as permissions, \
+                mock.patch('janus.views.get_group_list') as groups:
+            self.assertEqual({'id': 'user', 'email': 'user@example.com'}, self.get_profile('id,email'))
+        resolve.assert_not_called()
+        permissions.assert_not_called()
+        groups.assert_not_called()
+
+        with mock.patch('janus.views.get_permissions', wraps=get_permissions) as permissions:
+            self.assertEqual({'id': 'user', 'groups': ['staff']}, self.get_profile('id, groups'))
+        permissions.assert_not_called()
+
+        self.assertEqual({'can_authenticate': True, 'is_staff': False}, self.get_profile('can_authenticate,is_staff'))
+
+    def test_fewer_queries(self):
+        self.get_profile()
+        with CaptureQueriesContext(connection) as full:
+            self.get_profile()
+        with CaptureQueriesContext(connection) as identity:
+            self.get_profile('id')
+        self.assertLess(len(identity), len(full))
+
+    @mock.patch.object(app_settings, 'JANUS_APPLICATION_REGISTRY_TTL', 60)
+    def test_validated_token_is_reused(self):
+        registry.invalidate()
+        self.get_profile('id')
+        # the token is loaded with its user and application by the validation, the extension comes from the registry
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual({'id': 'user'}, self.get_profile('id'))
+        self.assertEqual(1, len(queries), queries.captured_queries)
+
+    def test_application_default(self):
+        self.extension.profile_fields = 'id,groups'
+        self.extension.profile_replace_json = json.dumps({'id': 'username'})
+        self.extension.save()
+        self.assertEqual({'username': 'user', 'groups': ['staff']}, self.get_profile())
+        # the replaced keys are accepted, the request cannot widen the application's fields
+        self.assertEqual({'username': 'user'}, self.get_profile('username,email'))
+        self.assertEqual({}, self.get_profile('email'))
+
+    @mock.patch.object(app_settings, 'JANUS_PROFILE_ETAG', True)
+    def test_etag_depends_on_the_fields(self):
+        etags = set()
+        for fields in (None, 'id', 'id,groups', 'email'):
+            data = {'fields': fields} if fields is not None else {}
+            etags.add(self.client.get(reverse('profile'), data, HTTP_AUTHORIZATION='Bearer token')['ETag'])
+        self.assertEqual(4, len(etags))
+
+
+class ProfileBatchTests(TestCase):
+    def setUp(self):
+        self.application = Application.objects.create(user=None, redirect_uris='', client_type='confidential',
+                                                      authorization_grant_type='client-credentials', name='sync')
+        ApplicationExtension.objects.create(application=self.application, profile_replace_json='{"id": "username"}')
+        self.group = ProfileGroup.objects.create(name='members')
+        gp = GroupPermission.objects.create(profile_group=self.group, application=self.application,
+                                            can_authenticate=True, is_staff=True)
+        gp.groups.add(ApplicationGroup.objects.create(application=self.application, name='member'))
+        self.alice = self.add_user('alice')
+        self.bob = User.objects.create(username='bob')
+        Profile.create_default_profile(self.bob)
+        AccessToken.objects.create(user=None, application=self.application, token='client', scope='read',
+                                   expires=now() + timedelta(hours=1))
+
+    def add_user(self, username):
+        user = User.objects.create(username=username, first_name=username)
+        Profile.create_default_profile(user).group.add(self.group)
+        return user
+
+    def post(self, data, token='client'):
+        return self.client.post(reverse('profile_batch'), json.dumps(data), content_type='application/json',
+                                HTTP_AUTHORIZATION='Bearer ' + token)
+
+    def test_profiles(self):
+        response = self.post({'usernames': ['alice', 'bob', 'unknown'], 'ids': [self.alice.pk]})
+        self.assertEqual(200, response.status_code)
+        data = response.json()
+        self.assertEqual(['bob', 'unknown'], data['not_found'])
+        self.assertEqual(1, len(data['profiles']))
+        profile = data['profiles'][0]
+        self.assertEqual('alice', profile['username'])
+        self.assertNotIn('id', profile)
+        self.assertTrue(profile['is_staff'])
+        self.assertEqual(['member'], profile['groups'])
+
+    def test_effective_permission_table(self):
+        live = self.post({'usernames': ['alice', 'bob']}).json()
+        with mock.patch.object(app_settings, 'JANUS_EFFECTIVE_PERMISSIONS', True):
+            refresh_effective_permissions()
+            self.assertEqual(live, self.post({'usernames': ['alice', 'bob']}).json())
+
+    def test_same_payload_as_profile_view(self):
+        AccessToken.objects.create(user=self.alice, application=self.application, token='alice', scope='read',
+                                   expires=now() + timedelta(hours=1))
+        single = self.client.get(reverse('profile'), HTTP_AUTHORIZATION='Bearer alice').json()
+        self.assertEqual([single], self.post({'usernames': ['alice']}).json()['profiles'])
+
+    def test_query_count_does_not_depend_on_users(self):
+        with CaptureQueriesContext(connection) as few:
+            self.post({'usernames': ['alice']})
+        for i in range(20):
+            self.add_user('user %d' % i)
+        with CaptureQueriesContext(connection) as many:
+            response = self.post({'usernames': ['alice'] + ['user %d' % i for i in range(20)]})
+        self.assertEqual(21, len(response.json()['profiles']))
+        self.assertEqual(len(few), len(many))
+
+    def test_rejected_requests(self):
+        AccessToken.objects.create(user=self.alice, application=self.application, token='alice', scope='read',
+                                   expires=now() + timedelta(hours=1))
+        self.assertEqual(403, self.post({'usernames': ['alice']}, token='alice').status_code)
+        self.assertEqual(403, self.post({'usernames': ['alice']}, token='invalid').status_code)
+        self.assertEqual(400, self.post({'ids': ['x']}).status_code)
+        with mock.patch.object(app_settings, 'JANUS_PROFILE_BATCH_LIMIT', 1):
+            self.assertEqual(400, self.post({'usernames': ['alice', 'bob']}).status_code)
+
+
+class OIDCClaimsTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='user', first_name='Jon', last_name='Doe')
+        Profile.create_default_profile(self.user)
+        self.application = Application.objects.create(user=None,
+                                                      redirect_uris='https://localhost:8000/accounts/janus/login/callback/',
+                                                      client_type='confidential',
+                                                      authorization_grant_type='authorization-code',
+                                                      name='test', skip_authorization=True)
+        group = ProfileGroup.objects.create(name='everyone', default=True)
+        gp = GroupPermission.objects.create(profile_group=group, application=self.application,
+                                            can_authenticate=True, is_staff=True)
+        gp.groups.add(ApplicationGroup.objects.create(application=self.application, name='staff'))
+
+    def get_claims(self, scopes):
+        request = OAuthRequest('https://localhost/o/userinfo/')
+        request.user = self.user
+        request.client = self.application
+        request.scopes = scopes
+        return JanusOAuth2Validator().get_oidc_claims(None, None, request)
+
+    def test_permissions_are_not_resolved_without_the_extra_scope(self):
+        with mock.patch('janus.oauth2.validator.resolve_permissions', wraps=resolve_permissions) as resolve, \
+                self.assertNumQueries(0):
+            claims = self.get_claims(['openid', 'profile'])
+        resolve.assert_not_called()
+        self.assertEqual('Jon Doe', claims['name'])
+        self.assertNotIn('is_staff', claims)
+        self.assertNotIn('email_verified', claims)
+
+    def test_one_resolution_for_all_permission_claims(self):
+        with mock.patch('janus.oauth2.validator.resolve_permissions', wraps=resolve_permissions) as resolve:
+            claims = self.get_claims(['openid', 'email', app_settings.JANUS_OIDC_SCOPE_EXTRA])
+        self.assertEqual(1, resolve.call_count)
+        self.assertEqual((True, True, False, ['staff'], False),
+                         (claims['can_authenticate'], claims['is_staff'], claims['is_superuser'], claims['groups'],
+                          claims['email_verified']))
+        self.assertNotIn('name', claims)
+
+
+class ProfileSnapshotTests(TestCase):
+    def setUp(self):
+        # the snapshot is stored when the token of the fixture is created
+        patcher = mock.patch.object(app_settings, 'JANUS_PROFILE_SNAPSHOT', True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.user = User.objects.create(username='user', first_name='Jon', last_name='Doe')
+        Profile.create_default_profile(self.user)
+        self.group = ProfileGroup.objects.create(name='group')
+        self.user.profile.group.add(self.group)
+        self.application = Application.objects.create(user=None,
+                                                      redirect_uris='https://localhost:8000/accounts/janus/login/callback/',
+                                                      client_type='confidential',
+                                                      authorization_grant_type='authorization-code',
+                                                      name='test', skip_authorization=True)
+        self.gp = GroupPermission.objects.create(profile_group=self.group, application=self.application,
+                                                 can_authenticate=True)
+        self.token = AccessToken.objects.create(user=self.user, application=self.application, token='token',
+                                                scope='read', expires=now() + timedelta(hours=1))
+
+    def get_profile(self):
+        return self.client.get(reverse('profile'), HTTP_AUTHORIZATION='Bearer token')
+
+    def test_snapshot_is_stored_at_issuance(self):
+        data = ProfileSnapshot.objects.get(access_token=self.token).data
+        self.assertEqual(('user', True, False), (data['id'], data['can_authenticate'], data['is_staff']))
+
+        # client credentials tokens have no user and no snapshot
+        token = AccessToken.objects.create(user=None, application=self.application, token='client', scope='read',
+                                           expires=now() + timedelta(hours=1))
+        self.assertFalse(ProfileSnapshot.objects.filter(access_token=token).exists())
+
+    def test_profile_is_served_from_the_snapshot(self):
+        with mock.patch('janus.views.resolve_permissions') as resolve:
+            response = self.get_profile()
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(response.json()['can_authenticate'])
+        resolve.assert_not_called()
+
+    def test_userinfo_claims_from_the_snapshot(self):
+        request = OAuthRequest('https://localhost/o/userinfo/')
+        request.user = self.user
+        request.client = self.application
+        request.scopes = ['openid', app_settings.JANUS_OIDC_SCOPE_EXTRA]
+        request.access_token = JanusOAuth2Validator()._load_access_token('token')
+        with mock.patch('janus.oauth2.validator.resolve_permissions') as resolve:
+            claims = JanusOAuth2Validator().get_oidc_claims(None, None, request)
+        resolve.assert_not_called()
+        self.assertTrue(claims['can_authenticate'])
+
+    def test_changes_invalidate_the_snapshot(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.gp.is_staff = True
+            self.gp.save()
+        self.assertFalse(ProfileSnapshot.objects.filter(access_token=self.token).exists())
+        # falls back to the live profile
+        self.assertTrue(self.get_profile().json()['is_staff'])
+
+        self.token.save()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.email = 'user@example.com'
+            self.user.save()
+        self.assertFalse(ProfileSnapshot.objects.filter(access_token=self.token).exists())
+
+        # a login keeps the snapshot
+        self.token.save()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.last_login = now()
+            self.user.save(update_fields=['last_login'])
+        self.assertTrue(ProfileSnapshot.objects.filter(access_token=self.token).exists())
+
+
+class SignedAccessTokenTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.private_key = jwk.JWK.generate(kty='RSA', size=2048).export_to_pem(private_key=True,
+                                                                                password=None).decode()
+
+    def setUp(self):
+        for name, value in (('OIDC_RSA_PRIVATE_KEY', self.private_key),
+                            ('OAUTH2_VALIDATOR_CLASS', JanusOAuth2Validator),
+                            ('ACCESS_TOKEN_GENERATOR', signed_token_generator),
+                            ('REFRESH_TOKEN_GENERATOR', random_token_generator),
+                            ('ALWAYS_RELOAD_OAUTHLIB_CORE', True)):
+            patcher = mock.patch.object(oauth2_settings, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(self.clear_oauthlib_cores)
+
+        self.user = User.objects.create(username='user')
+        Profile.create_default_profile(self.user)
+        self.application = Application.objects.create(user=None, client_id='client', client_secret='secret',
+                                                      redirect_uris='https://localhost:8000/accounts/janus/login/callback/',
+                                                      client_type='confidential',
+                                                      authorization_grant_type='client-credentials', name='test')
+        group = ProfileGroup.objects.create(name='everyone', default=True)
+        gp = GroupPermission.objects.create(profile_group=group, application=self.application,
+                                            can_authenticate=True, is_staff=True)
+        gp.groups.add(ApplicationGroup.objects.create(application=self.application, name='staff'))
+
+    @staticmethod
+    def clear_oauthlib_cores():
+        # the views cache the server with the patched validator and token generator
+        for view in (ProfileView, TokenView):
+            if '_oauthlib_core' in view.__dict__:
+                del view._oauthlib_core
+
+    def issue_token(self, user=None, expires_in=3600):
+        request = OAuthRequest('https://localhost/o/token/')
+        request.user = user or self.user
+        request.client = self.application
+        request.scopes = ['read', 'write']
+        request.expires_in = expires_in
+        token = signed_token_generator(request)
+        AccessToken.objects.create(user=request.user, application=self.application, token=token,
+                                   scope='read write', expires=now() + timedelta(seconds=expires_in))
+        return token
+
+    def test_claims(self):
+        token = self.issue_token()
+        claims = verify_signed_token(token)
+        self.assertEqual(str(self.user.pk), claims['sub'])
+        self.assertEqual('client', claims['client_id'])
+        self.assertEqual((True, True, False, ['staff'], False),
+                         (claims['can_authenticate'], claims['is_staff'], claims['is_superuser'], claims['groups'],
+                          claims['email_verified']))
+
+        self.assertIsNone(verify_signed_token(token[:-4] + 'AAAA'))
+        self.assertIsNone(verify_signed_token(self.issue_token(expires_in=-10)))
+
+    def test_other_token_types_are_rejected(self):
+        key = jwk.JWK.from_pem(self.private_key.encode())
+        claims = verify_signed_token(self.issue_token())
+        for typ in ('JWT', 'logout+jwt', None):
+            header = {'alg': 'RS256', 'kid': key.thumbprint()}
+            if typ:
+                header['typ'] = typ
+            token = jwt.JWT(header=header, claims=claims)
+            token.make_signed_token(key)
+            self.assertIsNone(verify_signed_token(token.serialize()))
+        self.assertIsNone(verify_signed_token('not.a.token'))
+
+    def test_stored_as_digest(self):
+        token = self.issue_token()
+        self.assertFalse(AccessToken.objects.filter(token=token).exists())
+        self.assertTrue(AccessToken.objects.filter(token=stored_token(token)).exists())
+
+        response = self.client.get(reverse('profile'), HTTP_AUTHORIZATION='Bearer ' + token)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(['staff'], response.json()['groups'])
+
+        self.assertEqual(200, self.client.get(reverse('remote_logout'), {'access_token': token}).status_code)
+        self.assertFalse(AccessToken.objects.filter(user=self.user).exists())
+
+    def test_client_credentials_token_endpoint(self):
+        response = self.client.post(reverse('oauth2_provider:token'), {'grant_type': 'client_credentials'},
+                                    HTTP_AUTHORIZATION='Basic ' + base64.b64encode(b'client:secret').decode())
+        self.assertEqual(200, response.status_code)
+        token = response.json()['access_token']
+        claims = verify_signed_token(token)
+        self.assertNotIn('sub', claims)
+        self.assertNotIn('groups', claims)
+        self.assertIsNone(AccessToken.objects.get(token=stored_token(token)).user)
+
+    def test_validate_locally_without_queries(self):
+        token = self.issue_token()
+        validator = JanusOAuth2Validator()
+        with mock.patch.object(app_settings, 'JANUS_JWT_VALIDATE_LOCALLY', True), \
+                mock.patch.object(app_settings, 'JANUS_APPLICATION_REGISTRY_TTL', 60):
+            registry.invalidate()
+            registry.get_application('client')
+            request = OAuthRequest('https://localhost/o/profile/')
+            with self.assertNumQueries(0):
+                self.assertTrue(validator.validate_bearer_token(token, ['read'], request))
+            self.assertEqual(self.application, request.client)
+            self.assertEqual(self.user.pk, request.user.pk)
+
+            self.assertFalse(validator.validate_bearer_token(token, ['admin'], OAuthRequest('/')))
+            self.assertFalse(validator.validate_bearer_token(token[:-4] + 'AAAA', ['read'], OAuthRequest('/')))
+            registry.invalidate()
+
+    def test_profile_loads_the_user_once(self):
+        token = self.issue_token()
+        with mock.patch.object(app_settings, 'JANUS_JWT_VALIDATE_LOCALLY', True), \
+                mock.patch.object(app_settings, 'JANUS_APPLICATION_REGISTRY_TTL', 60):
+            registry.invalidate()
+            registry.get_application('client')
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(reverse('profile'), HTTP_AUTHORIZATION='Bearer ' + token)
+            registry.invalidate()
+        self.assertEqual(200, response.status_code)
+        user_queries = [q['sql'] for q in queries.captured_queries if q['sql'].startswith('SELECT "auth_user"')]
+        self.assertEqual(1, len(user_queries), user_queries)
+
+    def test_refresh_tokens_must_not_be_signed(self):
+        check_token_generators()
+        for generator in (None, signed_token_generator):
+            with mock.patch.object(oauth2_settings, 'REFRESH_TOKEN_GENERATOR', generator), \
+                    self.assertRaises(ImproperlyConfigured):
+                check_token_generators()
+
+    def test_other_generators_are_stored_unchanged(self):
+        with mock.patch.object(oauth2_settings, 'ACCESS_TOKEN_GENERATOR', None):
+            self.assertEqual('a.b.c', stored_token('a.b.c'))
+            AccessToken.objects.create(user=self.user, application=self.application, token='a.b.c', scope='read',
+                                       expires=now() + timedelta(hours=1))
+        self.assertTrue(AccessToken.objects.filter(token='a.b.c').exists())
+
+    @mock.patch.object(oauth2_settings, 'REFRESH_TOKEN_GRACE_PERIOD_SECONDS', 60)
+    def test_refresh_within_grace_period(self):
+        self.application.authorization_grant_type = 'authorization-code'
+        self.application.save()
+        token = self.issue_token()
+        RefreshToken.objects.create(user=self.user, application=self.application, token='refresh',
+                                    access_token=AccessToken.objects.get(token=stored_token(token)))
+
+        tokens = []
+        for i in range(2):
+            response = self.client.post(reverse('oauth2_provider:token'),
+                                        {'grant_type': 'refresh_token', 'refresh_token': 'refresh'},
+                                        HTTP_AUTHORIZATION='Basic ' + base64.b64encode(b'client:secret').decode())
+            self.assertEqual(200, response.status_code)
+            tokens.append(response.json()['access_token'])
+
+        # the second response repeats the previous token, it is signed again as the digest cannot be restored
+        self.assertEqual(str(self.user.pk), verify_signed_token(tokens[1])['sub'])
+        self.assertEqual(1, AccessToken.objects.filter(user=self.user).count())
+        response = self.client.get(reverse('profile'), HTTP_AUTHORIZATION='Bearer ' + tokens[1])
+        self.assertEqual(200, response.status_code)
+
+
+class TokenCacheTests(TestCase):
+    def setUp(self):
+        for name, value in (('JANUS_TOKEN_CACHE_TTL', 60), ('JANUS_APPLICATION_REGISTRY_TTL', 60)):
+            patcher = mock.patch.object(app_settings, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        for name, value in (('OAUTH2_VALIDATOR_CLASS', JanusOAuth2Validator), ('ALWAYS_RELOAD_OAUTHLIB_CORE', True)):
+            patcher = mock.patch.object(oauth2_settings, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(SignedAccessTokenTests.clear_oauthlib_cores)
+        permission_cache.get_cache().clear()
+        registry.invalidate()
+        self.addCleanup(registry.invalidate)
+
+        self.user = User.objects.create(username='user')
+        self.application = Application.objects.create(user=None, client_id='client',
+                                                      redirect_uris='https://localhost:8000/accounts/janus/login/callback/',
+                                                      client_type='confidential',
+                                                      authorization_grant_type='authorization-code', name='test')
+        self.token = AccessToken.objects.create(user=self.user, application=self.application, token='token',
+                                                scope='read write', expires=now() + timedelta(hours=1))
+        self.validator = JanusOAuth2Validator()
+
+    def validate(self, token='token', scopes=('read',)):
+        request = OAuthRequest('https://localhost/o/profile/')
+        return self.validator.validate_bearer_token(token, list(scopes), request), request
+
+    def test_cached_validation_without_queries(self):
+        self.assertTrue(self.validate()[0])
+        registry.get_application('client')
+        with self.assertNumQueries(0):
+            valid, request = self.validate()
+        self.assertTrue(valid)
+        self.assertEqual(self.application, request.client)
+        self.assertEqual(self.token.pk, request.access_token.pk)
+        self.assertEqual(['read', 'write'], request.scopes)
+        self.assertEqual(self.user.pk, request.user.pk)
+
+        with self.assertNumQueries(0):
+            self.assertFalse(self.validate(scopes=['admin'])[0])
+        self.assertFalse(self.validate('unknown')[0])
+
+    def get_profile(self):
+        response = self.client.get(reverse('profile'), {'fields': 'id'}, HTTP_AUTHORIZATION='Bearer token')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual({'id': 'user'}, response.json())
+
+    def test_cached_profile_loads_the_user_once(self):
+        ApplicationExtension.objects.create(application=self.application)
+        self.get_profile()
+        registry.get_application('client')
+        with CaptureQueriesContext(connection) as queries:
+            self.get_profile()
+        self.assertEqual(1, len(queries), queries.captured_queries)
+        self.assertTrue(queries.captured_queries[0]['sql'].startswith('SELECT "auth_user"'))
+
+    def test_not_used_without_registry(self):
+        ApplicationExtension.objects.create(application=self.application)
+        with mock.patch.object(app_settings, 'JANUS_APPLICATION_REGISTRY_TTL', 0):
+            self.get_profile()
+            self.assertIsNone(permission_cache.get_token('token'))
+            # the token is loaded with its user and application, the extension is queried without the registry
+            with self.assertNumQueries(2):
+                self.get_profile()
+
+    def test_deleted_token_is_forgotten(self):
+        self.assertTrue(self.validate()[0])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(200, self.client.get(reverse('remote_logout'), {'access_token': 'token'}).status_code)
+        self.assertFalse(AccessToken.objects.filter(user=self.user).exists())
+        self.assertFalse(self.validate()[0])
+
+    def test_refreshed_token_is_forgotten(self):
+        self.assertTrue(self.validate()[0])
+        self.token.token = 'refreshed'
+        with self.captureOnCommitCallbacks(execute=True):
+            self.token.save()
+        self.assertFalse(self.validate()[0])
+        self.assertTrue(self.validate('refreshed')[0])
+
+    def test_never_outlives_the_token(self):
+        self.assertTrue(self.validate()[0])
+        with mock.patch('janus.cache.time.time', return_value=time.time() + 3601):
+            self.assertIsNone(permission_cache.get_token('token'))
+
+        self.token.expires = now() + timedelta(seconds=30)
+        with mock.patch.object(permission_cache, 'get_cache') as get_cache:
+            permission_cache.remember_token(self.token)
+            self.token.expires = now() - timedelta(seconds=1)
+            permission_cache.remember_token(self.token)
+        self.assertEqual(1, get_cache().set.call_count)
+        self.assertIn(get_cache().set.call_args[1]['timeout'], (29, 30))
+
+    def test_disabled(self):
+        with mock.patch.object(app_settings, 'JANUS_TOKEN_CACHE_TTL', 0):
+            self.assertTrue(self.validate()[0])
+        self.assertIsNone(permission_cache.get_token('token'))
+
+
+class InstrumentationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='user')
+        Profile.create_default_profile(self.user)
+        self.application = Application.objects.create(user=None,
+                                                      redirect_uris='https://localhost:8000/accounts/janus/login/callback/',
+                                                      client_type='confidential',
+                                                      authorization_grant_type='authorization-code',
+                                                      name='test', skip_authorization=True)
+        AccessToken.objects.create(user=self.user, application=self.application, token='token', scope='read',
+                                   expires=now() + timedelta(hours=1))
+
+    def get_profile(self):
+        return self.client.get(reverse('profile'), HTTP_AUTHORIZATION='Bearer token')
+
+    def test_disabled_by_default(self):
+        response = self.get_profile()
+        self.assertEqual(200, response.status_code)
+        self.assertNotIn('Server-Timing', response)
+
+    def test_server_timing_and_log_record(self):
+        with mock.patch.object(app_settings, 'JANUS_INSTRUMENTATION', True), \
+                self.assertLogs('janus.instrumentation', 'INFO') as logs:
+            with CaptureQueriesContext(connection) as queries:
+                response = self.get_profile()
+        self.assertEqual(200, response.status_code)
+
+        timings = [entry.split(';')[0] for entry in response['Server-Timing'].split(', ')]
+        self.assertEqual(['profile', 'token_validation', 'token', 'permissions', 'profile_data', 'replace_keys'],
+                         timings)
+        self.assertIn('profile;dur=', response['Server-Timing'])
+
+        record = logs.records[0].janus_timing
+        self.assertEqual('profile', record['view'])
+        # the middleware queries are not part of the view
+        self.assertLessEqual(record['queries'], len(queries))
+        stages = {stage['name']: stage['queries'] for stage in record['stages']}
+        self.assertEqual(record['queries'], stages['token_validation'] + stages['token'] + stages['profile_data']
+                         + stages['replace_keys'])
+
+    def test_query_budget(self):
+        with mock.patch.object(app_settings, 'JANUS_INSTRUMENTATION', True), \
+                mock.patch.object(app_settings, 'JANUS_QUERY_BUDGETS', {'profile': 1}), \
+                self.assertLogs('janus.instrumentation', 'WARNING') as logs:
+            self.get_profile()
+        self.assertIn('profile exceeded its query budget', logs.output[0])
+
+        with mock.patch.object(app_settings, 'JANUS_INSTRUMENTATION', True), \
+                mock.patch.object(app_settings, 'JANUS_QUERY_BUDGETS', {'profile': 100}), \
+                mock.patch('janus.instrumentation.logger.warning') as warning:
+            self.get_profile()
+        warning.assert_not_called()
+
+    def test_logout_stages(self):
+        with mock.patch.object(app_settings, 'JANUS_INSTRUMENTATION', True):
+            response = self.client.get(reverse('remote_logout'), {'access_token': 'token'})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(['logout', 'token', 'backchannel', 'sessions', 'tokens'],
+                         [entry.split(';')[0] for entry in response['Server-Timing'].split(', ')])
+
+
+@mock.patch.object(app_settings, 'JANUS_METRICS', True)
+class MetricsTests(TestCase):
+    def setUp(self):
+        # drop the counts of the previous tests
+        janus_metrics.flush()
+        permission_cache.stats.flush()
+        permission_cache.get_cache().clear()
+        self.user = User.objects.create(username='user')
+        Profile.create_default_profile(self.user)
+        self.application = Application.objects.create(user=None,
+                                                      redirect_uris='https://localhost:8000/accounts/janus/login/callback/',
+                                                      client_type='confidential',
+                                                      authorization_grant_type='authorization-code',
+                                                      name='test', client_id='test-client', skip_authorization=True)
+        AccessToken.objects.create(user=self.user, application=self.application, token='token', scope='read',
+                                   expires=now() + timedelta(hours=1))
+        for name, value in (('OAUTH2_VALIDATOR_CLASS', JanusOAuth2Validator), ('ALWAYS_RELOAD_OAUTHLIB_CORE', True)):
+            patcher = mock.patch.object(oauth2_settings, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(SignedAccessTokenTests.clear_oauthlib_cores)
+
+    def scrape(self):
+        with mock.patch.object(app_settings, 'JANUS_METRICS_TOKEN', 'secret'):
+            response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(200, response.status_code)
+        return response.content.decode().splitlines()
+
+    def test_access(self):
+        with mock.patch.object(app_settings, 'JANUS_METRICS', False):
+            self.assertEqual(404, self.client.get(reverse('metrics')).status_code)
+        self.assertEqual(403, self.client.get(reverse('metrics')).status_code)
+        with mock.patch.object(app_settings, 'JANUS_METRICS_TOKEN', 'secret'):
+            self.assertEqual(401, self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer wrong').status_code)
+
+        self.client.force_login(User.objects.create(username='admin', is_staff=True))
+        self.assertEqual(200, self.client.get(reverse('metrics')).status_code)
+
+    def test_profile_and_logout(self):
+        self.client.get(reverse('profile'), HTTP_AUTHORIZATION='Bearer token')
+        self.client.get(reverse('profile'), HTTP_AUTHORIZATION='Bearer invalid')
+        self.client.get(reverse('remote_logout'), {'access_token': 'token'})
+
+        lines = self.scrape()
+        self.assertIn('# TYPE janus_profile_request_seconds histogram', lines)
+        self.assertIn('janus_profile_requests_total{application="test-client"} 1', lines)
+        self.assertIn('janus_token_validations_total{result="valid"} 1', lines)
+        self.assertIn('janus_token_validations_total{result="invalid"} 1', lines)
+        self.assertIn('janus_profile_request_seconds_bucket{le="+Inf"} 2', lines)
+        self.assertIn('janus_profile_request_seconds_count 2', lines)
+        self.assertIn('janus_logout_tokens_deleted_total{type="access"} 1', lines)
+
+    def test_validations_of_all_endpoints(self):
+        # userinfo and introspect validate through the same validator as the profile
+        self.client.get(reverse('profile'), HTTP_AUTHORIZATION='Bearer token')
+        JanusOAuth2Validator().validate_bearer_token('token', ['read'], OAuthRequest('https://localhost/o/userinfo/'))
+        self.assertIn('janus_token_validations_total{result="valid"} 2', self.scrape())
+
+    def test_authorize_decisions(self):
+        authentication_permitted(self.user, self.application)
+        GroupPermission.objects.create(profile_group=ProfileGroup.objects.create(name='everyone', default=True),
+                                       application=self.application, can_authenticate=True)
+        authentication_permitted(self.user, self.application)
+        authentication_permitted(self.user, self.application)
+
+        lines = self.scrape()
+        self.assertIn('janus_authorize_decisions_total{decision="allow"} 2', lines)
+        self.assertIn('janus_authorize_decisions_total{decision="deny"} 1', lines)
+
+    def test_cache_hit_ratio(self):
+        with mock.patch.object(app_settings, 'JANUS_PERMISSION_CACHE_TTL', 60):
+            resolve_permissions(self.user, self.application)
+            resolve_permissions(self.user, self.application)
+            resolve_permissions(self.user, self.application)
+            lines = self.scrape()
+        self.assertIn('janus_permission_cache_requests_total{result="misses"} 1', lines)
+        self.assertIn('janus_permission_cache_hit_ratio 0.6666666666666666', lines)
+
+    def test_aggregated_over_workers_without_database_writes(self):
+        workers = [Metrics(), Metrics()]
+        with self.assertNumQueries(0):
+            for worker in workers:
+                worker.inc('janus_cleanup_runs_total')
+                worker.observe('janus_cleanup_duration_seconds', 0.2)
+                worker.flush()
+
+        lines = self.scrape()
+        self.assertIn('janus_cleanup_runs_total 2', lines)
+        self.assertIn('janus_cleanup_duration_seconds_bucket{le="0.1"} 0', lines)
+        self.assertIn('janus_cleanup_duration_seconds_bucket{le="0.25"} 2', lines)
+        self.assertIn('janus_cleanup_duration_seconds_sum 0.4', lines)
+
+
+class BenchmarkTests(TestCase):
+    def test_benchmark_small_organization(self):
+        organization = generate_organization(users=20, groups=5, applications=4, groups_per_user=2,
+                                             applications_per_group=2, application_groups=2)
+        self.assertEqual(20, len(organization.user_ids))
+        self.assertEqual(20, Profile.objects.filter(user_id__in=organization.user_ids).count())
+        # the generated groups do not apply to other users
+        self.assertFalse(ProfileGroup.objects.filter(default=True).exists())
+
+        results = run_benchmark(organization, iterations=3)
+        self.assertEqual('sqlite', results['database'])
+        for name in ('profile', 'authorize', 'logout'):
+            result = results['endpoints'][name]
+            self.assertEqual(3, result['requests'])
+            self.assertGreater(result['queries_mean'], 0)
+            self.assertLessEqual(result['p50_ms'], result['p99_ms'])
+        self.assertEqual({'200': 3}, results['endpoints']['profile']['status_codes'])
+
+    def test_host_validation_and_failed_requests(self):
+        organization = generate_organization(users=5, groups=2, applications=2, groups_per_user=1,
+                                             applications_per_group=1, application_groups=1)
+        # outside of the tests `testserver` is not an allowed host
+        with self.settings(ALLOWED_HOSTS=['sso.example.com']):
+            results = run_benchmark(organization, iterations=2, endpoints=['profile'])
+        self.assertEqual({'200': 2}, results['endpoints']['profile']['status_codes'])
+        self.assertEqual(0, results['endpoints']['profile']['errors'])
+
+        # error responses are not reported as latencies
+        with mock.patch('janus.benchmark._create_token', return_value='invalid'):
+            results = run_benchmark(organization, iterations=2, endpoints=['profile'])
+        self.assertEqual({'failed': 'all requests failed', 'status_codes': {'403': 2}},
+                         results['endpoints']['profile'])
+
+    def test_command_rolls_back(self):
+        out = StringIO()
+        call_command('janus_benchmark', users=5, groups=2, applications=2, iterations=1, endpoints=['profile'],
+                     stdout=out)
+        self.assertIn('profile', out.getvalue())
+        self.assertFalse(User.objects.filter(username__startswith='janus-bench').exists())
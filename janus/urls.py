@@ -1,11 +1,10 @@
 from django.conf.urls import include
 from django.urls import path, re_path
 from django.utils.module_loading import import_string
-from oauth2_provider.views import TokenView, RevokeTokenView, IntrospectTokenView, UserInfoView, \
-    ConnectDiscoveryInfoView, JwksInfoView
+from oauth2_provider.views import RevokeTokenView, UserInfoView, ConnectDiscoveryInfoView, JwksInfoView
 
 from janus import views
-from janus.oauth2.views import AuthorizationView
+from janus.oauth2.views import AuthorizationView, TokenView, IntrospectTokenView
 from janus.app_settings import JANUS_OIDC_ENABLED
 
 # override profile view if django settings point to a different class
@@ -35,8 +34,10 @@ urlpatterns = [
 
     # custom urls
     re_path(r'^o/profile/?$', ProfileViewClass.as_view(), name="profile"),
+    re_path(r'^o/profiles/?$', views.ProfileBatchView.as_view(), name="profile_batch"),
     re_path(r'^o/logout/?$', views.LogoutView.as_view(), name="remote_logout"),
     re_path(r'^o/not_authorized/$', views.not_authorized, name="not_authorized"),
+    re_path(r'^o/metrics/?$', views.metrics, name="metrics"),
 
     re_path(r'^o/restart_authorize/$', views.restart_authorize, name="restart_authorize"),
 
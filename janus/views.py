@@ -1,18 +1,67 @@
+import functools
+import hashlib
+import hmac
+import time
+
+from django.contrib.auth import get_user_model
 from django.contrib.sessions.models import Session
-from django.core.exceptions import ObjectDoesNotExist
-from django.http import JsonResponse, HttpResponse
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import JsonResponse, HttpResponse, HttpResponseNotModified, Http404
 from django.shortcuts import redirect, render
-from django.utils import timezone
+from django.utils.decorators import method_decorator
+from django.utils.http import parse_etags, quote_etag
+from django.utils.module_loading import import_string
+from django.views.decorators.csrf import csrf_exempt
 from django.views import View
 from oauth2_provider.exceptions import OAuthToolkitError
 from oauth2_provider.models import AccessToken, RefreshToken
 from oauth2_provider.views import ProtectedResourceView
 import json
 
-from janus.oauth2.util import get_permissions, get_group_list
+from janus import app_settings, cache
+from janus.backchannel import notify_logout
+from janus.cleanup import delete_in_batches
+from janus.instrumentation import instrument, stage
+from janus.metrics import metrics as janus_metrics, render as render_metrics
+from janus.models import UserSession, ProfileSnapshot
+from janus.oauth2.tokens import stored_token
+from janus.oauth2.util import resolve_permissions, resolve_application_permissions, get_permissions, get_group_list, \
+    uses_permission_store
+from janus.registry import registry
+
+try:
+    import orjson
+except ImportError:  # optional, encodes the profile responses faster
+    orjson = None
+
+
+def json_response(data, **kwargs):
+    """
+    compact JsonResponse, encoded with orjson if it is installed
+    """
+    if orjson is not None:
+        content = orjson.dumps(data, default=DjangoJSONEncoder().default)
+    else:
+        content = json.dumps(data, cls=DjangoJSONEncoder, separators=(',', ':'))
+    return HttpResponse(content, content_type='application/json', **kwargs)
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_profile_shape(profile_replace_json, profile_fields):
+    """
+    parse the key replacements and the field projection of an application extension once.
+    the cache is keyed by their content, a changed extension is compiled again.
+    :param profile_replace_json: ApplicationExtension.profile_replace_json
+    :param profile_fields: ApplicationExtension.profile_fields
+    :return: (tuple of (key, replacement), frozenset of the fields or None for all fields)
+    """
+    replacements = tuple(json.loads(profile_replace_json).items()) if profile_replace_json else ()
+    fields = frozenset(field.strip() for field in (profile_fields or '').split(',') if field.strip())
+    return replacements, fields or None
 
 
 class LogoutView(View):
+    @instrument('logout')
     def get(self, request):
         access_token = request.GET.get('access_token', None)
         if not access_token:
@@ -20,7 +69,8 @@ class LogoutView(View):
             if access_token:
                 access_token = access_token.replace("Bearer ", "")
 
-        token = AccessToken.objects.filter(token=access_token).first()
+        with stage('token'):
+            token = AccessToken.objects.filter(token=stored_token(access_token)).first()
 
         if not token:
             return self.error_response(OAuthToolkitError("No access token"))
@@ -31,69 +81,159 @@ class LogoutView(View):
 
         user = token.user
 
-        self.clean_user_sessions(user)
-        self.clean_user_tokens(user)
+        with stage('backchannel'):
+            notify_logout(request, user)
+        with stage('sessions'):
+            self.clean_user_sessions(user)
+        with stage('tokens'):
+            self.clean_user_tokens(user)
 
         return HttpResponse("OK")
 
     def clean_user_sessions(self, user):
-        now = timezone.now()
-        sessions = Session.objects.filter(expire_date__gt=now)
-
-        user_id2 = str(user.id)
-        for session in sessions:
-            user_id = session.get_decoded().get('_auth_user_id')
-            if user_id == user_id2:
-                session.delete()
+        # the index is filled on login, sessions from before run `./manage.py backfill_user_sessions`
+        user_sessions = UserSession.objects.filter(user=user)
+        deleted, _ = Session.objects.filter(session_key__in=user_sessions.values('session_key')).delete()
+        user_sessions.delete()
+        janus_metrics.inc('janus_logout_sessions_deleted_total', value=deleted)
 
     def clean_user_tokens(self, user):
-        AccessToken.objects.filter(user=user).delete()
-        RefreshToken.objects.filter(user=user).delete()
+        # batched, a user with many tokens must not lock large parts of the token tables
+        batch_size = app_settings.JANUS_CLEANUP_BATCH_SIZE
+        deleted = delete_in_batches(AccessToken.objects.filter(user=user), batch_size)
+        janus_metrics.inc('janus_logout_tokens_deleted_total', {'type': 'access'}, deleted)
+        deleted = delete_in_batches(RefreshToken.objects.filter(user=user), batch_size)
+        janus_metrics.inc('janus_logout_tokens_deleted_total', {'type': 'refresh'}, deleted)
 
 
 class ProfileView(ProtectedResourceView):
+    # keys of the profile response resolved from the permissions and from the application groups
+    PERMISSION_FIELDS = frozenset(['can_authenticate', 'is_staff', 'is_superuser'])
+    GROUP_FIELDS = frozenset(['groups'])
+
+    # keys requested by the current request, None for all
+    fields = None
+
+    @instrument('profile')
+    def dispatch(self, request, *args, **kwargs):
+        start = time.perf_counter()
+        response = super(ProfileView, self).dispatch(request, *args, **kwargs)
+        janus_metrics.observe('janus_profile_request_seconds', time.perf_counter() - start)
+        return response
+
+    def verify_request(self, request):
+        with stage('token_validation'):
+            valid, r = super(ProfileView, self).verify_request(request)
+        if valid:
+            # the validated token, loaded with its user and application
+            request.access_token = r.access_token
+        return valid, r
 
     def get(self, request):
         if request.resource_owner:
-            user = request.resource_owner
-
-            # set = user.accesstoken_set.all()
-            access_token = request.GET.get('access_token', None)
-            if not access_token:
-                access_token = request.META.get('HTTP_AUTHORIZATION', None)
-                if access_token:
-                    access_token = access_token.replace("Bearer ", "")
-
-            token = AccessToken.objects.filter(token=access_token).first()
-
-            if not token:
-                return self.error_response(OAuthToolkitError("No access token"))
+            with stage('token'):
+                token = request.access_token
+                user = token.user
+                application = token.application
+                self.fields = self.get_fields(request, application)
+
+            janus_metrics.inc('janus_profile_requests_total', {'application': application.client_id})
+
+            etag = None
+            if app_settings.JANUS_PROFILE_ETAG:
+                with stage('etag'):
+                    etag = self.get_etag(user, application)
+                    etags = parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))
+                    if etag in etags or '*' in etags:
+                        response = HttpResponseNotModified()
+                        response['ETag'] = etag
+                        return response
+
+            with stage('profile_data'):
+                data = ProfileSnapshot.for_token(token) if app_settings.JANUS_PROFILE_SNAPSHOT else None
+                if data is None:
+                    data = self.generate_json_data(user, application)
+            with stage('replace_keys'):
+                data = self.shape_json_data(data, application, self.fields)
+
+            response = json_response(data)
+            if etag:
+                response['ETag'] = etag
+            return response
 
-            if not token.is_valid():
-                return self.error_response(OAuthToolkitError("invalid access token"))
-
-            user = token.user
-            application = token.application
+        return self.error_response(OAuthToolkitError("No resource owner"))
 
-            data = self.generate_json_data(user, application)
-            data = self._replace_keys_by_application(data, application)
 
-            return JsonResponse(data)
+    def get_etag_data(self, user, application):
+        """
+        everything the profile response depends on, besides the permissions and groups.
+        extend it if generate_json_data is extended.
+        :param user:
+        :param application:
+        :return: list of values
+        """
+        extension = registry.get_extension(application)
+        return [user.pk, user.username, user.first_name, user.last_name, user.email,
+                extension.profile_replace_json if extension else None, extension.profile_fields if extension else None]
 
-        return self.error_response(OAuthToolkitError("No resource owner"))
+    def get_etag(self, user, application):
+        """
+        the ETag of the profile response, changes whenever the permissions, the groups or the etag data change
+        :param user:
+        :param application:
+        :return: quoted etag
+        """
+        fields = None if self.fields is None else sorted(self.fields)
+        data = [cache.get_permission_version(user, application), fields] + \
+            self.get_etag_data(user, application)
+        return quote_etag(hashlib.md5(repr(data).encode('utf-8')).hexdigest())
 
+    def get_fields(self, request, application):
+        """
+        the keys of the profile response, from the `fields` query parameter (comma separated, the replaced keys
+        are accepted as well) limited to the profile fields of the application
+        :param request:
+        :param application:
+        :return: frozenset of the keys before the replacement, None for all
+        """
+        replacements, default = self.get_profile_shape(application)
+        requested = request.GET.get('fields')
+        if not requested:
+            return default
+        original = {value: key for key, value in replacements}
+        fields = frozenset(original.get(field.strip(), field.strip()) for field in requested.split(',')
+                           if field.strip())
+        return fields if default is None else fields & default
 
     def generate_json_data(self, user, application):
         """
-        generate the profile response json object
+        generate the profile response json object, the permissions and groups are only resolved if requested
         :param user:
         :param application:
         :return:
         """
-
-        can_authenticate, is_staff, is_superuser = get_permissions(user, application)
-
-        groups = get_group_list(user, application)
+        need_permissions = self.fields is None or not self.PERMISSION_FIELDS.isdisjoint(self.fields)
+        need_groups = self.fields is None or not self.GROUP_FIELDS.isdisjoint(self.fields)
+
+        with stage('permissions'):
+            if not need_permissions and not need_groups:
+                permissions = (None, None, None), None
+            elif need_permissions and need_groups or uses_permission_store():
+                # the cache and the materialized table answer the flags and the groups at once
+                permissions = resolve_permissions(user, application)
+            else:
+                permissions = (get_permissions(user, application) if need_permissions else (None, None, None),
+                               get_group_list(user, application) if need_groups else None)
+        return self.build_json_data(user, permissions)
+
+    def build_json_data(self, user, permissions):
+        """
+        build the profile response json object from resolved permissions, used by the batch profile view as well
+        :param user:
+        :param permissions: ((can_authenticate, is_staff, is_superuser), groups)
+        :return:
+        """
+        (can_authenticate, is_staff, is_superuser), groups = permissions
 
         data = {
             'id': user.username,
@@ -112,6 +252,17 @@ class ProfileView(ProtectedResourceView):
 
         return data
 
+    @staticmethod
+    def get_profile_shape(application):
+        """
+        :param application: allauth application
+        :return: compiled (replacements, fields) of the application, see compile_profile_shape
+        """
+        extension = registry.get_extension(application)
+        if extension is None:
+            return (), None
+        return compile_profile_shape(extension.profile_replace_json, extension.profile_fields)
+
     @staticmethod
     def _replace_keys_by_application(json_data, application):
         """
@@ -120,19 +271,90 @@ class ProfileView(ProtectedResourceView):
         :param application: allauth application
         :return: processed json dict
         """
-        try:
-            extension = application.extension
-            replacement_mapping = extension.profile_replace_json
-        except ObjectDoesNotExist:
-            return json_data
-        if replacement_mapping is not None:
-            # iterate over replacements and apply them
-            replace_data = json.loads(replacement_mapping)
-            for key, value in replace_data.items():
-                if key in json_data:
-                    json_data[value] = json_data.pop(key)
+        replacements, _ = ProfileView.get_profile_shape(application)
+        for key, value in replacements:
+            if key in json_data:
+                json_data[value] = json_data.pop(key)
         return json_data
 
+    def shape_json_data(self, json_data, application, fields=None):
+        """
+        limit the json data to the requested fields or the profile fields of the application and replace the keys
+        :param json_data: json dict
+        :param application: allauth application
+        :param fields: keys to keep, None for the profile fields of the application
+        :return: processed json dict
+        """
+        if fields is None:
+            _, fields = self.get_profile_shape(application)
+        if fields is not None:
+            json_data = {key: value for key, value in json_data.items() if key in fields}
+        return self._replace_keys_by_application(json_data, application)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class ProfileBatchView(ProtectedResourceView):
+    """
+    profiles of many users for the application of a client credentials token.
+    POST {"usernames": [...], "ids": [...]}, answers {"profiles": [...], "not_found": [...]}.
+    users who are not permitted to authenticate for the application are reported as not found.
+    """
+
+    def verify_request(self, request):
+        valid, r = super(ProfileBatchView, self).verify_request(request)
+        if valid:
+            request.access_token = r.access_token
+        return valid, r
+
+    def post(self, request):
+        token = request.access_token
+        if token.user_id is not None:
+            return JsonResponse({'error': 'client credentials token required'}, status=403)
+        application = token.application
+
+        try:
+            body = json.loads(request.body or '{}')
+            usernames = [str(username) for username in body.get('usernames', [])]
+            ids = [int(pk) for pk in body.get('ids', [])]
+        except (ValueError, TypeError, AttributeError):
+            return JsonResponse({'error': 'expected {"usernames": [...], "ids": [...]}'}, status=400)
+        if len(usernames) + len(ids) > app_settings.JANUS_PROFILE_BATCH_LIMIT:
+            return JsonResponse({'error': 'at most %d users per request' % app_settings.JANUS_PROFILE_BATCH_LIMIT},
+                                status=400)
+
+        user_model = get_user_model()
+        users = list(user_model.objects.filter(username__in=usernames) | user_model.objects.filter(pk__in=ids))
+        permissions = resolve_application_permissions([user.pk for user in users], application)
+
+        profile_view = import_string(app_settings.ALLAUTH_JANUS_PROFILE_VIEW)()
+        profiles = []
+        found_usernames, found_ids = set(), set()
+        for user in users:
+            if not permissions[user.pk][0][0]:
+                continue
+            found_usernames.add(user.username)
+            found_ids.add(user.pk)
+            data = profile_view.build_json_data(user, permissions[user.pk])
+            profiles.append(profile_view.shape_json_data(data, application))
+
+        not_found = [username for username in usernames if username not in found_usernames] + \
+                    [pk for pk in ids if pk not in found_ids]
+        return json_response({'profiles': profiles, 'not_found': not_found})
+
+
+def metrics(request):
+    if not app_settings.JANUS_METRICS:
+        raise Http404()
+
+    if app_settings.JANUS_METRICS_TOKEN:
+        authorization = request.META.get('HTTP_AUTHORIZATION', '')
+        if not hmac.compare_digest(authorization, 'Bearer ' + app_settings.JANUS_METRICS_TOKEN):
+            return HttpResponse(status=401)
+    elif not request.user.is_staff:
+        return HttpResponse(status=403)
+
+    return HttpResponse(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
 
 def index(request):
 